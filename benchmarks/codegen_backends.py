@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# For copyright and license terms, see COPYRIGHT.rst (top level of repository)
+# Repository: https://github.com/C3S/collecting_society_worker
+
+"""
+Benchmark of echoprint-codegen as subprocess against the codegen library
+
+Fingerprints generated mono 11025 Hz wav files (the format of excerpts
+and the PCM cache) with the echoprint-codegen binary, in-process with
+the library built from contrib/codegen_c.cpp and through the worker
+process of the library repro.py uses, checks that the binary and the
+library print the same code string and compares the time per file.
+Needs ffmpeg and echoprint-codegen in the exe path. Run from the
+repository root:
+
+    python benchmarks/codegen_backends.py path/to/libcodegen_c.so
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from collecting_society_worker import codegenLibrary  # noqa: E402
+from collecting_society_worker import codegenRunner  # noqa: E402
+
+LENGTHS = [10, 60, 300]  # seconds
+
+
+def binary(path):
+    return str(subprocess.check_output(["echoprint-codegen", path]), "utf-8")
+
+
+def measure(func, path, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        output = func(path)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, json.loads(output)[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('library')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    library = codegenLibrary.CodegenLibrary(args.library)
+    tmp = tempfile.mkdtemp()
+    runner = codegenRunner.CodegenRunner(tmp, 1)
+    command = codegenLibrary.server_command(args.library)
+
+    def worker(path):
+        return runner.call(path, command, [path, 0, 0])
+
+    try:
+        print("%-8s %12s %12s %12s %10s" % (
+            'length', 'subprocess', 'library', 'worker', 'identical'))
+        for length in LENGTHS:
+            path = os.path.join(tmp, '%d.wav' % length)
+            subprocess.check_call(
+                ["ffmpeg", "-v", "error", "-y",
+                 "-f", "lavfi", "-i", "anoisesrc=a=0.3:d=%d" % length,
+                 "-ac", "1", "-ar", str(codegenLibrary.CODEGEN_RATE),
+                 "-c:a", "pcm_s16le", path])
+            binary_time, binary_result = measure(binary, path, args.repeat)
+            library_time, library_result = measure(
+                library.codegen_file, path, args.repeat)
+            worker_time, _ = measure(worker, path, args.repeat)
+            print("%-8s %12s %12s %12s %10s" % (
+                '%d s' % length, '%.3f s' % binary_time,
+                '%.3f s' % library_time, '%.3f s' % worker_time,
+                binary_result['code'] == library_result['code'] and
+                binary_result['code_count'] ==
+                library_result['code_count']))
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+# For copyright and license terms, see COPYRIGHT.rst (top level of repository)
+# Repository: https://github.com/C3S/collecting_society_worker
+
+"""
+Benchmark of the preview stage per upload format and decoder
+
+Renders preview and excerpt of generated test files with the ffmpeg
+filter graph, with numpy from ffmpeg decoded ranges and with numpy from
+the native decoders. Needs ffmpeg, FLAC needs soundfile for the native
+path. Run from the repository root:
+
+    python benchmarks/decoders.py [--minutes 10]
+"""
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from collecting_society_worker import audioTools  # noqa: E402
+from preview_renderer import (  # noqa: E402
+    ranges, CROSSFADE, FADEIN, FADEOUT, SAMPLERATE)
+
+EXCERPT = 60000
+EXCERPT_RATE = 11025
+
+FORMATS = [
+    ('wav 16 bit', 'wav', ['-c:a', 'pcm_s16le']),
+    ('wav 24 bit', 'wav', ['-c:a', 'pcm_s24le']),
+    ('flac', 'flac', []),
+    ('mp3', 'mp3', ['-b:a', '192k']),
+]
+
+
+def excerpt_range(total):
+    if total > EXCERPT:
+        return (total / 2 - EXCERPT / 2, total / 2 + EXCERPT / 2)
+    return (0, total)
+
+
+def ffmpeg_graph(path, info, out):
+    return audioTools.render_with_ffmpeg(
+        path, ranges(info['duration']), CROSSFADE, FADEIN, FADEOUT,
+        excerpt_range(info['duration']),
+        (out + '.ogg', 'ogg', SAMPLERATE, ['-aq', '0']),
+        (out + '.wav', 'wav', EXCERPT_RATE, []))
+
+
+def ffmpeg_numpy(path, info, out):
+    segments = audioTools.decode_ranges_samples(
+        path, ranges(info['duration']), info['channels'], info['frame_rate'])
+    preview = audioTools.render_preview(
+        segments, info['frame_rate'], CROSSFADE, FADEIN, FADEOUT, SAMPLERATE)
+    audioTools.encode_samples(preview, SAMPLERATE, out + '.ogg', 'ogg')
+    start, end = excerpt_range(info['duration'])
+    excerpt = audioTools.decode_range_samples(
+        path, start, end - start, info['channels'], info['frame_rate'])
+    return audioTools.write_wav(
+        audioTools.render_excerpt(
+            excerpt, info['frame_rate'], EXCERPT_RATE),
+        EXCERPT_RATE, out + '.wav')
+
+
+def native_numpy(path, info, out):
+    native = audioTools.open_native(path)
+    if native is None:
+        return None
+    with native:
+        duration = int(1000 * native.frames / native.frame_rate)
+        preview = audioTools.render_preview(
+            [native.read(start, end) for start, end in ranges(duration)],
+            native.frame_rate, CROSSFADE, FADEIN, FADEOUT, SAMPLERATE)
+        audioTools.encode_samples(preview, SAMPLERATE, out + '.ogg', 'ogg')
+        excerpt = audioTools.render_excerpt(
+            native.read(*excerpt_range(duration)),
+            native.frame_rate, EXCERPT_RATE)
+    return audioTools.write_wav(excerpt, EXCERPT_RATE, out + '.wav')
+
+
+def measure(func, path, info, out, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        if func(path, info, out) is None:
+            return None
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--minutes', type=float, default=10)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    tmp = tempfile.mkdtemp()
+    try:
+        source = os.path.join(tmp, 'source')
+        subprocess.check_call(
+            ["ffmpeg", "-v", "error", "-y",
+             "-f", "lavfi", "-i", "sine=frequency=440:duration=%f" % (
+                 args.minutes * 60),
+             "-f", "lavfi", "-i", "anoisesrc=a=0.1:d=%f" % (
+                 args.minutes * 60),
+             "-filter_complex", "amerge", "-ac", "2", "-ar", "44100",
+             "-f", "wav", source])
+        print("%.1f min stereo at 44100 Hz" % args.minutes)
+        print("%-12s %14s %14s %14s" % (
+            'format', 'ffmpeg graph', 'ffmpeg+numpy', 'native+numpy'))
+        for name, extension, parameters in FORMATS:
+            path = os.path.join(tmp, 'upload.' + extension)
+            subprocess.check_call(
+                ["ffmpeg", "-v", "error", "-y", "-i", source] +
+                parameters + [path])
+            info = audioTools.probe_audiofile(path)
+            out = os.path.join(tmp, 'out')
+            results = [
+                measure(func, path, info, out, args.repeat)
+                for func in (ffmpeg_graph, ffmpeg_numpy, native_numpy)]
+            print("%-12s %14s %14s %14s" % ((name,) + tuple(
+                '-' if result is None else '%.3f s' % result
+                for result in results)))
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# For copyright and license terms, see COPYRIGHT.rst (top level of repository)
+# Repository: https://github.com/C3S/collecting_society_worker
+
+"""
+Benchmark of the preview renderers on synthetic audio
+
+Compares the former pydub append chain, the in-place pydub assembler and
+the numpy renderer. Run from the repository root:
+
+    python benchmarks/preview_renderer.py [--minutes 10] [--encode]
+"""
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+import numpy
+from pydub import AudioSegment
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from collecting_society_worker import audioTools  # noqa: E402
+
+# same as the _preview_* constants in repro.py
+SEGMENT = 8000
+INTERVAL = 54000
+CROSSFADE = 2000
+FADEIN = 1000
+FADEOUT = 1000
+SAMPLERATE = 16000
+
+
+def ranges(total):
+    if SEGMENT >= total:
+        return [(0, total)]
+    result = []
+    start, end = 0, SEGMENT
+    while end < total:
+        result.append((start, end))
+        start = end + INTERVAL + 1
+        end = start + SEGMENT
+    return result
+
+
+def pydub_chain(audio):
+    mono = audio.set_channels(1)
+    preview = None
+    for start, end in ranges(len(mono)):
+        segment = mono[start:end]
+        preview = segment if not preview else preview.append(
+            segment, crossfade=CROSSFADE)
+    return preview.fade_in(FADEIN).fade_out(FADEOUT)
+
+
+def pydub_assembler(audio):
+    return audioTools.assemble_preview(
+        [audio[start:end] for start, end in ranges(len(audio))],
+        CROSSFADE, FADEIN, FADEOUT)
+
+
+def numpy_renderer(samples, frame_rate):
+    segments = [
+        samples[start * frame_rate // 1000:end * frame_rate // 1000]
+        for start, end in ranges(len(samples) * 1000 // frame_rate)]
+    return audioTools.render_preview(
+        segments, frame_rate, CROSSFADE, FADEIN, FADEOUT, SAMPLERATE)
+
+
+def measure(name, func, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    print("%-20s %8.3f s" % (name, best))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--minutes', type=float, default=10)
+    parser.add_argument('--rate', type=int, default=44100)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--encode', action='store_true',
+                        help="include the ogg encoding (needs ffmpeg)")
+    args = parser.parse_args()
+
+    rng = numpy.random.default_rng(0)
+    samples = rng.integers(
+        -8000, 8000, size=(int(args.minutes * 60 * args.rate), 2),
+        dtype=numpy.int16)
+    audio = AudioSegment(
+        data=samples.tobytes(), sample_width=2,
+        frame_rate=args.rate, channels=2)
+    path = os.path.join(tempfile.mkdtemp(), 'preview')
+    print("%.1f min stereo at %d Hz, %d segments" % (
+        args.minutes, args.rate, len(ranges(len(audio)))))
+
+    def export(preview):
+        if args.encode:
+            preview.export(path, format='ogg',
+                           parameters=["-aq", "0", "-ar", str(SAMPLERATE)])
+
+    def encode(preview):
+        if args.encode:
+            audioTools.encode_samples(
+                preview, SAMPLERATE, path, 'ogg', ["-aq", "0"])
+
+    measure("pydub append chain",
+            lambda: export(pydub_chain(audio)), args.repeat)
+    measure("pydub assembler",
+            lambda: export(pydub_assembler(audio)), args.repeat)
+    measure("numpy renderer",
+            lambda: encode(numpy_renderer(samples, args.rate)), args.repeat)
+
+
+if __name__ == '__main__':
+    main()
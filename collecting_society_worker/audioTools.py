@@ -0,0 +1,799 @@
+#!/usr/bin/env python
+# For copyright and license terms, see COPYRIGHT.rst (top level of repository)
+# Repository: https://github.com/C3S/collecting_society_worker
+
+"""
+The one and only C3S tools for probing and decoding audio files
+"""
+
+
+import os
+import json
+import mmap
+import wave
+import select
+import struct
+import tempfile
+import subprocess
+
+import numpy
+from pydub import AudioSegment
+from pydub.exceptions import CouldntDecodeError
+try:
+    import soundfile  # optional, native FLAC decoding via libsndfile
+except ImportError:
+    soundfile = None
+
+
+# bits per sample of the ffmpeg sample formats (planar ones end with 'p')
+_sample_format_bits = {
+    'u8': 8,
+    's16': 16,
+    's32': 32,
+    's64': 64,
+    'flt': 32,
+    'dbl': 64,
+}
+
+# the conversion echoprint-codegen does with its own ffmpeg, as wav
+_codegen_output = [
+    "-vn", "-f", "wav", "-acodec", "pcm_s16le", "-ac", "1", "-ar", "11025"]
+
+# ffprobe reports fltp for these lossy codecs, pydub decodes them to 16 bit
+_lossy_codecs = ['mp3', 'mp4', 'aac', 'webm', 'ogg', 'vorbis', 'opus']
+
+
+def probe_audiofile(filepath):
+    """
+    Reads the properties of the first audio stream from the file header.
+
+    Returns a dict with the duration in ms (None if the header doesn't
+    tell), channels, frame_rate and the sample_width in bytes (as pydub
+    would decode the file), or None if the file has no readable audio
+    stream. Raises OSError if ffprobe is missing.
+    """
+    proc = subprocess.Popen(
+        ["ffprobe", "-v", "error", "-select_streams", "a:0",
+         "-show_entries",
+         "stream=codec_name,channels,sample_rate,sample_fmt,"
+         "bits_per_sample,duration:format=duration",
+         "-of", "json", filepath],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    output = proc.communicate()[0]
+    if proc.returncode != 0:
+        return None
+    try:
+        probe = json.loads(output.decode('utf-8'))
+        stream = probe['streams'][0]
+        duration = (stream.get('duration') or
+                    probe.get('format', {}).get('duration'))
+        sample_fmt = stream.get('sample_fmt', '')
+        bits = int(stream.get('bits_per_sample') or 0)
+        if not bits:
+            bits = _sample_format_bits.get(sample_fmt.rstrip('p'), 0)
+        if sample_fmt == 'fltp' and stream.get('codec_name') in _lossy_codecs:
+            bits = 16
+        return {
+            'duration': (
+                int(float(duration) * 1000) if duration not in (None, 'N/A')
+                else None),
+            'channels': int(stream['channels']),
+            'frame_rate': int(stream['sample_rate']),
+            'sample_width': bits // 8,
+        }
+    except (ValueError, KeyError, IndexError):
+        return None
+
+
+def segment_info(audio):
+    """
+    Returns the same properties as probe_audiofile() for an AudioSegment.
+    """
+    return {
+        'duration': len(audio),
+        'channels': audio.channels,
+        'frame_rate': audio.frame_rate,
+        'sample_width': audio.sample_width,
+    }
+
+
+def _decode_range(filepath, start, duration, channels, frame_rate):
+    try:
+        proc = subprocess.Popen(
+            ["ffmpeg", "-v", "error", "-nostdin",
+             "-ss", "%.3f" % (start / 1000.0),
+             "-t", "%.3f" % (duration / 1000.0),
+             "-i", filepath,
+             "-vn", "-f", "s16le", "-acodec", "pcm_s16le",
+             "-ac", str(channels), "-ar", str(frame_rate),
+             "-"],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except OSError:
+        raise CouldntDecodeError(
+            "Unable to find ffmpeg executable in exe path.")
+    data, error = proc.communicate()
+    if proc.returncode != 0:
+        raise CouldntDecodeError(
+            "Decoding of '" + filepath + "' failed: " +
+            error.decode('utf-8', 'replace'))
+    # cut off incomplete frames
+    return data[:len(data) - len(data) % (2 * channels)]
+
+
+def decode_range(filepath, start, duration, channels, frame_rate):
+    """
+    Decodes duration ms of the file beginning at start ms.
+
+    ffmpeg seeks in the input, so only the requested range gets decoded.
+    Returns a 16 bit AudioSegment with the given channels and frame_rate.
+    """
+    data = _decode_range(filepath, start, duration, channels, frame_rate)
+    return AudioSegment(
+        data=data, sample_width=2, frame_rate=frame_rate, channels=channels)
+
+
+def decode_range_samples(filepath, start, duration, channels, frame_rate):
+    """
+    Like decode_range(), but returns an int16 array (frames, channels).
+    """
+    data = _decode_range(filepath, start, duration, channels, frame_rate)
+    return numpy.frombuffer(data, dtype=numpy.int16).reshape(-1, channels)
+
+
+def _decode_ranges(filepath, ranges, channels, frame_rate):
+    # every range is a seeking input of the same file, written to its own
+    # pipe, which are all read at once so ffmpeg never blocks on one
+    command = ["ffmpeg", "-v", "error", "-nostdin"]
+    for start, end in ranges:
+        command += [
+            "-ss", "%.3f" % (start / 1000.0),
+            "-t", "%.3f" % ((end - start) / 1000.0),
+            "-i", filepath]
+    pipes = [os.pipe() for _ in ranges]
+    for index, (_, write) in enumerate(pipes):
+        command += [
+            "-map", "%d:a:0" % index, "-f", "s16le", "-acodec", "pcm_s16le",
+            "-ac", str(channels), "-ar", str(frame_rate),
+            "pipe:%d" % write]
+    try:
+        proc = subprocess.Popen(
+            command, stderr=subprocess.PIPE,
+            pass_fds=[write for _, write in pipes])
+    except OSError:
+        for read, _ in pipes:
+            os.close(read)
+        raise CouldntDecodeError(
+            "Unable to find ffmpeg executable in exe path.")
+    finally:
+        for _, write in pipes:
+            os.close(write)
+    chunks = dict((read, []) for read, _ in pipes)
+    chunks[proc.stderr.fileno()] = []
+    reading = list(chunks)
+    while reading:
+        for fd in select.select(reading, [], [])[0]:
+            chunk = os.read(fd, 1048576)
+            if chunk:
+                chunks[fd].append(chunk)
+            else:
+                reading.remove(fd)
+    for read, _ in pipes:
+        os.close(read)
+    proc.stderr.close()
+    if proc.wait() != 0:
+        raise CouldntDecodeError(
+            "Decoding of '" + filepath + "' failed: " + b''.join(
+                chunks[proc.stderr.fileno()]).decode('utf-8', 'replace'))
+    data = [b''.join(chunks[read]) for read, _ in pipes]
+    # cut off incomplete frames
+    return [d[:len(d) - len(d) % (2 * channels)] for d in data]
+
+
+def decode_ranges(filepath, ranges, channels, frame_rate):
+    """
+    Like decode_range() for several (start, end) ranges in ms, decoded by
+    one ffmpeg process. Returns a list of AudioSegments.
+    """
+    return [
+        AudioSegment(
+            data=data, sample_width=2, frame_rate=frame_rate,
+            channels=channels)
+        for data in _decode_ranges(filepath, ranges, channels, frame_rate)]
+
+
+def decode_ranges_samples(filepath, ranges, channels, frame_rate):
+    """
+    Like decode_ranges(), but returns int16 arrays (frames, channels).
+    """
+    return [
+        numpy.frombuffer(data, dtype=numpy.int16).reshape(-1, channels)
+        for data in _decode_ranges(filepath, ranges, channels, frame_rate)]
+
+
+class RangeDecoder(object):
+    """
+    A file decoded by ffmpeg range by range, with the API of WavFile.
+
+    The number of frames is taken from the duration in the file header
+    (audio_info of probe_audiofile()), read_ranges() decodes all ranges
+    with one ffmpeg process.
+    """
+
+    def __init__(self, filepath, audio_info):
+        self.filepath = filepath
+        self.channels = audio_info['channels']
+        self.frame_rate = audio_info['frame_rate']
+        self.frames = int(audio_info['duration'] * self.frame_rate / 1000)
+
+    def read(self, start, end):
+        return self.read_ranges([(start, end)])[0]
+
+    def read_ranges(self, ranges):
+        return decode_ranges_samples(
+            self.filepath, ranges, self.channels, self.frame_rate)
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def decode_for_codegen(filepath, path):
+    """
+    Decodes a file to the mono 11025 Hz wav echoprint-codegen works on.
+
+    Returns True on success.
+    """
+    proc = subprocess.Popen(
+        ["ffmpeg", "-v", "error", "-nostdin", "-y", "-i", filepath] +
+        _codegen_output + [path],
+        stderr=subprocess.PIPE)
+    error = proc.communicate()[1]
+    if proc.returncode != 0:
+        print("ERROR: Decoding of '" + filepath + "' failed: " +
+              error.decode('utf-8', 'replace'))
+        return False
+    return True
+
+
+class PCMBuffer(object):
+    """
+    A whole file decoded to 16 bit PCM in a memory mapped scratch file.
+
+    The audio attribute is an AudioSegment on top of the mapping, so its
+    slices are memoryviews into the page cache instead of copies in RAM.
+
+    If tee is given, the file is read here and piped into ffmpeg, and each
+    chunk is passed to tee.update() on the way (e.g. a hasher). If
+    codegen_path is given, the mono 11025 Hz input of echoprint-codegen
+    is written there as a wav file by the same ffmpeg process.
+
+    ffmpeg can't seek in a pipe and ends without an error after decoding
+    nothing of e.g. mp4 files with the index at the end. With tee, less
+    than half of duration (ms, from the header) or no audio at all raises
+    CouldntDecodeError, so the caller can decode the file by path.
+
+    Like WavFile, it has frames, channels, frame_rate, read() and
+    read_ranges().
+    """
+
+    def __init__(self, filepath, channels, frame_rate, scratch_dir=None,
+                 tee=None, codegen_path=None, duration=0):
+        fd, self.path = tempfile.mkstemp(suffix='.pcm', dir=scratch_dir)
+        os.close(fd)
+        self.channels = channels
+        self.frame_rate = frame_rate
+        self._file = None
+        self._mmap = None
+        try:
+            command = [
+                "ffmpeg", "-v", "error", "-y",
+                "-i", filepath if tee is None else "pipe:0",
+                "-vn", "-f", "s16le", "-acodec", "pcm_s16le",
+                "-ac", str(channels), "-ar", str(frame_rate),
+                self.path]
+            if codegen_path:
+                command += _codegen_output + [codegen_path]
+            with tempfile.TemporaryFile() as stderr:
+                if tee is None:
+                    returncode = subprocess.call(
+                        command, stdin=subprocess.DEVNULL, stderr=stderr)
+                else:
+                    returncode = _decode_teed(filepath, command, tee, stderr)
+                stderr.seek(0)
+                error = stderr.read()
+            if returncode != 0:
+                raise CouldntDecodeError(
+                    "Decoding of '" + filepath + "' failed: " +
+                    error.decode('utf-8', 'replace'))
+            self._file = open(self.path, 'rb')
+            size = os.fstat(self._file.fileno()).st_size
+            size -= size % (2 * channels)
+            data = b''
+            if size:
+                self._mmap = mmap.mmap(
+                    self._file.fileno(), size, access=mmap.ACCESS_READ)
+                data = memoryview(self._mmap)
+            self.audio = AudioSegment(
+                data=data, sample_width=2,
+                frame_rate=frame_rate, channels=channels)
+            self.samples = numpy.frombuffer(
+                data, dtype=numpy.int16).reshape(-1, channels)
+            self.frames = len(self.samples)
+            decoded = 1000 * self.frames // frame_rate
+            if tee is not None and (
+                    not self.frames or decoded < (duration or 0) / 2):
+                raise CouldntDecodeError(
+                    "Decoding of '" + filepath + "' from a pipe failed: "
+                    "got " + str(decoded) + " ms" +
+                    (" of " + str(duration) if duration else ""))
+        except Exception:
+            self.close()
+            raise
+
+    def read(self, start, end):
+        """
+        Returns the frames from start to end ms as int16 (frames, channels).
+        """
+        return self.samples[
+            int(start * self.frame_rate / 1000.0):
+            int(end * self.frame_rate / 1000.0)]
+
+    def read_ranges(self, ranges):
+        """
+        Returns read() of each (start, end) range.
+        """
+        return [self.read(start, end) for start, end in ranges]
+
+    def close(self):
+        """
+        Unmaps and removes the scratch file.
+        """
+        self.audio = None
+        self.samples = None
+        if self._mmap is not None:
+            try:
+                self._mmap.close()
+            except BufferError:
+                pass  # slices still alive, unmapped when collected
+            self._mmap = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def _decode_teed(filepath, command, tee, stderr, bufsize=1048576):
+    """
+    Runs the ffmpeg command, feeding it with the file via stdin and tee.
+
+    The whole file is passed to tee, even if ffmpeg gives up early.
+    """
+    proc = subprocess.Popen(command, stdin=subprocess.PIPE, stderr=stderr)
+    stdin = proc.stdin
+    with open(filepath, 'rb') as source:
+        while True:
+            data = source.read(bufsize)
+            if not data:
+                break
+            tee.update(data)
+            if stdin is not None:
+                try:
+                    stdin.write(data)
+                except BrokenPipeError:
+                    stdin = None
+    try:
+        proc.stdin.close()
+    except BrokenPipeError:
+        pass
+    return proc.wait()
+
+
+def assemble_preview(segments, crossfade, fadein, fadeout):
+    """
+    Mixes the segments into a mono preview.
+
+    Gives the same result as chained AudioSegment.append(crossfade=...)
+    followed by fade_in() and fade_out(), but allocates the output once
+    and writes each crossfaded segment into place, so the preview isn't
+    copied again for every segment.
+    """
+    segments = [segment.set_channels(1) for segment in segments]
+    first = segments[0]
+    # the header may overestimate the duration
+    segments = [first] + [s for s in segments[1:] if len(s) > crossfade]
+
+    xf_bytes = len(first[:crossfade].raw_data) if len(segments) > 1 else 0
+    total = sum(len(s.raw_data) for s in segments)
+    output = bytearray(total - xf_bytes * (len(segments) - 1))
+    pos = 0
+    for segment in segments:
+        data = segment.raw_data
+        if pos:
+            # crossfade the tail already in place with the new head
+            tail = first._spawn(output[pos - xf_bytes:pos])
+            head = first._spawn(data[:xf_bytes])
+            xf = tail.fade(to_gain=-120, start=0, end=float('inf'))
+            xf *= head.fade(from_gain=-120, start=0, end=float('inf'))
+            output[pos - xf_bytes:pos] = xf.raw_data
+            data = data[xf_bytes:]
+        output[pos:pos + len(data)] = data
+        pos += len(data)
+    preview = first._spawn(output)
+
+    # fade in/out in place
+    faded = preview[:fadein].fade_in(fadein).raw_data
+    output[:len(faded)] = faded
+    faded = preview[-fadeout:].fade_out(fadeout).raw_data
+    output[len(output) - len(faded):] = faded
+    return preview
+
+
+def downmix(samples):
+    """
+    Averages the channels of a sample array into mono float32.
+    """
+    # summing columns beats mean() over the short axis
+    if samples.ndim == 1:
+        return samples.astype(numpy.float32)
+    mono = samples[:, 0].astype(numpy.float32)
+    for channel in range(1, samples.shape[1]):
+        mono += samples[:, channel]
+    mono *= numpy.float32(1.0 / samples.shape[1])
+    return mono
+
+
+def _ramp(length):
+    # linear gain ramp like the one of AudioSegment.fade()
+    return numpy.arange(length, dtype=numpy.float32) / max(length, 1)
+
+
+def render_preview(segments, frame_rate, crossfade, fadein, fadeout,
+                   preview_rate):
+    """
+    Renders the preview from int16 sample arrays (frames, channels).
+
+    Downmixes, crossfades and fades the segments like assemble_preview()
+    and resamples the result to preview_rate, using vectorized float32
+    operations instead of a pydub/audioop pass per step.
+
+    Returns the preview as mono int16 array.
+    """
+    def frames(ms):
+        return int(ms * frame_rate / 1000.0)
+
+    first = segments[0]
+    # the header may overestimate the duration
+    segments = [first] + [
+        s for s in segments[1:] if len(s) > frames(crossfade)]
+    xf = frames(crossfade) if len(segments) > 1 else 0
+    output = numpy.zeros(
+        sum(len(s) for s in segments) - xf * (len(segments) - 1),
+        dtype=numpy.float32)
+    fade_up = _ramp(xf)
+    fade_down = 1 - fade_up
+    pos = 0
+    for index, segment in enumerate(segments):
+        mono = downmix(segment)
+        # crossfade by adding the weighted overlaps
+        if index > 0:
+            mono[:xf] *= fade_up
+            pos -= xf
+        if index < len(segments) - 1:
+            mono[len(mono) - xf:] *= fade_down
+        output[pos:pos + len(mono)] += mono
+        pos += len(mono)
+
+    # fade in/out
+    length = min(frames(fadein), len(output))
+    output[:length] *= _ramp(length)
+    length = min(frames(fadeout), len(output))
+    output[len(output) - length:] *= _ramp(length)[::-1]
+
+    return to_int16(resample(output, frame_rate, preview_rate))
+
+
+def render_excerpt(samples, frame_rate, excerpt_rate):
+    """
+    Downmixes and resamples the excerpt samples to mono int16.
+    """
+    return to_int16(resample(downmix(samples), frame_rate, excerpt_rate))
+
+
+def to_segment(samples, frame_rate):
+    """
+    Returns an int16 sample array (frames, channels) as AudioSegment.
+    """
+    return AudioSegment(
+        data=numpy.ascontiguousarray(samples).tobytes(), sample_width=2,
+        frame_rate=frame_rate, channels=samples.shape[1])
+
+
+def to_int16(samples):
+    return numpy.clip(
+        numpy.rint(samples), -32768, 32767).astype(numpy.int16)
+
+
+def resample(samples, frame_rate, target_rate, taps=64):
+    """
+    Resamples mono float samples with linear interpolation.
+
+    Downsampling applies a windowed sinc low pass filter first.
+    """
+    if frame_rate == target_rate or not len(samples):
+        return samples
+    if target_rate < frame_rate:
+        cutoff = 0.45 * target_rate / frame_rate
+        n = numpy.arange(taps) - (taps - 1) / 2.0
+        kernel = (2 * cutoff * numpy.sinc(2 * cutoff * n) *
+                  numpy.hamming(taps)).astype(numpy.float32)
+        samples = numpy.convolve(samples, kernel / kernel.sum(), 'same')
+    length = int((len(samples) - 1) * target_rate / frame_rate) + 1
+    positions = numpy.arange(length) * (float(frame_rate) / target_rate)
+    index = positions.astype(numpy.int64)
+    fraction = (positions - index).astype(numpy.float32)
+    following = numpy.minimum(index + 1, len(samples) - 1)
+    return samples[index] + fraction * (samples[following] - samples[index])
+
+
+def encode_samples(samples, frame_rate, path, format, parameters=None):
+    """
+    Encodes mono int16 samples with ffmpeg, fed via stdin.
+    """
+    codec = AudioSegment.DEFAULT_CODECS.get(format)
+    try:
+        proc = subprocess.Popen(
+            ["ffmpeg", "-v", "error", "-nostdin", "-y",
+             "-f", "s16le", "-ar", str(frame_rate), "-ac", "1", "-i", "-"] +
+            (["-acodec", codec] if codec else []) +
+            (parameters or []) +
+            ["-f", format, path],
+            stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+    except OSError:
+        print("Error: Unable to find ffmpeg executable in exe path.")
+        return False
+    error = proc.communicate(samples.astype('<i2').tobytes())[1]
+    if proc.returncode != 0:
+        print("ERROR: Encoding of '" + path + "' failed: " +
+              error.decode('utf-8', 'replace'))
+        return False
+    return os.path.isfile(path)
+
+
+def render_with_ffmpeg(filepath, segments, crossfade, fadein, fadeout,
+                       excerpt, preview_output, excerpt_output):
+    """
+    Renders preview and excerpt in one ffmpeg process.
+
+    Every preview segment and the excerpt is a separate seeking input of
+    the same file, so only these ranges get decoded. One filter graph
+    downmixes, crossfades, fades and resamples them into both outputs
+    without temporary files.
+
+    segments and excerpt are (start, end) in ms, the outputs are tuples of
+    (path, format, frame_rate, extra ffmpeg output parameters).
+    """
+    command = ["ffmpeg", "-v", "error", "-nostdin", "-y"]
+    for start, end in segments + [excerpt]:
+        command += [
+            "-ss", "%.3f" % (start / 1000.0),
+            "-t", "%.3f" % ((end - start) / 1000.0),
+            "-i", filepath]
+
+    graph = []
+    for index in range(len(segments)):
+        graph.append(
+            "[%d:a]aformat=sample_fmts=fltp:channel_layouts=mono[s%d]" % (
+                index, index))
+    mixed = "s0"
+    for index in range(1, len(segments)):
+        graph.append("[%s][s%d]acrossfade=d=%.3f:c1=tri:c2=tri[x%d]" % (
+            mixed, index, crossfade / 1000.0, index))
+        mixed = "x%d" % index
+    length = (sum(end - start for start, end in segments) -
+              crossfade * (len(segments) - 1))
+    graph.append(
+        "[%s]afade=t=in:d=%.3f,afade=t=out:st=%.3f:d=%.3f,"
+        "aresample=%d[preview]" % (
+            mixed, fadein / 1000.0, max(length - fadeout, 0) / 1000.0,
+            fadeout / 1000.0, preview_output[2]))
+    graph.append(
+        "[%d:a]aformat=channel_layouts=mono,aresample=%d[excerpt]" % (
+            len(segments), excerpt_output[2]))
+
+    command += ["-filter_complex", ";".join(graph)]
+    for label, (path, format, _, parameters) in [
+            ("preview", preview_output), ("excerpt", excerpt_output)]:
+        codec = AudioSegment.DEFAULT_CODECS.get(format)
+        if format == 'wav':
+            codec = 'pcm_s16le'
+        command += ["-map", "[" + label + "]"]
+        command += ["-acodec", codec] if codec else []
+        command += (parameters or []) + ["-f", format, path]
+
+    try:
+        proc = subprocess.Popen(command, stderr=subprocess.PIPE)
+    except OSError:
+        print("Error: Unable to find ffmpeg executable in exe path.")
+        return False
+    error = proc.communicate()[1]
+    if proc.returncode != 0:
+        print("ERROR: Rendering of '" + filepath + "' failed: " +
+              error.decode('utf-8', 'replace')[-1000:])
+        return False
+    return os.path.isfile(preview_output[0]) and os.path.isfile(
+        excerpt_output[0])
+
+
+def write_wav(samples, frame_rate, path):
+    """
+    Writes mono int16 samples into a wav file, no ffmpeg needed.
+    """
+    try:
+        with wave.open(path, 'wb') as output:
+            output.setnchannels(1)
+            output.setsampwidth(2)
+            output.setframerate(frame_rate)
+            output.writeframes(samples.astype('<i2').tobytes())
+    except (IOError, wave.Error) as e:
+        print("ERROR: Writing of '" + path + "' failed: " + str(e))
+        return False
+    return os.path.isfile(path)
+
+
+# --- Native decoders ---
+
+
+class WavFile(object):
+    """
+    Memory mapped PCM wav file.
+
+    read() returns int16 arrays; 16 bit files are sliced without copying,
+    other sample formats are converted for the requested range only.
+    """
+
+    def __init__(self, filepath):
+        self._file = open(filepath, 'rb')
+        self._mmap = None
+        try:
+            self._mmap = mmap.mmap(
+                self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            self._parse()
+        except Exception:
+            self.close()
+            raise
+
+    def _parse(self):
+        data = self._mmap
+        if data[:4] != b'RIFF' or data[8:12] != b'WAVE':
+            raise ValueError("no RIFF/WAVE file")
+        pos = 12
+        fmt = None
+        while pos + 8 <= len(data):
+            chunk, size = struct.unpack_from('<4sI', data, pos)
+            pos += 8
+            if chunk == b'fmt ':
+                fmt = struct.unpack_from('<HHIIHH', data, pos)
+                if fmt[0] == 0xFFFE and size >= 40:  # WAVE_FORMAT_EXTENSIBLE
+                    fmt = (struct.unpack_from('<H', data, pos + 24)[0],) + \
+                        fmt[1:]
+            elif chunk == b'data':
+                if fmt is None:
+                    raise ValueError("data chunk before fmt chunk")
+                self.format, self.channels, self.frame_rate, _, _, bits = fmt
+                if self.format not in (1, 3) or bits not in (8, 16, 24, 32):
+                    raise ValueError("unsupported wav sample format")
+                self.sample_width = bits // 8
+                frame_width = self.sample_width * self.channels
+                # streamed wav files may have a bogus data size
+                size = min(size, len(data) - pos)
+                self.frames = size // frame_width
+                self._offset = pos
+                return
+            pos += size + size % 2
+        raise ValueError("no data chunk")
+
+    def read(self, start, end):
+        """
+        Returns the frames from start to end ms as int16 (frames, channels).
+        """
+        first = min(int(start * self.frame_rate / 1000.0), self.frames)
+        last = min(int(end * self.frame_rate / 1000.0), self.frames)
+        count = (last - first) * self.channels
+        offset = self._offset + first * self.channels * self.sample_width
+        if self.format == 3:
+            samples = numpy.frombuffer(
+                self._mmap, '<f%d' % self.sample_width, count, offset)
+            samples = to_int16(samples * 32767)
+        elif self.sample_width == 1:
+            samples = numpy.frombuffer(self._mmap, numpy.uint8, count, offset)
+            samples = ((samples.astype(numpy.int16) - 128) << 8)
+        elif self.sample_width == 2:
+            samples = numpy.frombuffer(self._mmap, '<i2', count, offset)
+        elif self.sample_width == 3:
+            # the upper two bytes of a 24 bit sample are its int16 value
+            samples = numpy.frombuffer(
+                self._mmap, numpy.uint8, count * 3, offset
+            ).reshape(-1, 3)[:, 1:].copy().view('<i2')
+        else:
+            samples = numpy.frombuffer(self._mmap, '<i4', count, offset)
+            samples = (samples >> 16).astype(numpy.int16)
+        return samples.reshape(-1, self.channels)
+
+    def read_ranges(self, ranges):
+        """
+        Returns read() of each (start, end) range.
+        """
+        return [self.read(start, end) for start, end in ranges]
+
+    def close(self):
+        self._mmap = None  # unmapped when the last view is gone
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class SoundFile(object):
+    """
+    Audio file decoded by libsndfile (FLAC, ...), with the API of WavFile.
+    """
+
+    def __init__(self, filepath):
+        self._file = soundfile.SoundFile(filepath)
+        self.channels = self._file.channels
+        self.frame_rate = self._file.samplerate
+        self.frames = self._file.frames
+
+    def read(self, start, end):
+        first = min(int(start * self.frame_rate / 1000.0), self.frames)
+        last = min(int(end * self.frame_rate / 1000.0), self.frames)
+        self._file.seek(first)
+        return self._file.read(
+            last - first, dtype='int16', always_2d=True)
+
+    def read_ranges(self, ranges):
+        return [self.read(start, end) for start, end in ranges]
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def open_native(filepath):
+    """
+    Opens WAV files (and FLAC files, if soundfile is installed) for
+    decoding without ffmpeg.
+
+    Returns a WavFile/SoundFile or None if the file needs ffmpeg.
+    """
+    with open(filepath, 'rb') as header_file:
+        header = header_file.read(12)
+    try:
+        if header[:4] == b'RIFF' and header[8:12] == b'WAVE':
+            return WavFile(filepath)
+        if header[:4] == b'fLaC' and soundfile is not None:
+            return SoundFile(filepath)
+    except (ValueError, RuntimeError, IOError):
+        # soundfile raises RuntimeError for files it can't handle
+        pass
+    return None
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# For copyright and license terms, see COPYRIGHT.rst (top level of repository)
+# Repository: https://github.com/C3S/collecting_society_worker
+
+"""
+The one and only C3S checkpoint journal and pacing of backfill runs
+"""
+
+
+import time
+import multiprocessing
+
+try:
+    import sqliteTools
+except Exception:
+    from . import sqliteTools
+
+
+class BackfillJournal(sqliteTools.SQLiteDatabase):
+    """
+    Persistent journal of the contents selected for a backfill run.
+
+    Each content (uuid, path hint) starts as 'pending' and is marked with
+    its outcome ('done', 'failed', 'missing') as soon as it has been
+    processed, so an interrupted run resumes with the pending ones. The
+    run parameters are kept as meta data. Worker processes share the
+    sqlite file.
+    """
+
+    schema = (
+        'CREATE TABLE IF NOT EXISTS meta ('
+        'key TEXT PRIMARY KEY, value TEXT NOT NULL)',
+        'CREATE TABLE IF NOT EXISTS contents ('
+        'uuid TEXT PRIMARY KEY, path TEXT NOT NULL, '
+        'state TEXT NOT NULL, updated REAL NOT NULL, '
+        'note TEXT NOT NULL)',
+    )
+
+    def __init__(self, path):
+        super(BackfillJournal, self).__init__(path)
+        self.path = path
+
+    def get_meta(self, key):
+        """
+        Returns a meta data value of the run or None.
+        """
+        row = self._db().execute(
+            'SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key, value):
+        """
+        Sets a meta data value of the run.
+        """
+        db = self._db()
+        with db:
+            db.execute(
+                'INSERT OR REPLACE INTO meta VALUES (?, ?)', (key, value))
+
+    def add(self, entries):
+        """
+        Adds (uuid, path) entries as pending, keeping known ones as they
+        are. Returns the number of new entries.
+        """
+        db = self._db()
+        with db:
+            before = db.total_changes
+            db.executemany(
+                'INSERT OR IGNORE INTO contents '
+                'VALUES (?, ?, \'pending\', ?, \'\')',
+                [(uuid, path, time.time()) for uuid, path in entries])
+            return db.total_changes - before
+
+    def pending(self, retry_failed=False):
+        """
+        Returns the (uuid, path) of the entries still to be processed.
+        """
+        states = ('pending', 'failed') if retry_failed else ('pending',)
+        return self._db().execute(
+            'SELECT uuid, path FROM contents WHERE state IN (%s) '
+            'ORDER BY rowid' % ', '.join('?' * len(states)),
+            states).fetchall()
+
+    def mark(self, uuid, state, note=''):
+        """
+        Records the outcome of processing an entry.
+        """
+        db = self._db()
+        with db:
+            db.execute(
+                'UPDATE contents SET state = ?, updated = ?, note = ? '
+                'WHERE uuid = ?', (state, time.time(), note, uuid))
+
+    def counts(self):
+        """
+        Returns the number of entries in each state.
+        """
+        return dict(self._db().execute(
+            'SELECT state, COUNT(*) FROM contents GROUP BY state'))
+
+
+class RateLimiter(object):
+    """
+    Spaces out the calls of wait() to at most rate per second, shared by
+    the processes forked after its creation (rate 0: no limit).
+    """
+
+    def __init__(self, rate=0):
+        self.interval = 1.0 / rate if rate else 0
+        self._next_slot = multiprocessing.Value('d', 0)
+
+    def wait(self):
+        """
+        Blocks until the next slot.
+        """
+        if not self.interval:
+            return
+        with self._next_slot.get_lock():
+            slot = max(time.time(), self._next_slot.value)
+            self._next_slot.value = slot + self.interval
+        time.sleep(max(0, slot - time.time()))
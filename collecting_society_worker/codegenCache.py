@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# For copyright and license terms, see COPYRIGHT.rst (top level of repository)
+# Repository: https://github.com/C3S/collecting_society_worker
+
+"""
+The one and only C3S cache of echoprint-codegen results
+"""
+
+
+import time
+import zlib
+import sqlite3
+
+try:
+    import sqliteTools
+except Exception:
+    from . import sqliteTools
+
+
+class CodegenCache(sqliteTools.SQLiteDatabase):
+    """
+    Persistent sqlite cache of echoprint-codegen output.
+
+    Maps (sha256 of the input audio, codegen version, offset, duration)
+    to the zlib compressed JSON codegen printed. The least recently used
+    entries are evicted as soon as the compressed data exceeds max_size
+    bytes (0 = unbounded).
+    """
+
+    schema = (
+        'CREATE TABLE IF NOT EXISTS codegen ('
+        'sha256 TEXT NOT NULL, version TEXT NOT NULL, '
+        'offset INTEGER NOT NULL, duration INTEGER NOT NULL, '
+        'data BLOB NOT NULL, size INTEGER NOT NULL, '
+        'used REAL NOT NULL, '
+        'PRIMARY KEY (sha256, version, offset, duration))',
+        'CREATE INDEX IF NOT EXISTS codegen_used ON codegen (used)',
+    )
+
+    def __init__(self, path, max_size=0):
+        super(CodegenCache, self).__init__(path)
+        self.path = path
+        self.max_size = max_size
+
+    def get(self, sha256, version, offset=0, duration=0):
+        """
+        Returns the cached codegen output or None.
+        """
+        key = (sha256, version, offset, duration)
+        db = self._db()
+        row = db.execute(
+            'SELECT data FROM codegen WHERE sha256 = ? AND version = ? '
+            'AND offset = ? AND duration = ?', key).fetchone()
+        if row is None:
+            return None
+        with db:
+            db.execute(
+                'UPDATE codegen SET used = ? WHERE sha256 = ? AND '
+                'version = ? AND offset = ? AND duration = ?',
+                (time.time(),) + key)
+        return zlib.decompress(row[0]).decode('utf-8')
+
+    def put(self, sha256, version, offset, duration, output):
+        """
+        Stores codegen output and evicts the least recently used entries.
+        """
+        data = zlib.compress(output.encode('utf-8'), 9)
+        db = self._db()
+        with db:
+            db.execute(
+                'INSERT OR REPLACE INTO codegen '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (sha256, version, offset, duration, sqlite3.Binary(data),
+                 len(data), time.time()))
+            if self.max_size:
+                self._evict(db)
+
+    def _evict(self, db):
+        size = db.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM codegen'
+        ).fetchone()[0]
+        if size <= self.max_size:
+            return
+        rows = db.execute(
+            'SELECT rowid, size FROM codegen ORDER BY used')
+        doomed = []
+        for rowid, length in rows:
+            if size <= self.max_size:
+                break
+            doomed.append((rowid,))
+            size -= length
+        db.executemany('DELETE FROM codegen WHERE rowid = ?', doomed)
+
+    def discard(self, sha256):
+        """
+        Removes all entries of an input.
+        """
+        db = self._db()
+        with db:
+            db.execute('DELETE FROM codegen WHERE sha256 = ?', (sha256,))
@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+# For copyright and license terms, see COPYRIGHT.rst (top level of repository)
+# Repository: https://github.com/C3S/collecting_society_worker
+
+"""
+The one and only C3S in-process binding of the echoprint-codegen library
+"""
+
+
+import os
+import sys
+import json
+import time
+import ctypes
+import traceback
+import subprocess
+
+import numpy
+
+try:
+    import audioTools
+except Exception:
+    from . import audioTools
+
+
+# the sample format echoprint-codegen decodes its input to
+CODEGEN_RATE = 11025
+
+
+class CodegenLibrary(object):
+    """
+    ctypes binding of the C interface to libcodegen (contrib/codegen_c.cpp).
+
+    Fingerprints audio without the fork/exec of echoprint-codegen per
+    file (and, for mono 11025 Hz 16 bit wav files, its own ffmpeg
+    decode). The worker runs it in a long-lived process of its own
+    (serve()), so crashes and hangs are contained. The output is the one
+    echoprint-codegen prints for the same file, apart from the measured
+    codegen_time and decode_time.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lib = ctypes.CDLL(path)
+        self._lib.codegen_new.argtypes = [
+            ctypes.POINTER(ctypes.c_float), ctypes.c_uint, ctypes.c_int]
+        self._lib.codegen_new.restype = ctypes.c_void_p
+        self._lib.codegen_code_string.argtypes = [ctypes.c_void_p]
+        self._lib.codegen_code_string.restype = ctypes.c_char_p
+        self._lib.codegen_num_codes.argtypes = [ctypes.c_void_p]
+        self._lib.codegen_num_codes.restype = ctypes.c_int
+        self._lib.codegen_version.argtypes = []
+        self._lib.codegen_version.restype = ctypes.c_double
+        self._lib.codegen_free.argtypes = [ctypes.c_void_p]
+        self._lib.codegen_free.restype = None
+        self._lib.codegen_json.argtypes = [
+            ctypes.POINTER(ctypes.c_float), ctypes.c_uint, ctypes.c_int,
+            ctypes.c_int, ctypes.c_char_p, ctypes.c_double]
+        self._lib.codegen_json.restype = ctypes.c_void_p
+        self._lib.codegen_json_free.argtypes = [ctypes.c_void_p]
+        self._lib.codegen_json_free.restype = None
+        self.version = self._lib.codegen_version()
+
+    @staticmethod
+    def _pcm(samples):
+        # echoprint-codegen scales its 16 bit input the same way
+        pcm = numpy.ascontiguousarray(
+            samples, dtype=numpy.float32) / numpy.float32(32768.0)
+        return pcm, pcm.ctypes.data_as(ctypes.POINTER(ctypes.c_float))
+
+    def codegen(self, samples, start_offset=0):
+        """
+        Fingerprints mono 11025 Hz int16 samples.
+
+        Returns the tuple (code string, number of codes) or None.
+        """
+        pcm, pointer = self._pcm(samples)
+        result = self._lib.codegen_new(pointer, len(pcm), start_offset)
+        if not result:
+            return None
+        try:
+            return (
+                self._lib.codegen_code_string(result).decode('ascii'),
+                self._lib.codegen_num_codes(result))
+        finally:
+            self._lib.codegen_free(result)
+
+    def codegen_file(self, filepath, offset=0, duration=0):
+        """
+        Fingerprints duration seconds from offset of a file (0, 0: the
+        whole file) like `echoprint-codegen filepath offset duration`.
+
+        Returns the output of echoprint-codegen, or None if the file
+        couldn't be decoded or codegen failed.
+        """
+        start = time.time()
+        samples = decode(filepath, offset, duration)
+        if samples is None or not len(samples):
+            return None
+        decode_time = time.time() - start
+        pcm, pointer = self._pcm(samples)
+        output = self._lib.codegen_json(
+            pointer, len(pcm), offset, duration, os.fsencode(filepath),
+            decode_time)
+        if not output:
+            return None
+        try:
+            return ctypes.string_at(output).decode('utf-8')
+        finally:
+            self._lib.codegen_json_free(output)
+
+
+def decode(filepath, offset=0, duration=0):
+    """
+    Returns the mono 11025 Hz int16 samples echoprint-codegen fingerprints
+    for duration seconds from offset of a file (0, 0: the whole file), or
+    None if the file can't be decoded.
+
+    Mono 11025 Hz 16 bit wav files are read directly, everything else is
+    decoded with the ffmpeg command line of echoprint-codegen.
+    """
+    native = audioTools.open_native(filepath)
+    if native is not None:
+        with native:
+            if (isinstance(native, audioTools.WavFile) and
+                    native.format == 1 and native.sample_width == 2 and
+                    native.channels == 1 and
+                    native.frame_rate == CODEGEN_RATE):
+                if offset or duration:
+                    end = 1000 * (offset + duration)
+                else:
+                    end = 1000.0 * native.frames / CODEGEN_RATE
+                return native.read(1000 * offset, end)[:, 0].copy()
+    # FfmpegStreamInput::GetCommandLine of echoprint-codegen
+    command = [
+        "ffmpeg", "-i", filepath, "-ac", "1", "-ar", str(CODEGEN_RATE),
+        "-f", "s16le"]
+    if offset or duration:
+        command += ["-t", str(duration), "-ss", str(offset)]
+    try:
+        proc = subprocess.Popen(
+            command + ["-"], stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    except OSError:
+        return None
+    data = proc.communicate()[0]
+    if proc.returncode != 0:
+        return None
+    return numpy.frombuffer(data[:len(data) - len(data) % 2], '<i2')
+
+
+def server_command(library_path):
+    """
+    Returns the command line of a worker process answering requests
+    [filepath, offset, duration] with CodegenLibrary.codegen_file() of
+    the library at library_path (see CodegenRunner.call()).
+    """
+    return [sys.executable, os.path.abspath(__file__), library_path]
+
+
+def serve(library_path):
+    """
+    Answers the JSON requests on stdin line by line on stdout.
+    """
+    # only the responses go to stdout, prints of the library to stderr
+    responses = os.fdopen(os.dup(sys.stdout.fileno()), 'w')
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    library = CodegenLibrary(library_path)
+    responses.write(json.dumps({'version': library.version}) + '\n')
+    responses.flush()
+    for line in sys.stdin:
+        try:
+            filepath, offset, duration = json.loads(line)
+            response = {
+                'output': library.codegen_file(filepath, offset, duration)}
+        except Exception as e:
+            traceback.print_exc()
+            response = {'error': str(e)}
+        responses.write(json.dumps(response) + '\n')
+        responses.flush()
+
+
+if __name__ == '__main__':
+    serve(sys.argv[1])
@@ -0,0 +1,273 @@
+#!/usr/bin/env python
+# For copyright and license terms, see COPYRIGHT.rst (top level of repository)
+# Repository: https://github.com/C3S/collecting_society_worker
+
+"""
+The one and only C3S runner for echoprint-codegen processes
+"""
+
+
+import os
+import json
+import time
+import fcntl
+import signal
+import select
+import resource
+import threading
+import subprocess
+import contextlib
+
+
+class CodegenRunner(object):
+    """
+    Runs echoprint-codegen with limits.
+
+    At most max_procs codegen processes run at a time on a host: each
+    run holds one of max_procs lock files in slots_dir, so the limit
+    covers pool workers, windowed runs and other worker instances alike.
+    A run is killed (with the ffmpeg process codegen spawns) after
+    timeout seconds, and its address space is limited to memory_limit
+    bytes (0 = no limit). The wall-clock time of each run is appended
+    to stats_path, if given.
+    """
+
+    poll_interval = 0.1  # seconds between attempts to get a slot
+
+    def __init__(self, slots_dir, max_procs, timeout=0, memory_limit=0,
+                 stats_path=None):
+        self.slots_dir = slots_dir
+        self.max_procs = max_procs
+        self.timeout = timeout or None
+        self.memory_limit = memory_limit
+        self.stats_path = stats_path
+        self._idle_pid = None
+
+    @contextlib.contextmanager
+    def _slot(self):
+        slotfile = None
+        while slotfile is None:
+            for slot in range(self.max_procs):
+                slotfile = open(os.path.join(
+                    self.slots_dir, 'codegen-slot-%d.lock' % slot), 'w+')
+                try:
+                    fcntl.flock(slotfile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except IOError:
+                    slotfile.close()
+                    slotfile = None
+            else:
+                time.sleep(self.poll_interval)
+        try:
+            yield
+        finally:
+            fcntl.flock(slotfile, fcntl.LOCK_UN)
+            slotfile.close()
+
+    def run(self, arguments):
+        """
+        Runs echoprint-codegen with a list of arguments.
+
+        Returns its output or None, if it was killed after the timeout
+        or by the memory limit. Raises OSError, if it's missing.
+        """
+        with self._slot():
+            start = time.time()
+            # own session, so the ffmpeg child can be killed as well
+            proc = subprocess.Popen(
+                ["echoprint-codegen"] + arguments,
+                stdout=subprocess.PIPE, start_new_session=True)
+            if self.memory_limit:
+                try:
+                    resource.prlimit(
+                        proc.pid, resource.RLIMIT_AS,
+                        (self.memory_limit, self.memory_limit))
+                except (OSError, ValueError):
+                    pass  # already gone
+            try:
+                output = proc.communicate(timeout=self.timeout)[0]
+                status = 'ok' if proc.returncode == 0 else 'failed'
+                if proc.returncode < 0:
+                    output = None
+                    status = 'killed'  # e.g. SIGABRT when out of memory
+            except subprocess.TimeoutExpired:
+                self._kill(proc)
+                output = None
+                status = 'timeout'
+            seconds = time.time() - start
+            self._record(seconds, status, arguments[0])
+        if output is None:
+            print(
+                "ERROR: echoprint-codegen " + status + " on '" +
+                arguments[0] + "' after %.1f seconds." % seconds)
+            return None
+        return str(output, "utf-8")
+
+    def call(self, label, command, request):
+        """
+        Sends a request to a worker process fingerprinting in-process
+        under the same limits as run(), for a str or None result.
+
+        The worker is started with command (e.g. server_command() of
+        codegenLibrary) and kept for the next calls; it writes a line
+        when it is ready and answers each JSON request line with a JSON
+        object line, {"output": ...} or {"error": ...}. Being a process
+        of its own, a crash or hang of the library doesn't take the
+        worker with it: it is killed after timeout seconds, and its
+        address space may grow by memory_limit bytes after startup.
+        Returns the output, or None if the call failed or was killed.
+        Successful calls are recorded with the status 'library'.
+        """
+        with self._slot():
+            start = time.time()
+            status, result = self._call_worker(command, request)
+            seconds = time.time() - start
+            if status == 'ok':
+                if result is not None:
+                    self._record(seconds, 'library', label)
+                return result
+            self._record(seconds, status, label)
+        print(
+            "ERROR: codegen library " + status + " on '" + label +
+            "' after %.1f seconds." % seconds)
+        return None
+
+    def _call_worker(self, command, request):
+        # (status, result) of a request to an idle or a new worker
+        deadline = time.time() + self.timeout if self.timeout else None
+        proc = self._checkout(command)
+        try:
+            if proc is None:
+                proc = self._start(command, deadline)
+            if proc is None:
+                return 'failed', None
+            os.write(proc.stdin.fileno(),
+                     json.dumps(request).encode('utf-8') + b'\n')
+            line = self._readline(proc, deadline)
+        except BrokenPipeError:
+            line = b''
+        if line is None:
+            self._kill(proc)
+            return 'timeout', None
+        if not line:
+            returncode = self._kill(proc)
+            return 'killed' if returncode < 0 else 'failed', None
+        self._checkin(command, proc)
+        response = json.loads(line.decode('utf-8'))
+        if 'error' in response:
+            return 'failed', None
+        return 'ok', response.get('output')
+
+    def _idle(self):
+        # (lock, {command: idle workers}) of this process, forked
+        # processes start workers of their own
+        if self._idle_pid != os.getpid():
+            self._idle_workers = (threading.Lock(), {})
+            self._idle_pid = os.getpid()
+        return self._idle_workers
+
+    def _checkout(self, command):
+        lock, idle = self._idle()
+        with lock:
+            procs = idle.get(tuple(command), [])
+            while procs:
+                proc = procs.pop()
+                if proc.poll() is None:
+                    return proc
+        return None
+
+    def _checkin(self, command, proc):
+        lock, idle = self._idle()
+        with lock:
+            idle.setdefault(tuple(command), []).append(proc)
+
+    def _start(self, command, deadline):
+        # the new worker or None, if it didn't get ready
+        proc = subprocess.Popen(
+            command, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            start_new_session=True)
+        if not self._readline(proc, deadline):
+            self._kill(proc)
+            return None
+        if self.memory_limit:
+            try:
+                with open('/proc/%d/statm' % proc.pid) as statm:
+                    size = int(statm.read().split()[0]) * (
+                        resource.getpagesize())
+                limit = size + self.memory_limit
+                resource.prlimit(
+                    proc.pid, resource.RLIMIT_AS, (limit, limit))
+            except (OSError, ValueError):
+                pass  # already gone
+        return proc
+
+    @staticmethod
+    def _readline(proc, deadline):
+        # the next line of the worker, b'' if it ended, None on timeout
+        fd = proc.stdout.fileno()
+        chunks = []
+        while not chunks or not chunks[-1].endswith(b'\n'):
+            wait = None
+            if deadline is not None:
+                wait = max(0, deadline - time.time())
+            if not select.select([fd], [], [], wait)[0]:
+                return None
+            chunk = os.read(fd, 65536)
+            if not chunk:
+                return b''
+            chunks.append(chunk)
+        return b''.join(chunks)
+
+    @staticmethod
+    def _kill(proc):
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except OSError:
+            proc.kill()
+        proc.communicate()
+        return proc.returncode
+
+    def _record(self, seconds, status, path):
+        if not self.stats_path:
+            return
+        line = '%.3f\t%.3f\t%s\t%s\n' % (time.time(), seconds, status, path)
+        # a single write to a file opened for appending stays in one piece
+        fd = os.open(
+            self.stats_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line.encode('utf-8'))
+        finally:
+            os.close(fd)
+
+
+def read_stats(stats_path, since=0):
+    """
+    Summarizes the codegen runs recorded in stats_path since a timestamp.
+
+    Returns a dict with the number of runs per status and the latency
+    percentiles of all runs in seconds, or None, if there are no runs.
+    """
+    latencies = []
+    statuses = {}
+    with open(stats_path) as stats:
+        for line in stats:
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) < 3 or float(fields[0]) < since:
+                continue
+            latencies.append(float(fields[1]))
+            statuses[fields[2]] = statuses.get(fields[2], 0) + 1
+    if not latencies:
+        return None
+    latencies.sort()
+
+    def percentile(p):
+        return latencies[min(len(latencies) - 1, int(p * len(latencies)))]
+
+    return {
+        'runs': len(latencies),
+        'statuses': statuses,
+        'p50': percentile(0.5),
+        'p90': percentile(0.9),
+        'p99': percentile(0.99),
+        'max': latencies[-1],
+    }
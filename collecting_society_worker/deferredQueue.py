@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+# For copyright and license terms, see COPYRIGHT.rst (top level of repository)
+# Repository: https://github.com/C3S/collecting_society_worker
+
+"""
+The one and only C3S deferral of files during EchoPrint server outages
+"""
+
+
+import time
+
+try:
+    import sqliteTools
+except Exception:
+    from . import sqliteTools
+
+
+class CircuitBreaker(sqliteTools.SQLiteDatabase):
+    """
+    Persistent circuit breaker for the requests to a server.
+
+    After threshold failures in a row, the circuit opens for cooldown
+    seconds, and requests shouldn't be sent. Then a single request may
+    probe the server: a failure opens the circuit again for twice as
+    long (at most max_cooldown seconds), a success closes it. The state
+    is shared by all workers using the same sqlite file.
+    """
+
+    schema = (
+        'CREATE TABLE IF NOT EXISTS breaker ('
+        'name TEXT PRIMARY KEY, failures INTEGER NOT NULL, '
+        'open_until REAL NOT NULL, cooldown REAL NOT NULL, '
+        'probing INTEGER NOT NULL)',
+    )
+
+    def __init__(self, path, name='echoprint', threshold=5, cooldown=30,
+                 max_cooldown=900):
+        super(CircuitBreaker, self).__init__(path)
+        self.path = path
+        self.name = name
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+
+    def _state(self, db):
+        row = db.execute(
+            'SELECT failures, open_until, cooldown, probing FROM breaker '
+            'WHERE name = ?', (self.name,)).fetchone()
+        return row or (0, 0, self.cooldown, 0)
+
+    def _save(self, db, failures, open_until, cooldown, probing):
+        db.execute(
+            'INSERT OR REPLACE INTO breaker VALUES (?, ?, ?, ?, ?)',
+            (self.name, failures, open_until, cooldown, probing))
+
+    def open_until(self):
+        """
+        Returns the time the circuit stays open until, or 0 if requests
+        may be sent.
+        """
+        failures, open_until = self._state(self._db())[:2]
+        if failures < self.threshold or open_until <= time.time():
+            return 0
+        return open_until
+
+    def allow(self):
+        """
+        Checks, if a request may be sent.
+
+        Once the cooldown has passed, only the first caller is allowed to
+        probe the server, all others wait for another cooldown.
+        """
+        db = self._db()
+        with db:
+            db.execute('BEGIN IMMEDIATE')
+            failures, open_until, cooldown, probing = self._state(db)
+            if failures < self.threshold:
+                return True
+            now = time.time()
+            if open_until > now:
+                return False
+            # half open: hold the others back while probing
+            self._save(db, failures, now + cooldown, cooldown, 1)
+        return True
+
+    def success(self):
+        """
+        Closes the circuit.
+        """
+        db = self._db()
+        if self._state(db)[0]:
+            with db:
+                db.execute(
+                    'DELETE FROM breaker WHERE name = ?', (self.name,))
+
+    def failure(self):
+        """
+        Counts a failed request and opens the circuit at the threshold.
+        """
+        db = self._db()
+        with db:
+            db.execute('BEGIN IMMEDIATE')
+            failures, open_until, cooldown, probing = self._state(db)
+            failures += 1
+            if probing:
+                cooldown = min(2 * cooldown, self.max_cooldown)
+                open_until = time.time() + cooldown
+            elif failures == self.threshold:
+                open_until = time.time() + cooldown
+            # else: closed, or already open and failing requests sent
+            # before it opened
+            self._save(db, failures, open_until, cooldown, 0)
+
+
+class DeferredQueue(sqliteTools.SQLiteDatabase):
+    """
+    Persistent queue of files whose processing has been deferred.
+
+    A file deferred for the nth time in a row is due again after
+    delay * 2^(n-1) seconds, at most max_delay seconds. After max_attempts
+    deferrals in a row (0: no limit), it isn't deferred again.
+    """
+
+    schema = (
+        'CREATE TABLE IF NOT EXISTS deferred ('
+        'filename TEXT PRIMARY KEY, attempts INTEGER NOT NULL, '
+        'due REAL NOT NULL, reason TEXT NOT NULL)',
+    )
+
+    def __init__(self, path, delay=60, max_delay=3600, max_attempts=0):
+        super(DeferredQueue, self).__init__(path)
+        self.path = path
+        self.delay = delay
+        self.max_delay = max_delay
+        self.max_attempts = max_attempts
+
+    def defer(self, filename, reason):
+        """
+        Defers a file and returns the time it is due again, or None, if
+        it has been deferred max_attempts times (and is removed).
+        """
+        db = self._db()
+        with db:
+            db.execute('BEGIN IMMEDIATE')
+            row = db.execute(
+                'SELECT attempts FROM deferred WHERE filename = ?',
+                (filename,)).fetchone()
+            attempts = (row[0] if row else 0) + 1
+            if self.max_attempts and attempts > self.max_attempts:
+                db.execute(
+                    'DELETE FROM deferred WHERE filename = ?', (filename,))
+                return None
+            due = time.time() + min(
+                self.delay * 2 ** (attempts - 1), self.max_delay)
+            db.execute(
+                'INSERT OR REPLACE INTO deferred VALUES (?, ?, ?, ?)',
+                (filename, attempts, due, reason))
+        return due
+
+    def is_due(self, filename):
+        """
+        Checks, if a file may be processed (also if it isn't deferred).
+        """
+        row = self._db().execute(
+            'SELECT due FROM deferred WHERE filename = ?',
+            (filename,)).fetchone()
+        return row is None or row[0] <= time.time()
+
+    def remove(self, filename):
+        """
+        Removes a file after it has been processed.
+        """
+        db = self._db()
+        with db:
+            db.execute(
+                'DELETE FROM deferred WHERE filename = ?', (filename,))
+
+    def retain(self, filenames):
+        """
+        Removes the files not in filenames, e.g. the ones which left
+        their folder, and returns their names.
+        """
+        keep = set(filenames)
+        db = self._db()
+        with db:
+            db.execute('BEGIN IMMEDIATE')
+            stale = [
+                filename for filename, in db.execute(
+                    'SELECT filename FROM deferred')
+                if filename not in keep]
+            db.executemany(
+                'DELETE FROM deferred WHERE filename = ?',
+                [(filename,) for filename in stale])
+        return stale
+
+    def entries(self):
+        """
+        Returns (filename, attempts, due, reason) of all deferred files.
+        """
+        return self._db().execute(
+            'SELECT filename, attempts, due, reason FROM deferred '
+            'ORDER BY due').fetchall()
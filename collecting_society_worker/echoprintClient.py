@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+# For copyright and license terms, see COPYRIGHT.rst (top level of repository)
+# Repository: https://github.com/C3S/collecting_society_worker
+
+"""
+The one and only C3S client for the EchoPrint server
+"""
+
+
+import os
+import gzip
+import json
+import asyncio
+import functools
+import concurrent.futures
+from urllib.parse import urlencode
+
+import requests
+
+
+class EchoprintClient(object):
+    """
+    Client for the EchoPrint server API (/query, /ingest, /delete).
+
+    Keeps up to pool_size connections to the server alive between
+    requests instead of connecting (and handshaking TLS) for every call.
+    Queries are POSTed as form data instead of putting the whole code
+    string into the URL; with compress, the form data is sent gzip
+    compressed (Content-Encoding: gzip), which the server or a proxy in
+    front of it has to decode.
+
+    With a breaker (deferredQueue.CircuitBreaker), connection errors and
+    server errors (5xx) are counted, and no requests are sent while the
+    circuit is open.
+    """
+
+    def __init__(self, url, pool_size=10, compress=False, verify=False,
+                 timeout=None, breaker=None):
+        self.url = url
+        self.pool_size = pool_size
+        self.compress = compress
+        self.verify = verify
+        self.timeout = timeout
+        self.breaker = breaker
+        self._session = None
+        self._pid = None
+
+    def session(self):
+        """
+        Returns the requests session of this process.
+        """
+        # connections must not be shared with forked workers
+        if self._pid != os.getpid():
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=1, pool_maxsize=self.pool_size)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            session.verify = self.verify
+            self._session = session
+            self._pid = os.getpid()
+        return self._session
+
+    def post(self, path, data, compress=False):
+        """
+        POSTs form data to an API path and returns the response.
+
+        Raises requests.RequestException, if the server can't be reached
+        or the circuit of the breaker is open.
+        """
+        if self.breaker is not None and not self.breaker.allow():
+            raise requests.ConnectionError(
+                "EchoPrint server unavailable (circuit open)")
+        headers = {}
+        body = data
+        if compress:
+            body = gzip.compress(urlencode(data).encode('ascii'))
+            headers = {
+                'Content-Type': 'application/x-www-form-urlencoded',
+                'Content-Encoding': 'gzip',
+            }
+        try:
+            response = self.session().post(
+                self.url + path, data=body, headers=headers,
+                timeout=self.timeout)
+        except requests.RequestException:
+            if self.breaker is not None:
+                self.breaker.failure()
+            raise
+        if self.breaker is not None:
+            if response.status_code >= 500:
+                self.breaker.failure()
+            else:
+                self.breaker.success()
+        return response
+
+    def query(self, code):
+        """
+        Queries the server for the best match of a code string.
+        """
+        return self.post('/query', {'fp_code': code}, self.compress)
+
+    def ingest(self, data):
+        """
+        Ingests a fingerprint (a dict of the ingest parameters).
+        """
+        return self.post('/ingest', data)
+
+    def ingest_batch(self, items):
+        """
+        Ingests several fingerprints (dicts of the ingest parameters) with
+        one request, so the server commits its index only once.
+
+        The server needs to accept the form fields token and data, a JSON
+        list of the ingest parameters of each fingerprint, which isn't part
+        of the EchoPrint server API (see ingest_batch_api in config.ini).
+        """
+        token = items[0].get('token', '')
+        data = [
+            dict((key, value) for key, value in item.items()
+                 if key != 'token')
+            for item in items]
+        return self.post('/ingest', {'token': token, 'data': json.dumps(data)})
+
+    def delete(self, track_id):
+        """
+        Deletes the fingerprint of a track from the server.
+        """
+        return self.post('/delete', {'track_id': track_id})
+
+
+class AsyncEchoprintClient(object):
+    """
+    asyncio front end of an EchoprintClient.
+
+    Runs the requests of the pooled client in up to max_requests threads
+    (default: its pool size), so an event loop can overlap the round
+    trips of many files.
+
+    With batch_size > 1, ingests are collected and sent with
+    EchoprintClient.ingest_batch as soon as batch_size fingerprints are
+    waiting or the first of them waited batch_wait seconds. Each ingest
+    returns the response to its whole batch; if the server rejects a
+    batch (4xx), e.g. for one invalid fingerprint, its fingerprints are
+    ingested one by one and each ingest returns its own response.
+    """
+
+    def __init__(self, client, max_requests=None, batch_size=0,
+                 batch_wait=2.0):
+        self.client = client
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_requests or client.pool_size)
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self._batch = []
+        self._timer = None
+        self._sending = set()
+
+    async def _call(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor, functools.partial(func, *args))
+
+    async def query(self, code):
+        return await self._call(self.client.query, code)
+
+    async def ingest(self, data):
+        if self.batch_size <= 1:
+            return await self._call(self.client.ingest, data)
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._batch.append((data, future))
+        if len(self._batch) >= self.batch_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.batch_wait, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._batch = self._batch, []
+        if batch:
+            task = asyncio.ensure_future(self._send(batch))
+            self._sending.add(task)
+            task.add_done_callback(self._sending.discard)
+
+    async def _send(self, batch):
+        try:
+            response = await self._call(
+                self.client.ingest_batch, [data for data, _ in batch])
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        if 400 <= response.status_code < 500 and len(batch) > 1:
+            responses = await asyncio.gather(*[
+                self._call(self.client.ingest, data) for data, _ in batch],
+                return_exceptions=True)
+        else:
+            responses = [response] * len(batch)
+        for (_, future), response in zip(batch, responses):
+            if future.done():
+                continue
+            if isinstance(response, Exception):
+                future.set_exception(response)
+            else:
+                future.set_result(response)
+
+    async def delete(self, track_id):
+        return await self._call(self.client.delete, track_id)
+
+    def close(self):
+        self.executor.shutdown()
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# For copyright and license terms, see COPYRIGHT.rst (top level of repository)
+# Repository: https://github.com/C3S/collecting_society_worker
+
+"""
+The one and only C3S tools for EchoPrint code strings
+"""
+
+
+import json
+import zlib
+import base64
+
+import numpy
+
+# value of the ASCII hex digits
+_HEX_VALUES = numpy.zeros(256, dtype=numpy.uint32)
+_HEX_VALUES[numpy.frombuffer(b'0123456789', dtype=numpy.uint8)] = range(10)
+_HEX_VALUES[numpy.frombuffer(b'abcdef', dtype=numpy.uint8)] = range(10, 16)
+_HEX_VALUES[numpy.frombuffer(b'ABCDEF', dtype=numpy.uint8)] = range(10, 16)
+_HEX_PLACES = numpy.array([16 ** 4, 16 ** 3, 16 ** 2, 16, 1], numpy.uint32)
+
+
+def decode_code_string(code_string):
+    """
+    Decodes a code string of echoprint-codegen.
+
+    The string is the url safe base64 of the zlib compressed hex digits
+    of all times followed by all codes, 5 digits each. Returns the lists
+    (times, codes).
+    """
+    if not code_string:
+        return [], []
+    data = zlib.decompress(base64.urlsafe_b64decode(
+        code_string + '=' * (-len(code_string) % 4))).decode('ascii')
+    count = len(data) // 10
+    times = [int(data[i:i + 5], 16) for i in range(0, count * 5, 5)]
+    codes = [
+        int(data[i:i + 5], 16) for i in range(count * 5, count * 10, 5)]
+    return times, codes
+
+
+def decode_code_arrays(code_string):
+    """
+    Decodes a code string of echoprint-codegen like decode_code_string,
+    but vectorized.
+
+    Returns the uint32 arrays (times, codes).
+    """
+    if not code_string:
+        return (numpy.zeros(0, numpy.uint32), numpy.zeros(0, numpy.uint32))
+    data = zlib.decompress(base64.urlsafe_b64decode(
+        code_string + '=' * (-len(code_string) % 4)))
+    count = len(data) // 10
+    digits = _HEX_VALUES[
+        numpy.frombuffer(data, dtype=numpy.uint8, count=count * 10)]
+    values = digits.reshape(2 * count, 5).dot(_HEX_PLACES)
+    return values[:count], values[count:]
+
+
+def encode_code_string(times, codes):
+    """
+    Encodes times and codes to a code string like echoprint-codegen does.
+    """
+    data = ''.join('%05x' % time for time in times) + \
+        ''.join('%05x' % code for code in codes)
+    return base64.urlsafe_b64encode(
+        zlib.compress(data.encode('ascii'))).decode('ascii')
+
+
+def merge_outputs(outputs):
+    """
+    Merges the outputs of echoprint-codegen runs on windows of one file.
+
+    The times in the codes already include the start offset of a window,
+    so the codes of all windows are concatenated. Returns the merged
+    output in the format of a single run or None, if one of the runs
+    failed.
+    """
+    if len(outputs) == 1:
+        return outputs[0]
+    times = []
+    codes = []
+    merged = None
+    for output in outputs:
+        try:
+            fingerprint = json.loads(output)[0]
+            window_times, window_codes = decode_code_string(
+                fingerprint['code'])
+        except (ValueError, KeyError, IndexError, TypeError, zlib.error):
+            return None
+        if merged is None:
+            merged = fingerprint
+        times += window_times
+        codes += window_codes
+    merged['code'] = encode_code_string(times, codes)
+    merged['code_count'] = len(codes)
+    return json.dumps([merged])
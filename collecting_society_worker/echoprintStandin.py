@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+# For copyright and license terms, see COPYRIGHT.rst (top level of repository)
+# Repository: https://github.com/C3S/collecting_society_worker
+
+"""
+The one and only C3S stand-in for the EchoPrint server
+
+Serves /ingest, /query and /delete like the EchoPrint server API, with
+the response fields repro.py reads, from memory. Latency, failing
+requests and a throughput limit can be injected to test and benchmark
+the worker on a single machine:
+
+    python collecting_society_worker/echoprintStandin.py --port 8080 \\
+        --latency 0.05 --error-rate 0.01 --max-rps 50
+"""
+
+
+import gzip
+import json
+import time
+import random
+import argparse
+import threading
+from urllib.parse import urlparse, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+try:
+    import echoprintCodes
+except Exception:
+    from . import echoprintCodes
+
+
+class StandinHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive, like the real server
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        self._handle(url.path, parse_qs(url.query))
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.headers.get('Content-Encoding') == 'gzip':
+            body = gzip.decompress(body)
+        self._handle(
+            urlparse(self.path).path, parse_qs(body.decode('utf-8')))
+
+    def _handle(self, path, form):
+        params = dict((key, values[0]) for key, values in form.items())
+        status, response = self.server.standin.handle(path, params)
+        body = json.dumps(response).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class StandinServer(object):
+    """
+    In-memory EchoPrint server on a local port (0 = any free port).
+
+    Each request waits latency seconds (plus up to jitter seconds), at
+    most max_rps requests per second are answered (0 = no limit), and
+    error_rate of the requests fail with 503. Requests with a wrong
+    token fail with 403, if a token is set. A query matches the track
+    with the most codes at a consistent time offset, if there are at
+    least min_score of them.
+    """
+
+    def __init__(self, port=0, latency=0, jitter=0, error_rate=0,
+                 max_rps=0, token='', min_score=10):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.max_rps = max_rps
+        self.token = token
+        self.min_score = min_score
+        self.requests = {}  # path: count
+        self.tracks = {}  # track_id: metadata
+        self._codes = {}  # track_id: {code: [times]}
+        self._lock = threading.Lock()
+        self._next_slot = 0
+        self._httpd = ThreadingHTTPServer(('127.0.0.1', port), StandinHandler)
+        self._httpd.daemon_threads = True
+        self._httpd.standin = self
+        self._thread = None
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d' % self._httpd.server_port
+
+    def start(self):
+        self._thread = threading.Thread(target=self._httpd.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def serve_forever(self):
+        self._httpd.serve_forever()
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+        self._thread.join()
+
+    def _throttle(self):
+        if self.max_rps:
+            with self._lock:
+                slot = max(time.time(), self._next_slot)
+                self._next_slot = slot + 1.0 / self.max_rps
+            time.sleep(max(0, slot - time.time()))
+        if self.latency or self.jitter:
+            time.sleep(self.latency + random.uniform(0, self.jitter))
+
+    def handle(self, path, params):
+        """
+        Answers a request with (HTTP status, JSON response).
+        """
+        with self._lock:
+            self.requests[path] = self.requests.get(path, 0) + 1
+        self._throttle()
+        if self.error_rate and random.random() < self.error_rate:
+            return 503, {'ok': False, 'message': "injected failure"}
+        if path == '/query':
+            return self.query(params.get('fp_code', ''))
+        if self.token and params.get('token') != self.token:
+            return 403, {'ok': False, 'message': "invalid token"}
+        if path == '/ingest':
+            if 'data' in params:  # batch, see EchoprintClient.ingest_batch
+                try:
+                    items = json.loads(params['data'])
+                except ValueError:
+                    items = None
+                if not isinstance(items, list):
+                    return 400, {'ok': False, 'message': "invalid data"}
+            else:
+                items = [params]
+            for item in items:
+                if not self.ingest(item):
+                    return 400, {
+                        'ok': False,
+                        'message': "missing track_id or invalid code"}
+            return 200, {
+                'ok': True, 'status': 'ok',
+                'track_id': items[-1].get('track_id'),
+                'track_ids': [item.get('track_id') for item in items]}
+        if path == '/delete':
+            with self._lock:
+                found = self.tracks.pop(params.get('track_id'), None)
+                self._codes.pop(params.get('track_id'), None)
+            return 200, {'ok': found is not None}
+        return 404, {'ok': False, 'message': "unknown path"}
+
+    def ingest(self, item):
+        if not isinstance(item, dict) or not item.get('track_id'):
+            return False
+        try:
+            times, codes = echoprintCodes.decode_code_string(
+                item.get('fp_code', ''))
+        except Exception:
+            return False
+        index = {}
+        for code_time, code in zip(times, codes):
+            index.setdefault(code, []).append(code_time)
+        metadata = dict(
+            (key, item.get(key)) for key in
+            ('artist', 'release', 'track', 'length', 'codever'))
+        with self._lock:
+            self.tracks[item.get('track_id')] = metadata
+            self._codes[item.get('track_id')] = index
+        return True
+
+    def query(self, code_string):
+        try:
+            times, codes = echoprintCodes.decode_code_string(code_string)
+        except Exception:
+            return 200, {
+                'ok': False, 'match': False, 'score': 0,
+                'message': "couldn't decode code string"}
+        best_score = 0
+        best_track = None
+        with self._lock:
+            tracks = list(self._codes.items())
+        for track_id, index in tracks:
+            # codes of the same recording appear at a constant offset
+            histogram = {}
+            for code_time, code in zip(times, codes):
+                for track_time in index.get(code, ()):
+                    offset = track_time - code_time
+                    histogram[offset] = histogram.get(offset, 0) + 1
+            score = max(histogram.values()) if histogram else 0
+            if score > best_score:
+                best_score, best_track = score, track_id
+        if best_track is None or best_score < self.min_score:
+            return 200, {
+                'ok': True, 'match': False, 'score': best_score,
+                'message': "query didn't match"}
+        result = {
+            'ok': True, 'match': True, 'score': best_score,
+            'track_id': best_track, 'message': "query matched"}
+        metadata = self.tracks.get(best_track, {})
+        result.update(
+            (key, value) for key, value in metadata.items()
+            if value is not None)
+        return 200, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--latency', type=float, default=0)
+    parser.add_argument('--jitter', type=float, default=0)
+    parser.add_argument('--error-rate', type=float, default=0)
+    parser.add_argument('--max-rps', type=float, default=0)
+    parser.add_argument('--token', default='')
+    args = parser.parse_args()
+    server = StandinServer(
+        args.port, args.latency, args.jitter, args.error_rate,
+        args.max_rps, args.token)
+    print("EchoPrint stand-in listening on " + server.url)
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -69,3 +69,60 @@ def checksum_correct(host_ssh, directory, filename):
 def is_checksum_file(filename):
     if filename.endswith(".checksum") or filename.endswith(".checksums"):
         return True
+
+
+class FileHasher(object):
+    """
+    Hashes a file while it is read for other purposes.
+
+    Computes the SHA-256 of the whole file and, if block_size is set,
+    of each block of block_size bytes. Feed it with update() like a
+    hashlib object.
+    """
+
+    def __init__(self, block_size=0):
+        self.sha256 = hashlib.sha256()
+        self.block_size = block_size
+        self.blocks = []  # (begin, end, hexdigest)
+        self.length = 0
+        self._block = hashlib.sha256() if block_size else None
+        self._block_begin = 0
+
+    def update(self, data):
+        if self._block is not None:
+            pos = 0
+            while pos < len(data):
+                rest = self._block_begin + self.block_size - (
+                    self.length + pos)
+                self._block.update(data[pos:pos + rest])
+                pos += rest
+                if pos <= len(data):
+                    self._finish_block(self.length + pos)
+        self.sha256.update(data)
+        self.length += len(data)
+
+    def _finish_block(self, end):
+        self.blocks.append(
+            (self._block_begin, end, self._block.hexdigest()))
+        self._block = hashlib.sha256()
+        self._block_begin = end
+
+    def hexdigest(self):
+        """
+        Returns the hexdigest of the whole file and finishes the last block.
+        """
+        if self._block is not None and self.length > self._block_begin:
+            self._finish_block(self.length)
+        return self.sha256.hexdigest()
+
+    def hash_file(self, filepath, bufsize=65536):
+        """
+        Reads and hashes a whole file.
+        """
+        with open(filepath, 'rb') as filetohash:
+            while True:
+                data = filetohash.read(bufsize)
+                if not data:
+                    break
+                self.update(data)
+        return self
@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+# For copyright and license terms, see COPYRIGHT.rst (top level of repository)
+# Repository: https://github.com/C3S/collecting_society_worker
+
+"""
+The one and only C3S inotify watcher for the repertoire processing folders
+"""
+
+
+import os
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+
+
+# --- inotify constants (see <sys/inotify.h>) ---
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+
+_event_header = struct.Struct('iIII')  # wd, mask, cookie, len
+
+
+class Inotify(object):
+    """
+    Minimal ctypes binding of the linux inotify API.
+    """
+
+    def __init__(self):
+        self._libc = ctypes.CDLL(
+            ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        self.paths = {}  # watch descriptor -> path
+
+    def add_watch(self, path, mask):
+        """
+        Watches path for the events in mask, returns the watch descriptor.
+        """
+        wd = self._libc.inotify_add_watch(
+            self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), path)
+        self.paths[wd] = path
+        return wd
+
+    def read_events(self, timeout=None):
+        """
+        Waits up to timeout seconds for events.
+
+        Returns a list of (path, name, mask) tuples; path is None for a
+        queue overflow.
+        """
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+        try:
+            buf = os.read(self.fd, 65536)
+        except OSError as e:
+            if e.errno == errno.EAGAIN:
+                return []
+            raise
+        events = []
+        pos = 0
+        while pos < len(buf):
+            wd, mask, _, length = _event_header.unpack_from(buf, pos)
+            pos += _event_header.size
+            name = os.fsdecode(buf[pos:pos + length].rstrip(b'\0'))
+            pos += length
+            if mask & IN_Q_OVERFLOW:
+                events.append((None, '', mask))
+                continue
+            if mask & IN_IGNORED:
+                self.paths.pop(wd, None)
+                continue
+            if wd in self.paths:
+                events.append((self.paths[wd], name, mask))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class StageWatcher(object):
+    """
+    Watches the user subfolders of processing stage directories.
+
+    Reports files that were written or moved into a user subfolder and
+    picks up new user subfolders automatically.
+    """
+
+    file_mask = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_ONLYDIR
+
+    def __init__(self, stage_dirs):
+        self.inotify = Inotify()
+        self.stage_dirs = set(stage_dirs)
+        self._pending = []
+        for stage_dir in self.stage_dirs:
+            self._watch(stage_dir)
+            for entry in os.scandir(stage_dir):
+                if entry.is_dir(follow_symlinks=False):
+                    self._watch(entry.path)
+
+    def _watch(self, path):
+        try:
+            self.inotify.add_watch(path, self.file_mask)
+        except OSError as e:
+            print("WARNING: Couldn't watch '" + path + "': " + str(e))
+
+    def _watch_user_dir(self, stage_dir, path):
+        """
+        Watches a new user subfolder and reports the files that have been
+        moved into it before the watch was set.
+        """
+        self._watch(path)
+        try:
+            for entry in os.scandir(path):
+                if entry.is_file(follow_symlinks=False):
+                    self._pending.append((stage_dir, path, entry.name))
+        except OSError:
+            pass
+
+    def events(self, timeout=None):
+        """
+        Waits up to timeout seconds for new files.
+
+        Returns a tuple (overflow, files) with files as a list of
+        (stage_dir, user_dir, filename) tuples. If overflow is True,
+        events were lost and the stage directories need a full rescan.
+        """
+        overflow = False
+        files, self._pending = self._pending, []
+        for path, name, mask in self.inotify.read_events(
+                0 if files else timeout):
+            if path is None:
+                overflow = True
+                continue
+            if path in self.stage_dirs:
+                if mask & IN_ISDIR:
+                    self._watch_user_dir(path, os.path.join(path, name))
+                continue
+            if mask & IN_ISDIR or not mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                continue
+            files.append((os.path.dirname(path), path, name))
+        files.extend(self._pending)
+        self._pending = []
+        return overflow, files
+
+    def close(self):
+        self.inotify.close()
@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+# For copyright and license terms, see COPYRIGHT.rst (top level of repository)
+# Repository: https://github.com/C3S/collecting_society_worker
+
+"""
+The one and only C3S local store of ingested fingerprints
+"""
+
+
+import os
+import json
+import zlib
+import fcntl
+import struct
+
+try:
+    import sqliteTools
+except Exception:
+    from . import sqliteTools
+
+_HEADER = struct.Struct('>I')  # length of the compressed record
+
+
+class FingerprintStore(sqliteTools.SQLiteDatabase):
+    """
+    Append-only store of the fingerprints ingested into EchoPrint.
+
+    Each fingerprint (track id, codegen version, code string, metadata)
+    is appended as a zlib compressed JSON record to fingerprints.dat in
+    the directory path. A sqlite index maps each track id to its latest
+    record; it can be rebuilt from the data file. Workers sharing the
+    directory append under an fcntl lock.
+    """
+
+    schema = (
+        'CREATE TABLE IF NOT EXISTS fingerprints ('
+        'track_id TEXT PRIMARY KEY, offset INTEGER NOT NULL, '
+        'length INTEGER NOT NULL)',
+    )
+
+    def __init__(self, path):
+        super(FingerprintStore, self).__init__(
+            os.path.join(path, 'index.db'))
+        self.path = path
+        self.datapath = os.path.join(path, 'fingerprints.dat')
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def append(self, track_id, codever, code, metadata=None):
+        """
+        Stores a fingerprint, replacing former ones of the track.
+        """
+        offset, length = self._write({
+            'track_id': track_id,
+            'codever': codever,
+            'code': code,
+            'metadata': metadata or {},
+        })
+        db = self._db()
+        with db:
+            db.execute(
+                'INSERT OR REPLACE INTO fingerprints VALUES (?, ?, ?)',
+                (track_id, offset, length))
+
+    def _write(self, entry):
+        record = zlib.compress(json.dumps(entry).encode('utf-8'), 9)
+        with open(self.datapath, 'ab') as datafile:
+            fcntl.flock(datafile, fcntl.LOCK_EX)
+            try:
+                offset = datafile.seek(0, os.SEEK_END)
+                datafile.write(_HEADER.pack(len(record)) + record)
+                datafile.flush()
+                os.fsync(datafile.fileno())
+            finally:
+                fcntl.flock(datafile, fcntl.LOCK_UN)
+        return offset, _HEADER.size + len(record)
+
+    @staticmethod
+    def _decode(data):
+        return json.loads(zlib.decompress(data[_HEADER.size:]).decode('utf-8'))
+
+    def get(self, track_id):
+        """
+        Returns the latest fingerprint of a track as a dict or None.
+        """
+        row = self._db().execute(
+            'SELECT offset, length FROM fingerprints WHERE track_id = ?',
+            (track_id,)).fetchone()
+        if row is None:
+            return None
+        with open(self.datapath, 'rb') as datafile:
+            datafile.seek(row[0])
+            return self._decode(datafile.read(row[1]))
+
+    def remove(self, track_id):
+        """
+        Forgets the fingerprint of a track.
+        """
+        db = self._db()
+        if db.execute(
+                'SELECT 1 FROM fingerprints WHERE track_id = ?',
+                (track_id,)).fetchone() is None:
+            return
+        self._write({'track_id': track_id, 'deleted': True})
+        with db:
+            db.execute(
+                'DELETE FROM fingerprints WHERE track_id = ?', (track_id,))
+
+    def __len__(self):
+        return self.count()
+
+    def count(self, after=-1):
+        """
+        Returns the number of tracks whose latest fingerprint is stored
+        after the data file offset after.
+        """
+        return self._db().execute(
+            'SELECT COUNT(*) FROM fingerprints WHERE offset > ?',
+            (after,)).fetchone()[0]
+
+    def __iter__(self):
+        """
+        Yields the latest fingerprint of each track, reading the data
+        file sequentially.
+        """
+        for _, record in self.records():
+            yield record
+
+    def records(self, after=-1):
+        """
+        Yields (data file offset, fingerprint) of the latest fingerprint
+        of each track stored after the offset after, in the order of the
+        data file. Fingerprints stored later always have a larger offset,
+        so the offset of the last processed one resumes an iteration.
+        """
+        if not os.path.exists(self.datapath):
+            return
+        rows = self._db().execute(
+            'SELECT offset, length FROM fingerprints WHERE offset > ? '
+            'ORDER BY offset', (after,))
+        with open(self.datapath, 'rb') as datafile:
+            for offset, length in rows:
+                datafile.seek(offset)
+                yield offset, self._decode(datafile.read(length))
+
+    def _scan(self):
+        # (offset, length, record) of all complete records
+        with open(self.datapath, 'rb') as datafile:
+            offset = 0
+            while True:
+                header = datafile.read(_HEADER.size)
+                if len(header) < _HEADER.size:
+                    return
+                length = _HEADER.unpack(header)[0]
+                data = datafile.read(length)
+                if len(data) < length:
+                    return  # torn write at the end
+                yield (offset, _HEADER.size + length,
+                       self._decode(header + data))
+                offset += _HEADER.size + length
+
+    def rebuild_index(self):
+        """
+        Rebuilds the index from the data file and returns its size.
+        """
+        latest = {}
+        if os.path.exists(self.datapath):
+            for offset, length, record in self._scan():
+                if record.get('deleted'):
+                    latest.pop(record['track_id'], None)
+                else:
+                    latest[record['track_id']] = (offset, length)
+        db = self._db()
+        with db:
+            db.execute('DELETE FROM fingerprints')
+            db.executemany(
+                'INSERT INTO fingerprints VALUES (?, ?, ?)',
+                [(track_id, offset, length)
+                 for track_id, (offset, length) in latest.items()])
+        return len(latest)
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+# For copyright and license terms, see COPYRIGHT.rst (top level of repository)
+# Repository: https://github.com/C3S/collecting_society_worker
+
+"""
+The one and only C3S scratch cache of decoded audio shared by the stages
+"""
+
+
+import os
+import time
+import tempfile
+
+
+class PCMCache(object):
+    """
+    Size bounded cache of decoded audio files on local scratch space.
+
+    Entries are mono 11025 Hz 16 bit wav files (the input of
+    echoprint-codegen), named '<uuid>.<sha256>.wav', so a replaced upload
+    never hits the entry of its predecessor. The least recently used
+    entries are evicted as soon as the cache grows beyond max_size bytes.
+
+    Entries are written under a temporary name and renamed into place,
+    and readers get a private hard link, so concurrent workers never see
+    half written files and eviction never removes a file in use.
+    """
+
+    suffix = '.wav'
+    stale_after = 86400  # seconds until temporary files count as orphaned
+
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def entry_path(self, uuid, sha256):
+        return os.path.join(self.path, uuid + '.' + sha256 + self.suffix)
+
+    def reserve(self):
+        """
+        Returns a new temporary path in the cache to decode an entry into.
+
+        Hand it to store() or remove it.
+        """
+        fd, path = tempfile.mkstemp(
+            prefix='.', suffix=self.suffix, dir=self.path)
+        os.close(fd)
+        return path
+
+    def store(self, uuid, sha256, path):
+        """
+        Moves the file at path (see reserve()) into the cache.
+        """
+        if not os.path.getsize(path):
+            os.remove(path)
+            return
+        os.rename(path, self.entry_path(uuid, sha256))
+        self.evict()
+
+    def checkout(self, uuid, sha256):
+        """
+        Returns the path of a private link to an entry, or None on a miss.
+
+        Hand it to release() when done.
+        """
+        path = self.entry_path(uuid, sha256)
+        link = os.path.join(
+            self.path, '.%s.%d%s' % (uuid, os.getpid(), self.suffix))
+        try:
+            if os.path.exists(link):
+                os.remove(link)
+            os.link(path, link)
+        except OSError:
+            return None
+        os.utime(path)  # most recently used
+        return link
+
+    def release(self, link):
+        """
+        Removes a link returned by checkout().
+        """
+        if link is not None and os.path.exists(link):
+            os.remove(link)
+
+    def discard(self, uuid):
+        """
+        Removes all entries of a content.
+        """
+        with os.scandir(self.path) as entries:
+            for entry in entries:
+                if entry.name.startswith(uuid + '.'):
+                    self._remove(entry.path)
+
+    def evict(self):
+        """
+        Removes the least recently used entries beyond max_size.
+
+        Also removes temporary files left behind by crashed workers.
+        """
+        entries = []
+        with os.scandir(self.path) as scan:
+            for entry in scan:
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                if entry.name.startswith('.'):
+                    # being written or checked out
+                    if stat.st_mtime < time.time() - self.stale_after:
+                        self._remove(entry.path)
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        size = sum(entry[1] for entry in entries)
+        for _, entry_size, path in sorted(entries):
+            if size <= self.max_size:
+                break
+            self._remove(path)
+            size -= entry_size
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass  # removed concurrently
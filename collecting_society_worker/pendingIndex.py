@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# For copyright and license terms, see COPYRIGHT.rst (top level of repository)
+# Repository: https://github.com/C3S/collecting_society_worker
+
+"""
+The one and only C3S index of files waiting in the processing folders
+"""
+
+
+import os
+import time
+
+try:
+    import sqliteTools
+except Exception:
+    from . import sqliteTools
+
+
+class PendingIndex(sqliteTools.SQLiteDatabase):
+    """
+    Persistent sqlite index of the files waiting in each stage directory.
+
+    A stage directory is 'warm' after it has been reconciled with the
+    file system and stays warm for max_age seconds (0 = forever). Files
+    are added to and removed from warm stages as they are moved, so the
+    stage commands don't have to walk the whole tree to find their work.
+    """
+
+    schema = (
+        'CREATE TABLE IF NOT EXISTS pending ('
+        'path TEXT PRIMARY KEY, stage TEXT NOT NULL)',
+        'CREATE INDEX IF NOT EXISTS pending_stage ON pending (stage)',
+        'CREATE TABLE IF NOT EXISTS stage ('
+        'stage TEXT PRIMARY KEY, reconciled REAL NOT NULL)',
+    )
+
+    def __init__(self, path, max_age=0):
+        super(PendingIndex, self).__init__(path)
+        self.path = path
+        self.max_age = max_age
+
+    @staticmethod
+    def _stage_of(filepath):
+        # <stage>/<user subfolder>/<file>
+        return os.path.dirname(os.path.dirname(filepath))
+
+    def is_warm(self, stage_dir):
+        """
+        Checks, if the index of a stage directory can be trusted.
+        """
+        row = self._db().execute(
+            'SELECT reconciled FROM stage WHERE stage = ?',
+            (os.path.normpath(stage_dir),)).fetchone()
+        if row is None:
+            return False
+        return not self.max_age or time.time() - row[0] < self.max_age
+
+    def reconcile(self, stage_dir, pattern):
+        """
+        Rebuilds the index of a stage directory from the file system.
+
+        Only looks at the files in the user subfolders matching pattern.
+        """
+        stage_dir = os.path.normpath(stage_dir)
+        paths = []
+        if os.path.isdir(stage_dir):
+            with os.scandir(stage_dir) as subdirs:
+                for subdir in subdirs:
+                    if not subdir.is_dir(follow_symlinks=False):
+                        continue
+                    with os.scandir(subdir.path) as entries:
+                        for entry in entries:
+                            if (pattern.match(entry.name) and
+                                    entry.is_file(follow_symlinks=False)):
+                                paths.append((entry.path, stage_dir))
+        db = self._db()
+        with db:
+            db.execute('DELETE FROM pending WHERE stage = ?', (stage_dir,))
+            db.executemany(
+                'INSERT OR IGNORE INTO pending VALUES (?, ?)', paths)
+            db.execute(
+                'INSERT OR REPLACE INTO stage VALUES (?, ?)',
+                (stage_dir, time.time()))
+        return len(paths)
+
+    def pending(self, stage_dir):
+        """
+        Returns the (user subfolder, filename) of the files in a stage.
+        """
+        rows = self._db().execute(
+            'SELECT path FROM pending WHERE stage = ? ORDER BY path',
+            (os.path.normpath(stage_dir),)).fetchall()
+        return [os.path.split(row[0]) for row in rows]
+
+    def add(self, filepath):
+        """
+        Adds a file to the index of its stage directory.
+
+        Files in cold stages are ignored, as the next reconcile finds them.
+        """
+        filepath = os.path.normpath(filepath)
+        stage_dir = self._stage_of(filepath)
+        if not self.is_warm(stage_dir):
+            return
+        db = self._db()
+        with db:
+            db.execute(
+                'INSERT OR IGNORE INTO pending VALUES (?, ?)',
+                (filepath, stage_dir))
+
+    def discard(self, filepath):
+        """
+        Removes a file from the index.
+        """
+        db = self._db()
+        with db:
+            db.execute(
+                'DELETE FROM pending WHERE path = ?',
+                (os.path.normpath(filepath),))
+
+    def invalidate(self, stage_dir):
+        """
+        Marks a stage directory as cold, so it will be reconciled.
+        """
+        db = self._db()
+        with db:
+            db.execute(
+                'DELETE FROM stage WHERE stage = ?',
+                (os.path.normpath(stage_dir),))
@@ -12,23 +12,60 @@ The one and only C3S repertoire processing utility
 import os
 import time
 import fcntl
+import traceback
+import multiprocessing
+import multiprocessing.pool
 import socket
-import subprocess
 import configparser
 import json
+import zlib
 import datetime
 import re
-import hashlib
+import csv
+import sys
+import shutil
+import glob
+import asyncio
+import tempfile
+import functools
+import contextlib
+import concurrent.futures
 import click
-import requests
-from pydub import AudioSegment
 import taglib
 from proteus import config, Model
+from pydub.exceptions import CouldntDecodeError
 try:
     import trytonAccess
+    import fileWatcher
+    import pendingIndex
+    import audioTools
+    import fileTools
+    import pcmCache
+    import codegenCache
+    import echoprintCodes
+    import codegenRunner
+    import codegenLibrary
+    import echoprintClient
+    import deferredQueue
+    import similarityIndex
+    import fingerprintStore
+    import backfillJournal
 except Exception:
     from . import trytonAccess
-# import fileTools
+    from . import fileWatcher
+    from . import pendingIndex
+    from . import audioTools
+    from . import fileTools
+    from . import pcmCache
+    from . import codegenCache
+    from . import echoprintCodes
+    from . import codegenRunner
+    from . import codegenLibrary
+    from . import echoprintClient
+    from . import deferredQueue
+    from . import similarityIndex
+    from . import fingerprintStore
+    from . import backfillJournal
 
 # --- some constants ---
 
@@ -48,6 +85,11 @@ _excerpt_fadein = 0
 _excerpt_fadeout = 0
 _excerpt_segment_duration = 60000
 
+# only uuid4 compilant filenames are processed
+uuid4hex = re.compile(
+    '^[0-9A-F]{8}-[0-9A-F]{4}-[4][0-9A-F]{3}'
+    '-[89AB][0-9A-F]{3}-[0-9A-F]{12}$', re.I)
+
 
 # --- some initialization ---
 
@@ -98,17 +140,142 @@ if not ECHOPRINT_PORT:
     ECHOPRINT_PORT = 80
 ECHOPRINT_URL = (ECHOPRINT_SCHEMA + "://" + ECHOPRINT_HOSTNAME + ":" +
                  ECHOPRINT_PORT)
+# optional deferral of files while the EchoPrint server is unavailable,
+# instead of rejecting them
+DEFERRED_QUEUE = None
+ECHOPRINT_BREAKER = None
+if FILEHANDLING_CONFIG.get('deferred_queue_path'):
+    DEFERRED_QUEUE = deferredQueue.DeferredQueue(
+        FILEHANDLING_CONFIG['deferred_queue_path'],
+        int(FILEHANDLING_CONFIG.get('deferred_delay') or 60),
+        int(FILEHANDLING_CONFIG.get('deferred_max_delay') or 3600),
+        int(FILEHANDLING_CONFIG.get('deferred_max_attempts') or 20))
+    ECHOPRINT_BREAKER = deferredQueue.CircuitBreaker(
+        FILEHANDLING_CONFIG['deferred_queue_path'],
+        threshold=int(ECHOPRINT_CONFIG.get('breaker_threshold') or 5),
+        cooldown=int(ECHOPRINT_CONFIG.get('breaker_cooldown') or 30),
+        max_cooldown=int(ECHOPRINT_CONFIG.get('breaker_max_cooldown') or 900))
+# keep-alive connections to the EchoPrint server shared by all requests
+ECHOPRINT_CLIENT = echoprintClient.EchoprintClient(
+    ECHOPRINT_URL,
+    pool_size=int(ECHOPRINT_CONFIG.get('pool_size') or 10),
+    compress=ECHOPRINT_CONFIG.get('compress_queries') == 'yes',
+    verify=False,  # TODO: remove when cert. is updated
+    timeout=float(ECHOPRINT_CONFIG.get('timeout') or 0) or None,
+    breaker=ECHOPRINT_BREAKER)
+# ingest fingerprints of the concurrent fingerprint stage in batches of
+# up to this many, waiting at most this many seconds for a batch to fill
+INGEST_BATCH_SIZE = int(ECHOPRINT_CONFIG.get('ingest_batch_size') or 0)
+INGEST_BATCH_WAIT = float(ECHOPRINT_CONFIG.get('ingest_batch_wait') or 2)
+# batches need an extension of the ingest API of the EchoPrint server
+INGEST_BATCH_API = ECHOPRINT_CONFIG.get('ingest_batch_api') == 'yes'
+if INGEST_BATCH_SIZE > 1 and not INGEST_BATCH_API:
+    print("ERROR: ingest_batch_size needs ingest_batch_api=yes, ingesting "
+          "one fingerprint per request.")
+    INGEST_BATCH_SIZE = 0
 
 HOSTNAME = socket.gethostname()
+# decode only the parts of an upload that go into preview and excerpt
+PARTIAL_DECODING = (
+    FILEHANDLING_CONFIG.get('partial_decoding', 'no') == 'yes')
 STORAGE_BASE_PATH = FILEHANDLING_CONFIG['storage_base_path']
+# decode WAV (and FLAC, if soundfile is installed) without ffmpeg
+NATIVE_DECODING = (
+    FILEHANDLING_CONFIG.get('native_decoding', 'no') == 'yes')
+# 'ffmpeg' renders preview and excerpt in one ffmpeg process,
+# 'numpy' renders previews vectorized, 'pydub' uses the pydub operations
+PREVIEW_RENDERER = FILEHANDLING_CONFIG.get('preview_renderer') or 'pydub'
+# scratch space for decoded audio, default is the system temp dir
+SCRATCH_PATH = FILEHANDLING_CONFIG.get('scratch_path') or None
+# read each upload only once for preview, checksum and fingerprint
+FUSED_PIPELINE = FILEHANDLING_CONFIG.get('fused_pipeline', 'no') == 'yes'
+# additionally store checksums of blocks of this many bytes, 0 = off
+CHECKSUM_BLOCK_SIZE = int(FILEHANDLING_CONFIG.get('checksum_block_size') or 0)
+# fingerprint up to this many files at a time in one process, overlapping
+# their requests to the EchoPrint server, 0 = one file per job
+FINGERPRINT_CONCURRENCY = int(
+    FILEHANDLING_CONFIG.get('fingerprint_concurrency') or 0)
+
+# optional local index of the ingested codes, answers the test query
+# before ingest instead of the EchoPrint server
+SIMILARITY_INDEX = None
+if FILEHANDLING_CONFIG.get('similarity_index_path'):
+    SIMILARITY_INDEX = similarityIndex.SimilarityIndex(
+        FILEHANDLING_CONFIG['similarity_index_path'])
+SIMILARITY_MIN_SCORE = int(
+    FILEHANDLING_CONFIG.get('similarity_min_score') or 10)
+
+# optional local copy of all ingested fingerprints ('repro reingest')
+FINGERPRINT_STORE = None
+if FILEHANDLING_CONFIG.get('fingerprint_store_path'):
+    FINGERPRINT_STORE = fingerprintStore.FingerprintStore(
+        FILEHANDLING_CONFIG['fingerprint_store_path'])
+
+# journal and pacing of a 'repro backfill' run, shared with its workers
+BACKFILL_JOURNAL = None
+BACKFILL_LIMITER = None
+
+# optional index of pending files, replaces the directory walks
+PENDING_INDEX = None
+if FILEHANDLING_CONFIG.get('pending_index_path'):
+    PENDING_INDEX = pendingIndex.PendingIndex(
+        FILEHANDLING_CONFIG['pending_index_path'],
+        int(FILEHANDLING_CONFIG.get('pending_index_max_age') or 0))
+
+# optional cache of decoded audio, shared by the stages
+PCM_CACHE = None
+if FILEHANDLING_CONFIG.get('pcm_cache_path'):
+    PCM_CACHE = pcmCache.PCMCache(
+        FILEHANDLING_CONFIG['pcm_cache_path'],
+        int(FILEHANDLING_CONFIG.get('pcm_cache_size') or 1024) * 1024 * 1024)
+
+# files longer than this many seconds are fingerprinted in windows of
+# codegen_window seconds by up to codegen_jobs parallel codegen processes
+CODEGEN_WINDOW_THRESHOLD = int(
+    FILEHANDLING_CONFIG.get('codegen_window_threshold') or 0)
+CODEGEN_WINDOW = int(FILEHANDLING_CONFIG.get('codegen_window') or 300)
+CODEGEN_JOBS = int(
+    FILEHANDLING_CONFIG.get('codegen_jobs') or multiprocessing.cpu_count())
+
+# limits of the echoprint-codegen processes: number per host, seconds
+# until they are killed, address space in MB, file to record latencies in
+CODEGEN_RUNNER = codegenRunner.CodegenRunner(
+    SCRATCH_PATH or tempfile.gettempdir(),
+    int(FILEHANDLING_CONFIG.get('codegen_max_procs') or
+        multiprocessing.cpu_count()),
+    int(FILEHANDLING_CONFIG.get('codegen_timeout') or 0),
+    int(FILEHANDLING_CONFIG.get('codegen_memory_limit') or 0) * 1024 * 1024,
+    FILEHANDLING_CONFIG.get('codegen_stats_path') or None)
+
+# optional fingerprinting through the codegen library (see
+# contrib/codegen_c.cpp) in long-lived worker processes instead of a
+# codegen process per file, echoprint-codegen stays the fallback
+CODEGEN_LIBRARY = None
+if FILEHANDLING_CONFIG.get('codegen_library'):
+    try:
+        CODEGEN_LIBRARY = codegenLibrary.CodegenLibrary(
+            FILEHANDLING_CONFIG['codegen_library'])
+    except (OSError, AttributeError) as e:
+        print("WARNING: Couldn't load the codegen library: " + str(e))
+
+# optional persistent cache of echoprint-codegen results
+CODEGEN_CACHE = None
+if FILEHANDLING_CONFIG.get('codegen_cache_path'):
+    CODEGEN_CACHE = codegenCache.CodegenCache(
+        FILEHANDLING_CONFIG['codegen_cache_path'],
+        int(FILEHANDLING_CONFIG.get('codegen_cache_size') or 0) * 1024 * 1024)
 
 
 # --- Processing stage functions for single audiofiles ---
 
 
-def preview_audiofile(srcdir, destdir, filename):
+def preview_audiofile(srcdir, destdir, filename, pcm_buffer=None,
+                      audio_info=None):
     """
     Creates a low-quality preview audio snippet for newly uploaded files.
+
+    If pcm_buffer is given, the file has already been decoded into it,
+    if audio_info is given, the file has already been probed.
     """
 
     # make sure previews and excerpts paths exist
@@ -173,16 +340,28 @@ def preview_audiofile(srcdir, destdir, filename):
         return
 
     if matching_content.category == 'audio':
-        # create preview
-        audio = AudioSegment.from_file(filepath)
-        result = create_preview(audio, previews_filepath)
-        if not result:
-            print("ERROR: '" + filename + "' couldn't be previewed.")
+        # read stream properties from the header
+        # and reject broken files before any decoding
+        if audio_info is None:
+            try:
+                audio_info = audioTools.probe_audiofile(filepath)
+            except OSError:
+                print(
+                    "Error: Unable to find ffprobe executable in exe path.")
+                return
+        reason_details = check_audio_format(audio_info)
+        if reason_details != '':
+            reject_file(filepath, 'format_error', reason_details)
             return
 
-        # create excerpt
-        result = create_excerpt(audio, excerpts_filepath)
-        if not result:
+        # create preview and excerpt
+        preview_result, excerpt_result = create_preview_and_excerpt(
+            filepath, filename, audio_info, pcm_buffer,
+            previews_filepath, excerpts_filepath)
+        if not preview_result:
+            print("ERROR: '" + filename + "' couldn't be previewed.")
+            return
+        if not excerpt_result:
             print(
                 "ERROR: No excerpt could be cut out of '" +
                 filename + "'.")
@@ -199,15 +378,16 @@ def preview_audiofile(srcdir, destdir, filename):
         print('-' * 80)
         print("test query with excerpt file " + excerpts_filepath)
         try:
-            proc = subprocess.Popen(["echoprint-codegen", excerpts_filepath],
-                                    stdout=subprocess.PIPE)
+            json_meta_fp = run_codegen(
+                excerpts_filepath, hash_codegen_input(excerpts_filepath))
         except OSError:
             print(
                 "Error: Unable to find echoprint-codegen executable in exe "
                 "path."
             )
             return
-        json_meta_fp = str(proc.communicate()[0], "utf-8")
+        if json_meta_fp is None:
+            json_meta_fp = ''  # timed out, no test query
         fpcode_pos = json_meta_fp.find('"code":')
         if fpcode_pos > 0 and len(json_meta_fp) > 80:
             print(
@@ -217,50 +397,52 @@ def preview_audiofile(srcdir, destdir, filename):
 
             meta_fp = json.loads(json_meta_fp)
 
-            try:
-                query_request = requests.get(
-                    ECHOPRINT_URL + "/query?fp_code=" +
-                    meta_fp[0]['code'],
-                    verify=False,  # TODO: remove when cert. is updated
-                )
-            except Exception as e:
-                raise e
+            qresult = None
+            if SIMILARITY_INDEX is not None:
+                codes = decode_codes(meta_fp[0]['code'])
+                if codes is not None:
+                    qresult = SIMILARITY_INDEX.best_match(
+                        *codes, min_score=SIMILARITY_MIN_SCORE)
+                    print("Local similarity index: " + json.dumps(qresult))
+            # the local index only knows the tracks ingested since it was
+            # set up, ask the server about the rest of the catalog
+            if qresult is None or not qresult['match']:
+                try:
+                    query_request = ECHOPRINT_CLIENT.query(
+                        meta_fp[0]['code'])
+                except Exception as e:
+                    raise e
+                    print(
+                        "ERROR: '" + excerpts_filepath_relative +
+                        "' couldn't be test-queried on the EchoPrint server.")
+                    return
+
+                print
                 print(
-                    "ERROR: '" + excerpts_filepath_relative +
-                    "' couldn't be test-queried on the EchoPrint server.")
-                return
-
-            print
-            print(
-                "Server response: ",
-                query_request.status_code,
-                query_request.reason)
-            print
-            print(
-                "Body: " +
-                (query_request.text[:500] +
-                 '...' + query_request.text[-1500:]
-                 if len(query_request.text) > 2000 else query_request.text)
-            )
-
-            if query_request.status_code != 200:
+                    "Server response: ",
+                    query_request.status_code,
+                    query_request.reason)
+                print
                 print(
-                    "ERROR: '" +
-                    srcdir +
-                    "' cloudn't be test-queried on the EchoPrint server.")
-            else:
-                qresult = json.loads(query_request.text)
+                    "Body: " +
+                    (query_request.text[:500] +
+                     '...' + query_request.text[-1500:]
+                     if len(query_request.text) > 2000
+                     else query_request.text)
+                )
+
+                if query_request.status_code != 200:
+                    print(
+                        "ERROR: '" +
+                        srcdir +
+                        "' cloudn't be test-queried on the EchoPrint server.")
+                else:
+                    qresult = json.loads(query_request.text)
+            if qresult is not None:
                 score = qresult['score']
                 if qresult['match']:
-                    track_id_from_test_query = (
-                        qresult['track_id'][:8] +
-                        '-' +
-                        qresult['track_id'][8:12] +
-                        '-' +
-                        qresult['track_id'][12:16] +
-                        '-' +
-                        qresult['track_id'][16:]
-                    )
+                    track_id_from_test_query = track_id_to_uuid(
+                        qresult['track_id'])
                     # TODO: get these two from the creation table:
                     if 'artist' in qresult.keys():
                         similiar_artist = qresult['artist']
@@ -284,10 +466,10 @@ def preview_audiofile(srcdir, destdir, filename):
             STORAGE_BASE_PATH +
             os.sep, '')  # relative path
         matching_content.preview_path = previews_filepath
-        matching_content.length = int(audio.duration_seconds)
-        matching_content.channels = int(audio.channels)
-        matching_content.sample_rate = int(audio.frame_rate)
-        matching_content.sample_width = int(audio.sample_width * 8)
+        matching_content.length = int(audio_info['duration'] / 1000)
+        matching_content.channels = int(audio_info['channels'])
+        matching_content.sample_rate = int(audio_info['frame_rate'])
+        matching_content.sample_width = int(audio_info['sample_width'] * 8)
         matching_content.pre_ingest_excerpt_score = score
         if track_id_from_test_query:
             most_similar_content = trytonAccess.get_content_by_filename(
@@ -359,23 +541,6 @@ def preview_audiofile(srcdir, destdir, filename):
 
         matching_content.save()
 
-        # check it the audio format is much too bad even for 8bit enthusiasts
-        reason_details = ''
-        if audio.frame_rate < 11025:
-            reason_details = (
-                'Invalid frame rate of ' +
-                str(int(audio.frame_rate)) +
-                ' Hz')
-        if audio.sample_width < 1:
-            # less than one byte? is this even possible? :-p
-            reason_details = (
-                'Invalid sample rate of ' +
-                str(int(audio.sample_width * 8)) +
-                ' bits')
-        if reason_details != '':
-            reject_file(filepath, 'format_error', reason_details)
-            return
-
     # move file to previewed directory
     if move_file(filepath, destdir + os.sep + filename) is False:
         print(
@@ -386,43 +551,217 @@ def preview_audiofile(srcdir, destdir, filename):
         return
 
 
-def get_segments(audio):
+def plan_segments(total):
     """
-    Yields the segments back to the caller one by one.
+    Returns the (start, end) in ms of the segments mixed into the preview.
     """
-    _total = len(audio)
     _segment = _preview_segment_duration
     _interval = _preview_segment_interval
-    if _segment >= _total:
-        yield audio
-    else:
-        start = 0
-        end = _segment
-        while end < _total:
-            yield audio[start:end]
-            start = end + _interval + 1
-            end = start + _segment
+    if _segment >= total:
+        return [(0, total)]
+    segments = []
+    start = 0
+    end = _segment
+    while end < total:
+        segments.append((start, end))
+        start = end + _interval + 1
+        end = start + _segment
+    return segments
+
+
+def plan_excerpt(total):
+    """
+    Returns the (start, end) in ms of the excerpt.
+    """
+    # cut out one minute from the middle of the file
+    if total > _excerpt_segment_duration:
+        excerpt_center = total / 2
+        return (excerpt_center - _excerpt_segment_duration / 2,
+                excerpt_center + _excerpt_segment_duration / 2)
+    return (0, total)
 
 
-def create_preview(audio, preview_path):
+def check_audio_format(audio_info):
+    """
+    Returns the reason why an audio format is rejected, '' if it's fine.
     """
-    mix a cool audio preview file with low quality
+    if audio_info is None:
+        return 'No decodable audio stream found'
+    if audio_info['duration'] == 0:
+        return 'Empty audio stream'
+    # check it the audio format is much too bad even for 8bit enthusiasts
+    reason_details = ''
+    if audio_info['frame_rate'] < 11025:
+        reason_details = (
+            'Invalid frame rate of ' +
+            str(int(audio_info['frame_rate'])) +
+            ' Hz')
+    if audio_info['sample_width'] < 1:
+        # less than one byte? is this even possible? :-p
+        reason_details = (
+            'Invalid sample rate of ' +
+            str(int(audio_info['sample_width'] * 8)) +
+            ' bits')
+    return reason_details
+
+
+@contextlib.contextmanager
+def pcm_source(filepath, filename, audio_info, pcm_buffer=None):
     """
+    Yields the source of the samples of preview and excerpt of a file,
+    an object with frames, frame_rate and read_ranges() (see WavFile):
+
+    * the pcm_buffer the caller has already decoded the file into
+    * the native decoder (native_decoding=yes), for wav and flac files
+    * ffmpeg decoding only the ranges needed (partial_decoding=yes),
+      if the file header tells the duration
+    * the whole file decoded into a PCMBuffer, storing the codegen
+      input in the PCM cache on the way, or decoded by path without
+      caching, if it can't be decoded from a pipe
+    """
+    if pcm_buffer is not None:
+        yield pcm_buffer
+        return
+    native_audio = None
+    if NATIVE_DECODING:
+        native_audio = audioTools.open_native(filepath)
+    if native_audio is not None:
+        with native_audio:
+            yield native_audio
+        return
+    if audio_info['duration'] and PARTIAL_DECODING:
+        with audioTools.RangeDecoder(filepath, audio_info) as range_decoder:
+            yield range_decoder
+        return
+    # decoded audio lives in the page cache, not in the heap;
+    # the codegen input for the later stages is decoded alongside
+    cache_path = file_hasher = None
+    if PCM_CACHE is not None:
+        cache_path = PCM_CACHE.reserve()
+        file_hasher = fileTools.FileHasher()
+    try:
+        try:
+            pcm_buffer = audioTools.PCMBuffer(
+                filepath, audio_info['channels'], audio_info['frame_rate'],
+                SCRATCH_PATH, tee=file_hasher, codegen_path=cache_path,
+                duration=audio_info['duration'])
+        except CouldntDecodeError as e:
+            if file_hasher is None:
+                raise
+            # not every file can be decoded from a pipe
+            print("WARNING: " + str(e).strip())
+            file_hasher = None
+            pcm_buffer = audioTools.PCMBuffer(
+                filepath, audio_info['channels'], audio_info['frame_rate'],
+                SCRATCH_PATH)
+        with pcm_buffer:
+            yield pcm_buffer
+        if file_hasher is not None:
+            PCM_CACHE.store(filename, file_hasher.hexdigest(), cache_path)
+    finally:
+        if cache_path and os.path.exists(cache_path):
+            os.remove(cache_path)
+
+
+def create_preview_and_excerpt(filepath, filename, audio_info, pcm_buffer,
+                               preview_path, excerpt_path):
+    """
+    Creates preview and excerpt of an audio file from its pcm_source().
 
-    # convert to mono
-    mono = audio.set_channels(1)
+    The renderer is preview_renderer. If ffmpeg decodes the ranges anyway,
+    'ffmpeg' renders them in the same process, otherwise (and if that
+    fails) the samples are rendered with numpy. Fills in the duration, if
+    the file header didn't tell.
 
-    # mix segments
-    preview = None
-    for segment in get_segments(mono):
-        preview = segment if not preview else preview.append(
-            segment, crossfade=_preview_segment_crossfade
-        )
+    Returns the results of preview and excerpt creation.
+    """
+    with pcm_source(filepath, filename, audio_info, pcm_buffer) as source:
+        if not audio_info['duration']:
+            audio_info['duration'] = int(
+                1000 * source.frames / source.frame_rate)
+        if (PREVIEW_RENDERER == 'ffmpeg' and
+                isinstance(source, audioTools.RangeDecoder)):
+            if create_preview_and_excerpt_from_file(
+                    filepath, audio_info, preview_path, excerpt_path):
+                return True, True
+            print("WARNING: Falling back to separate rendering.")
+        return render_preview_and_excerpt(
+            source, audio_info['duration'], preview_path, excerpt_path)
+
+
+def render_preview_and_excerpt(source, duration, preview_path,
+                               excerpt_path):
+    """
+    Renders preview and excerpt from the samples of a pcm_source() of
+    duration ms with numpy, or with pydub (preview_renderer=pydub).
+
+    Returns the results of preview and excerpt creation.
+    """
+    frame_rate = source.frame_rate
+    ranges = plan_segments(duration)
+    samples = source.read_ranges(ranges + [plan_excerpt(duration)])
+    segments, excerpt = samples[:-1], samples[-1]
+    if PREVIEW_RENDERER == 'pydub':
+        preview_result = export_preview(
+            audioTools.assemble_preview(
+                [audioTools.to_segment(segment, frame_rate)
+                 for segment in segments],
+                _preview_segment_crossfade,
+                _preview_fadein, _preview_fadeout),
+            preview_path)
+        return preview_result, preview_result and export_excerpt(
+            audioTools.to_segment(excerpt, frame_rate).set_channels(1),
+            excerpt_path)
+    preview_result = render_preview(segments, frame_rate, preview_path)
+    return preview_result, preview_result and render_excerpt(
+        excerpt, frame_rate, excerpt_path)
+
+
+def create_preview_and_excerpt_from_file(filepath, audio_info, preview_path,
+                                         excerpt_path):
+    """
+    Renders preview and excerpt with a single ffmpeg process.
+    """
+    return audioTools.render_with_ffmpeg(
+        filepath, plan_segments(audio_info['duration']),
+        _preview_segment_crossfade, _preview_fadein, _preview_fadeout,
+        plan_excerpt(audio_info['duration']),
+        (preview_path, _preview_format, int(_preview_samplerate),
+         ["-aq", _preview_quality]),
+        (excerpt_path, _excerpt_format, int(_excerpt_samplerate),
+         ["-aq", _excerpt_quality]))
+
+
+def render_preview(segments, frame_rate, preview_path):
+    """
+    Renders the preview from sample arrays with numpy and encodes it.
+    """
+    preview = audioTools.render_preview(
+        segments, frame_rate, _preview_segment_crossfade,
+        _preview_fadein, _preview_fadeout, int(_preview_samplerate))
+    return audioTools.encode_samples(
+        preview, int(_preview_samplerate), preview_path, _preview_format,
+        ["-aq", _preview_quality])
 
-    # fade in/out
-    preview = preview.fade_in(_preview_fadein).fade_out(_preview_fadeout)
 
-    # export
+def render_excerpt(samples, frame_rate, excerpt_path):
+    """
+    Renders the excerpt from a sample array with numpy and encodes it.
+    """
+    excerpt = audioTools.render_excerpt(
+        samples, frame_rate, int(_excerpt_samplerate))
+    if _excerpt_format == 'wav':
+        return audioTools.write_wav(
+            excerpt, int(_excerpt_samplerate), excerpt_path)
+    return audioTools.encode_samples(
+        excerpt, int(_excerpt_samplerate), excerpt_path, _excerpt_format,
+        ["-aq", _excerpt_quality])
+
+
+def export_preview(preview, preview_path):
+    """
+    Exports the mixed preview.
+    """
     ok_return = True
     try:
         preview.export(
@@ -439,46 +778,10 @@ def create_preview(audio, preview_path):
     return ok_return and os.path.isfile(preview_path)
 
 
-def create_excerpt(audio, excerpt_path):
-    """
-    well, as the functin name says...
-    """
-
-    # convert to mono
-    # mono =
-    audio.set_channels(1)
-
-    # this was for experimenting with different code lengths:
-    # for exlen in range(1000, 61000, 1000):
-    #    # cut out one minute from the middle of the file
-    #    if len(audio) > exlen:
-    #        excerpt_center = len(audio) / 2
-    #        excerpt_start = excerpt_center - exlen/2
-    #        excerpt_end = excerpt_center + exlen/2
-    #        audio2 = audio[excerpt_start:excerpt_end]
-    #
-    #    # export
-    #    ok_return = True
-    #    try:
-    #        audio2.export(
-    #            excerpt_path+"-"+str(int(exlen/1000))+".wav",
-    #            format=_excerpt_format,
-    #            parameters=[
-    #                "-aq", _excerpt_quality,
-    #                "-ar", _excerpt_samplerate
-    #            ]
-    #        )
-    #    except:
-    #        ok_return = False
-
-    # cut out one minute from the middle of the file
-    if len(audio) > 60000:
-        excerpt_center = len(audio) / 2
-        excerpt_start = excerpt_center - 30000
-        excerpt_end = excerpt_center + 30000
-        audio = audio[excerpt_start:excerpt_end]
-
-    # export
+def export_excerpt(audio, excerpt_path):
+    """
+    Exports the excerpt for the fingerprint test queries.
+    """
     ok_return = True
     try:
         audio.export(
@@ -495,25 +798,22 @@ def create_excerpt(audio, excerpt_path):
     return ok_return and os.path.isfile(excerpt_path)
 
 
-def checksum_audiofile(srcdir, destdir, filename):
+def checksum_audiofile(srcdir, destdir, filename, file_hasher=None):
     """
     Hashing a single file.
+
+    If file_hasher is given, the file has already been hashed with it.
     """
 
     filepath = os.path.join(srcdir, filename)
     statinfo = os.stat(filepath)
     filelength = statinfo.st_size
 
-    bufsize = 65536
-
-    sha256 = hashlib.sha256()
-
-    with open(filepath, 'rb') as filetohash:
-        while True:
-            data = filetohash.read(bufsize)
-            if not data:
-                break
-            sha256.update(data)
+    if file_hasher is None:
+        file_hasher = fileTools.FileHasher(CHECKSUM_BLOCK_SIZE)
+        file_hasher.hash_file(filepath)
+    sha256 = file_hasher.sha256
+    file_hasher.hexdigest()  # finishes the last block
 
     print(
         "SHA256 of file {0}: {1}".format(
@@ -573,11 +873,23 @@ def checksum_audiofile(srcdir, destdir, filename):
         '')  # relative path
     matching_content.save()
 
-    # save sha256 to database
+    # save sha256 of the whole file and its blocks to database
+    ranges = [(0, filelength, sha256.hexdigest())]
+    ranges += [
+        block for block in file_hasher.blocks if block[:2] != (0, filelength)]
+    for begin, end, code in ranges:
+        save_checksum(matching_content, filename, sha256.__class__.__name__,
+                      begin, end, code)
+
+
+def save_checksum(matching_content, filename, algorithm, begin, end, code):
+    """
+    Creates or updates the checksum of a range of bytes of a content.
+    """
     matching_checksums = [
         x for x in matching_content.checksums if (
-            x.begin == 0 and
-            x.end == filelength
+            x.begin == begin and
+            x.end == end
         )
     ]
     if len(matching_checksums) == 0:
@@ -587,30 +899,105 @@ def checksum_audiofile(srcdir, destdir, filename):
         matching_content.checksums.append(checksum_to_use)
     elif len(matching_checksums) > 1:  # shouldn't happen
         print(
-            "WARNING: More than one whole file checksum entry " +
-            "in the database for '" +
+            "WARNING: More than one checksum entry for bytes " +
+            str(begin) + "-" + str(end) +
+            " in the database for '" +
             filename +
             "'. Please clean up the mess! Using the first one.")
+        checksum_to_use = matching_checksums[0]
     else:
         checksum_to_use = matching_checksums[0]  # just one found: use it!
 
-    checksum_to_use.code = sha256.hexdigest()
+    checksum_to_use.code = code
     checksum_to_use.timestamp = datetime.datetime.now()
-    checksum_to_use.algorithm = sha256.__class__.__name__
-    checksum_to_use.begin = 0
-    checksum_to_use.end = filelength
+    checksum_to_use.algorithm = algorithm
+    checksum_to_use.begin = begin
+    checksum_to_use.end = end
     checksum_to_use.save()
 
 
-def fingerprint_audiofile(srcdir, destdir, filename):
+def fingerprint_audiofile(srcdir, destdir, filename, codegen_input=None):
     """
     Audiofingerprint a single file.
 
     Comes along with metadata lookup and store it on the EchoPrint server.
+    If codegen_input is given, echoprint-codegen reads the already decoded
+    audio from there instead of decoding the file again.
+    """
+    steps = fingerprint_steps(srcdir, destdir, filename, codegen_input)
+    result = None
+    error = None
+    while True:
+        try:
+            step = steps.send(result) if error is None else steps.throw(error)
+        except StopIteration:
+            return
+        result = None
+        error = None
+        try:
+            if step[0] == 'codegen':
+                result = step[1](*step[2:])
+            else:
+                result = getattr(ECHOPRINT_CLIENT, step[0])(*step[1:])
+        except Exception as e:
+            error = e
+
+
+async def fingerprint_audiofile_async(srcdir, destdir, filename, client,
+                                      codegen_executor):
+    """
+    Audiofingerprint a single file like fingerprint_audiofile, awaiting
+    the requests to the EchoPrint server (AsyncEchoprintClient) and the
+    codegen runs (in codegen_executor) meanwhile other files proceed.
+    """
+    loop = asyncio.get_running_loop()
+    steps = fingerprint_steps(srcdir, destdir, filename)
+    result = None
+    error = None
+    while True:
+        try:
+            step = steps.send(result) if error is None else steps.throw(error)
+        except StopIteration:
+            return
+        result = None
+        error = None
+        try:
+            if step[0] == 'codegen':
+                result = await loop.run_in_executor(
+                    codegen_executor, functools.partial(*step[1:]))
+            else:
+                result = await getattr(client, step[0])(*step[1:])
+        except Exception as e:
+            error = e
+
+
+def fingerprint_steps(srcdir, destdir, filename, codegen_input=None):
+    """
+    The steps of audiofingerprinting a single file.
+
+    A generator yielding the calls that wait for others to the driver
+    (fingerprint_audiofile or fingerprint_audiofile_async): a tuple
+    ('codegen', function, arguments...) for codegen runs and a tuple
+    (method of EchoprintClient, arguments...) for the requests to the
+    EchoPrint server. The driver sends back the result or throws the
+    exception of the call. Database access stays in the generator, as
+    the proteus connection can't be used from other threads.
     """
 
     filepath = os.path.join(srcdir, filename)
 
+    # leave the file in checksummed while the EchoPrint server is down
+    # or the retry of a deferred file isn't due yet
+    if DEFERRED_QUEUE is not None:
+        if ECHOPRINT_BREAKER.open_until():
+            print(
+                "EchoPrint server unavailable until " +
+                time.ctime(ECHOPRINT_BREAKER.open_until()) +
+                ", skipping '" + filename + "'.")
+            return
+        if not DEFERRED_QUEUE.is_due(filename):
+            return
+
     # get track_id and metadata from the creation via content table
     matching_content = trytonAccess.get_content_by_filename(filename)
     if matching_content is None:
@@ -619,30 +1006,22 @@ def fingerprint_audiofile(srcdir, destdir, filename):
     if matching_content.category == 'audio':
         # already metadata present in creation?
         # then put it on the EchoPrint server rightaway
-        artist = ''
-        title = ''
-        release = ''
-        matching_creation = trytonAccess.get_creation_by_content(
-                            matching_content)
-        if matching_creation:
-            artist = matching_creation.artist.name
-            title = matching_creation.title
-            if matching_creation.releases:
-                release = matching_creation.releases[0].title
-            if artist == '':
-                artist = 'DummyFiFaFu'
-            if title == '':
-                title = 'DummyFiFaFu'
-            if release == '':
-                release = 'DummyFiFaFu'
+        artist, release, title = creation_metadata(matching_content)
 
         # create fringerprint from audio file using echoprint-codegen
         print('-' * 80)
         print("processing file " + filepath)
-        proc = subprocess.Popen(
-            ["echoprint-codegen", filepath],
-            stdout=subprocess.PIPE)
-        json_meta_fp = proc.communicate()[0]
+        json_meta_fp = yield (
+            'codegen', codegen_audiofile, filepath, filename,
+            int(matching_content.length or 0), codegen_input)
+        if json_meta_fp is None:
+            reject_file(
+                filepath,
+                'no_fingerprint',
+                "echoprint-codegen was killed after " +
+                str(CODEGEN_RUNNER.timeout) + " seconds or for exceeding " +
+                "the memory limit")
+            return
         fpcode_pos = json_meta_fp.find('"code":')
         if fpcode_pos > 0 and len(json_meta_fp) > 80:
             print(
@@ -670,7 +1049,7 @@ def fingerprint_audiofile(srcdir, destdir, filename):
             'track_id': filename.replace('-', ''),
             # '-' reserved for fp segment
             'token': ECHOPRINT_CONFIG['token'],
-            'fp_code': meta_fp[0]['code'].encode('utf8'),
+            'fp_code': meta_fp[0]['code'],
             'artist': artist,
             'release': release,
             'track': title,
@@ -696,12 +1075,11 @@ def fingerprint_audiofile(srcdir, destdir, filename):
         print()
 
         try:
-            ingest_request = requests.post(
-                ECHOPRINT_URL + "/ingest",
-                data,
-                verify=False,  # TO DO: remove when certificate is updated
-            )
+            ingest_request = yield 'ingest', data
         except Exception as e:
+            if defer_file(filepath, "Could not be sent to EchoPrint "
+                          "server (server offline?). Note: %s" % e):
+                return
             reject_file(
                 filepath,
                 'no_fingerprint',
@@ -737,6 +1115,11 @@ def fingerprint_audiofile(srcdir, destdir, filename):
                 ingest_request.text
             )
 
+        if (ingest_request.status_code >= 500 and
+                defer_file(filepath, "EchoPrint server response code " +
+                           str(ingest_request.status_code) + ': ' +
+                           ingest_request.reason)):
+            return
         if ingest_request.status_code != 200:
             reject_file(
                 filepath,
@@ -754,6 +1137,9 @@ def fingerprint_audiofile(srcdir, destdir, filename):
                 "' cloudn't be ingested into the EchoPrint server. " +
                 "File rejected.")
             return
+        if DEFERRED_QUEUE is not None:
+            DEFERRED_QUEUE.remove(filename)
+        remember_fingerprint(data)
 
         # do a 2nd test query on the EchoPrint server
         # (1st was before ingest, during preview)
@@ -772,9 +1158,13 @@ def fingerprint_audiofile(srcdir, destdir, filename):
             )
             return
 
-        excerpts_path = FILEHANDLING_CONFIG['excerpts_path']
+        excerpts_path = os.path.join(
+            FILEHANDLING_CONFIG['excerpts_path'],
+            filename[0],
+            filename[1])
         if (
-                ensure_path_exists(excerpts_path) is None
+                ensure_path_exists(
+                    os.path.join(content_base_path, excerpts_path)) is None
         ):
             print(
                 "ERROR: '" +
@@ -794,10 +1184,9 @@ def fingerprint_audiofile(srcdir, destdir, filename):
         # using echoprint-codegen and relate to the score
         print('-' * 80)
         print("test query with excerpt file " + excerpts_filepath)
-        proc = subprocess.Popen(
-            ["echoprint-codegen", excerpts_filepath],
-            stdout=subprocess.PIPE)
-        json_meta_fp = proc.communicate()[0]
+        json_meta_fp = (yield (
+            'codegen', run_codegen, excerpts_filepath,
+            hash_codegen_input(excerpts_filepath))) or ''
         fpcode_pos = json_meta_fp.find('"code":')
         if fpcode_pos > 0 and len(json_meta_fp) > 80:
             print(
@@ -808,11 +1197,7 @@ def fingerprint_audiofile(srcdir, destdir, filename):
             meta_fp = json.loads(json_meta_fp)
 
             try:
-                query_request = requests.get(
-                    ECHOPRINT_URL + "/query?fp_code=" +
-                    meta_fp[0]['code'].encode('utf8'),
-                    verify=False,  # TO DO: remove when cert. is updated
-                )
+                query_request = yield 'query', meta_fp[0]['code']
             except Exception:
                 print(
                     "ERROR: '" +
@@ -840,14 +1225,8 @@ def fingerprint_audiofile(srcdir, destdir, filename):
                 qresult = json.loads(query_request.text)
                 score = qresult['score']
                 if qresult['match']:
-                    track_id_from_test_query = (
-                        qresult['track_id'][:8] +
-                        '-' +
-                        qresult['track_id'][8:12] +
-                        '-' +
-                        qresult['track_id'][12:16] +
-                        '-' +
-                        qresult['track_id'][16:])
+                    track_id_from_test_query = track_id_to_uuid(
+                        qresult['track_id'])
                     # similiar_artist = qresult['artist']
                     # similiar_track = qresult['track']
         else:
@@ -892,29 +1271,13 @@ def fingerprint_audiofile(srcdir, destdir, filename):
 
         matching_content.save()
 
-        # TO DO: user access control
-        FingerprintLog = Model.get('content.fingerprintlog')
-        new_logentry = FingerprintLog()
-        user = Model.get('res.user')
-        matching_users = user.find(['login', '=', 'admin'])
-        if not matching_users:
-            return
-
-        new_logentry.user = matching_users[0]
-        new_logentry.content = matching_content
-        new_logentry.timestamp = datetime.datetime.now()
-        new_logentry.fingerprinting_algorithm = 'EchoPrint'
         if fpcode_pos > 0 and len(json_meta_fp) > 80:
-            new_logentry.fingerprinting_version = str(
-                meta_fp[0]['metadata']['version'])
+            fingerprinting_version = str(meta_fp[0]['metadata']['version'])
         else:
-            new_logentry.fingerprinting_version = (
+            fingerprinting_version = (
                 "unknown (check if echoprint access token was set properly!)")
-        new_logentry.entity_origin = 'direct'
-        Party = Model.get('party.party')
-        party = Party.find(['name', '=', 'C3S SCE'])[0]
-        new_logentry.entity_creator = party
-        new_logentry.save()
+        if not save_fingerprintlog(matching_content, fingerprinting_version):
+            return
 
         # TO DO: check newly ingested fingerprint using the excerpt
         # Response codes:
@@ -941,6 +1304,134 @@ def fingerprint_audiofile(srcdir, destdir, filename):
         return
 
 
+def creation_metadata(matching_content):
+    """
+    Returns the (artist, release, title) of the creation of a content for
+    the EchoPrint server.
+    """
+    artist = ''
+    title = ''
+    release = ''
+    matching_creation = trytonAccess.get_creation_by_content(
+                        matching_content)
+    if matching_creation:
+        artist = matching_creation.artist.name
+        title = matching_creation.title
+        if matching_creation.releases:
+            release = matching_creation.releases[0].title
+        if artist == '':
+            artist = 'DummyFiFaFu'
+        if title == '':
+            title = 'DummyFiFaFu'
+        if release == '':
+            release = 'DummyFiFaFu'
+    return artist, release, title
+
+
+def remember_fingerprint(data):
+    """
+    Adds a fingerprint ingested into the EchoPrint server (the ingest
+    parameters) to the fingerprint store and similarity index, if any.
+    """
+    if FINGERPRINT_STORE is not None:
+        FINGERPRINT_STORE.append(
+            data['track_id'], data['codever'], data['fp_code'],
+            {'artist': data['artist'], 'release': data['release'],
+             'track': data['track'], 'length': data['length']})
+    if SIMILARITY_INDEX is not None:
+        codes = decode_codes(data['fp_code'])
+        if codes is not None:
+            SIMILARITY_INDEX.add(
+                data['track_id'], *codes,
+                metadata={'artist': data['artist'],
+                          'release': data['release'],
+                          'track': data['track']})
+
+
+def save_fingerprintlog(matching_content, fingerprinting_version):
+    """
+    Logs the fingerprinting of a content in the database.
+
+    Returns False, if there is no admin user to log it for.
+    """
+    # TO DO: user access control
+    FingerprintLog = Model.get('content.fingerprintlog')
+    new_logentry = FingerprintLog()
+    user = Model.get('res.user')
+    matching_users = user.find(['login', '=', 'admin'])
+    if not matching_users:
+        return False
+
+    new_logentry.user = matching_users[0]
+    new_logentry.content = matching_content
+    new_logentry.timestamp = datetime.datetime.now()
+    new_logentry.fingerprinting_algorithm = 'EchoPrint'
+    new_logentry.fingerprinting_version = fingerprinting_version
+    new_logentry.entity_origin = 'direct'
+    Party = Model.get('party.party')
+    party = Party.find(['name', '=', 'C3S SCE'])[0]
+    new_logentry.entity_creator = party
+    new_logentry.save()
+    return True
+
+
+def track_id_to_uuid(track_id):
+    """
+    Returns the content uuid of an EchoPrint track id (the uuid without
+    '-', which the server reserves for fingerprint segments).
+    """
+    return (
+        track_id[:8] + '-' + track_id[8:12] + '-' + track_id[12:16] + '-' +
+        track_id[16:20] + '-' + track_id[20:])
+
+
+def decode_codes(code_string):
+    """
+    Returns the arrays (times, codes) of an EchoPrint code string, or None
+    if it can't be decoded.
+    """
+    try:
+        return echoprintCodes.decode_code_arrays(code_string)
+    except (ValueError, TypeError, zlib.error):
+        print("ERROR: Couldn't decode the EchoPrint code string.")
+        return None
+
+
+def defer_file(filepath, reason):
+    """
+    Leaves a file in its folder to retry it later with exponential
+    backoff, instead of rejecting it.
+
+    Returns False, if files can't be deferred (no deferred_queue_path)
+    or the file has been deferred deferred_max_attempts times.
+    """
+    if DEFERRED_QUEUE is None:
+        return False
+    due = DEFERRED_QUEUE.defer(os.path.basename(filepath), reason)
+    if due is None:
+        print(
+            "WARNING: '" + filepath + "' has been deferred " +
+            str(DEFERRED_QUEUE.max_attempts) + " times, giving up.")
+        return False
+    print(
+        "WARNING: '" + filepath + "' deferred until " + time.ctime(due) +
+        ": " + reason)
+    return True
+
+
+def reconcile_deferred(startpath):
+    """
+    Forgets the deferred files which aren't waiting in the fingerprint
+    stage folder any more (deleted, or moved or rejected elsewhere).
+    """
+    if DEFERRED_QUEUE is None or not DEFERRED_QUEUE.entries():
+        return
+    for filename in DEFERRED_QUEUE.retain(
+            audiofile for _, audiofile in stage_files(startpath)):
+        print("Forgetting deferred '" + filename + "', it left '" +
+              startpath + "'.")
+
+
 def drop_audiofile(srcdir, destdir, filename):
     """
     Does nothing but setting the processing step from fingerprinted to dropped.
@@ -972,6 +1463,9 @@ def drop_audiofile(srcdir, destdir, filename):
             "'.")
         return
 
+    if PCM_CACHE is not None:
+        PCM_CACHE.discard(filename)
+
     # overwrite file content with its filename
     # (so it generates different hash values)
     if FILEHANDLING_CONFIG['disembody_dropped_files'] == 'yes':
@@ -1004,82 +1498,882 @@ def drop_audiofile(srcdir, destdir, filename):
     matching_content.save()
 
 
+def fused_audiofile(srcdir, destdir, filename):
+    """
+    Previews, checksums and fingerprints a single file in one pass.
+
+    The upload is read only once: the bytes are hashed on their way into
+    ffmpeg, which decodes them for preview and excerpt and for
+    echoprint-codegen at the same time. The stage functions then record
+    the state transitions and move the file through the stage folders as
+    usual. Files that can't be decoded from a pipe take the separate
+    stages.
+    """
+
+    filepath = os.path.join(srcdir, filename)
+    user_dir = os.path.basename(os.path.normpath(srcdir))
+    previewed_dir = os.path.join(
+        STORAGE_BASE_PATH, FILEHANDLING_CONFIG['previewed_path'], user_dir)
+    checksummed_dir = os.path.join(
+        STORAGE_BASE_PATH, FILEHANDLING_CONFIG['checksummed_path'], user_dir)
+    for path in (previewed_dir, checksummed_dir):
+        if ensure_path_exists(path) is None:
+            print("ERROR: '" + path + "' couldn't be created.")
+            return
+
+    # sheets and broken files are handled by the preview stage
+    try:
+        audio_info = audioTools.probe_audiofile(filepath)
+    except OSError:
+        audio_info = None
+    if audio_info is None or check_audio_format(audio_info) != '':
+        preview_audiofile(srcdir, previewed_dir, filename,
+                          audio_info=audio_info)
+        return
+
+    file_hasher = fileTools.FileHasher(CHECKSUM_BLOCK_SIZE)
+    if PCM_CACHE is not None:
+        codegen_input = PCM_CACHE.reserve()
+    else:
+        fd, codegen_input = tempfile.mkstemp(
+            suffix='.wav', dir=SCRATCH_PATH)
+        os.close(fd)
+    try:
+        try:
+            pcm_buffer = audioTools.PCMBuffer(
+                filepath, audio_info['channels'], audio_info['frame_rate'],
+                SCRATCH_PATH, tee=file_hasher, codegen_path=codegen_input,
+                duration=audio_info['duration'])
+        except CouldntDecodeError as e:
+            print("WARNING: " + str(e).strip())
+            print("WARNING: Falling back to separate stages.")
+            preview_audiofile(srcdir, previewed_dir, filename,
+                              audio_info=audio_info)
+            return
+        if PCM_CACHE is not None:
+            PCM_CACHE.store(filename, file_hasher.hexdigest(), codegen_input)
+            codegen_input = PCM_CACHE.checkout(
+                filename, file_hasher.hexdigest())
+        with pcm_buffer:
+            preview_audiofile(
+                srcdir, previewed_dir, filename, pcm_buffer, audio_info)
+
+        # the next stages lock the file like the directory walker does
+        if not process_file_locked(
+                functools.partial(
+                    checksum_audiofile, file_hasher=file_hasher),
+                previewed_dir, checksummed_dir, filename):
+            return
+        process_file_locked(
+            functools.partial(
+                fingerprint_audiofile, codegen_input=codegen_input),
+            checksummed_dir, destdir, filename)
+    finally:
+        if codegen_input is not None and os.path.exists(codegen_input):
+            os.remove(codegen_input)
+
+
 # --- Helper functions ---
 
 
-def directory_walker(processing_step_func, args):
+def directory_walker(processing_step_func, args, jobs=1):
     """
     Walks through the specified directory tree.
 
     Applies the specified repertoire processing step for each file.
+    With jobs > 1 the files are handed to a pool of worker processes.
 
     Example: directory_walker(fingerprint_audiofile, (sourcedir, destdir))
     """
 
-    startpath = args[0]
-    destdir = args[1]
-    processing_message = "Processing " + startpath
+    startpath = os.path.normpath(args[0])
     processing_did_some_work = False
+    candidates = stage_candidates(processing_step_func, startpath, args[1])
+    if candidates is None:
+        return
+
+    if jobs > 1 and len(candidates) > 1:
+        for processed in pool_map(_process_file_in_pool, candidates, jobs):
+            processing_did_some_work |= bool(processed)
+    else:
+        for candidate in candidates:
+            processing_did_some_work |= process_file_locked(*candidate)
+
+    if processing_did_some_work:
+        print("Finished processing " + startpath)
+
+
+def async_directory_walker(processing_step_coroutine, args, concurrency):
+    """
+    Walks through the specified directory tree like directory_walker.
+
+    Applies the specified asynchronous processing step to up to
+    concurrency files at a time in an event loop.
+
+    Example: async_directory_walker(
+        fingerprint_audiofile_async, (sourcedir, destdir), 16)
+    """
+    startpath = os.path.normpath(args[0])
+    candidates = stage_candidates(
+        processing_step_coroutine, startpath, args[1])
+    if not candidates:
+        return
+    if any(asyncio.run(process_files_async(candidates, concurrency))):
+        print("Finished processing " + startpath)
+
+
+async def process_files_async(candidates, concurrency):
+    """
+    Awaits the processing of candidates, up to concurrency at a time.
+
+    The coroutines get an AsyncEchoprintClient and an executor for the
+    codegen runs as further arguments. Returns the processed flags.
+    """
+    client = echoprintClient.AsyncEchoprintClient(
+        ECHOPRINT_CLIENT, batch_size=INGEST_BATCH_SIZE,
+        batch_wait=INGEST_BATCH_WAIT)
+    # the threads just wait for the codegen processes
+    codegen_executor = concurrent.futures.ThreadPoolExecutor(
+        CODEGEN_RUNNER.max_procs)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def process(processing_step_coroutine, root, destsubdir,
+                      audiofile):
+        async with semaphore:
+            return await process_file_locked_async(
+                functools.partial(
+                    processing_step_coroutine, client=client,
+                    codegen_executor=codegen_executor),
+                root, destsubdir, audiofile)
+
+    try:
+        return await asyncio.gather(*[
+            process(*candidate) for candidate in candidates])
+    finally:
+        client.close()
+        codegen_executor.shutdown()
+
+
+def stage_candidates(processing_step_func, startpath, destdir):
+    """
+    Returns the (processing step, user subfolder, destination subfolder,
+    filename) of the files waiting in a stage, creating the destination
+    subfolders, or None, if destdir couldn't be created.
+    """
     if ensure_path_exists(destdir) is None:
         print(
             "ERROR: '" +
             destdir +
             "' couldn't be created.")
+        return None
+
+    candidates = []
+    for root, audiofile in stage_files(startpath):
+        destsubdir = root.replace(startpath, destdir, 1)
+        if ensure_path_exists(destsubdir) is None:
+            # ensure user subfolder exists
+            print(
+                "ERROR: '" +
+                destdir +
+                "' couldn't be created.")
+            continue
+        candidates.append(
+            (processing_step_func, root, destsubdir, audiofile))
+    return candidates
+
+
+def stage_files(startpath):
+    """
+    Yields (user subfolder, filename) of the files waiting in a stage.
+
+    Uses the pending index, if configured, and walks the tree otherwise.
+    The uploaded folder is filled by the web application, not by moves of
+    the worker, so its index is rebuilt on every pass (it only holds the
+    few files not previewed yet).
+    """
+    if PENDING_INDEX is not None:
+        uploaded = os.path.join(
+            STORAGE_BASE_PATH, FILEHANDLING_CONFIG['uploaded_path'])
+        if (os.path.normpath(startpath) == os.path.normpath(uploaded) or
+                not PENDING_INDEX.is_warm(startpath)):
+            PENDING_INDEX.reconcile(startpath, uuid4hex)
+        for root, audiofile in PENDING_INDEX.pending(startpath):
+            yield root, audiofile
         return
 
-    uuid4rule = (
-        '^[0-9A-F]{8}-[0-9A-F]{4}-[4][0-9A-F]{3}'
-        '-[89AB][0-9A-F]{3}-[0-9A-F]{12}$')
-    uuid4hex = re.compile(uuid4rule, re.I)
     for root, _, files in os.walk(startpath):
         level = root.replace(startpath, '').count(os.sep)
         if level == 1:
             for audiofile in files:
                 if uuid4hex.match(audiofile) is not None:
-                    # only uuid4 compilant filenames
-                    destsubdir = root.replace(args[0], destdir)
-                    if ensure_path_exists(destsubdir) is None:
-                        # ensure user subfolder exists
-                        print(
-                            "ERROR: '" +
-                            destdir +
-                            "' couldn't be created.")
-                        continue
-
-                    # lock file
-                    try:
-                        audiofilepath = os.path.join(root, audiofile)
-                        lockfilename = audiofilepath + '.lock'
-                        lockfile = open(lockfilename, 'w+')
-                        fcntl.flock(lockfile, fcntl.LOCK_EX | fcntl.LOCK_NB)
-
-                        # after successful locking,
-                        # make sure the audiofile is still there ...
-                        if os.path.isfile(audiofilepath):
-                            # ... and process file
-                            print(processing_message)
-                            processing_did_some_work = True
-                            processing_step_func(root, destsubdir, audiofile)
-
-                        # unlock file
-                        fcntl.flock(lockfile, fcntl.LOCK_UN)
-                        lockfile.close()
-                        # try:
-                        os.remove(lockfilename)
-                        # except OSError:
-                        #    pass
-
-                    except IOError:
-                        print("XXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXX")
-                        print("LOCKED: " + audiofile)
-                        # pass
-
-                    finally:
-                        if lockfile:
-                            lockfile.close()
+                    yield root, audiofile
 
-    if processing_did_some_work:
-        print("Finished processing " + startpath)
+
+def read_checksum(filepath):
+    """
+    Returns the sha256 hexdigest from the '.checksum' file next to a file,
+    or None if the file hasn't been checksummed yet.
+    """
+    try:
+        with open(filepath + '.checksum') as checksumfile:
+            return checksumfile.read().strip().rsplit(':', 1)[-1] or None
+    except IOError:
+        return None
+
+
+def codegen_audiofile(filepath, filename, length, codegen_input=None):
+    """
+    Returns the codegen output of a checksummed file of length seconds
+    from the codegen cache or runs codegen on the PCM cache entry, the
+    given codegen_input or the file itself.
+    """
+    sha256 = read_checksum(filepath)
+    json_meta_fp = lookup_codegen(sha256, length)
+    if json_meta_fp is None:
+        cached_input = None
+        if codegen_input is None and PCM_CACHE is not None:
+            cached_input = checkout_codegen_input(filepath, filename)
+        json_meta_fp = run_codegen(
+            codegen_input or cached_input or filepath, sha256, length)
+        if cached_input:
+            PCM_CACHE.release(cached_input)
+    return json_meta_fp
+
+
+def checkout_codegen_input(filepath, filename):
+    """
+    Returns a checked out PCM cache entry with the codegen input of a
+    checksummed file, decoding it into the cache on a miss.
+
+    Returns None, if the cache can't be used for the file.
+    """
+    sha256 = read_checksum(filepath)
+    if sha256 is None:
+        return None
+    cached_input = PCM_CACHE.checkout(filename, sha256)
+    if cached_input is None:
+        cache_path = PCM_CACHE.reserve()
+        if not audioTools.decode_for_codegen(filepath, cache_path):
+            os.remove(cache_path)
+            return None
+        PCM_CACHE.store(filename, sha256, cache_path)
+        cached_input = PCM_CACHE.checkout(filename, sha256)
+    return cached_input
+
+
+def codegen_version():
+    """
+    Identifies the installed echoprint-codegen build.
+
+    The binary only tells its version in the output of a run, so its
+    path, size and modification time are used (those of the codegen
+    library, if only the library is installed).
+    """
+    path = shutil.which('echoprint-codegen')
+    if path is None and CODEGEN_LIBRARY is not None:
+        path = CODEGEN_LIBRARY.path
+    if path is None:
+        raise OSError("echoprint-codegen not found in exe path")
+    path = os.path.realpath(path)
+    statinfo = os.stat(path)
+    return '%s:%d:%d' % (path, statinfo.st_size, int(statinfo.st_mtime))
+
+
+def hash_codegen_input(filepath):
+    """
+    Returns the sha256 of a codegen input for the cache, if configured.
+    """
+    if CODEGEN_CACHE is None or not os.path.isfile(filepath):
+        return None
+    return fileTools.FileHasher().hash_file(filepath).hexdigest()
+
+
+def codegen_windows(length):
+    """
+    Returns the (offset, duration) in seconds of the windows codegen runs
+    on for a file of length seconds. (0, 0) is the whole file.
+    """
+    if not CODEGEN_WINDOW_THRESHOLD or length <= CODEGEN_WINDOW_THRESHOLD:
+        return [(0, 0)]
+    return [
+        (offset, CODEGEN_WINDOW)
+        for offset in range(0, length, CODEGEN_WINDOW)]
+
+
+def lookup_codegen(sha256, length=0):
+    """
+    Returns the cached codegen output for an input or None.
+    """
+    if CODEGEN_CACHE is None or not sha256:
+        return None
+    version = codegen_version()
+    outputs = []
+    for offset, duration in codegen_windows(length):
+        output = CODEGEN_CACHE.get(sha256, version, offset, duration)
+        if output is None:
+            return None
+        outputs.append(output)
+    output = echoprintCodes.merge_outputs(outputs)
+    if output is not None:
+        print("Got codegen output from cache.")
+    return output
+
+
+def run_codegen(path, sha256=None, length=0):
+    """
+    Runs echoprint-codegen on an audio file and returns its output, or
+    None if codegen had to be killed.
+
+    Files longer than codegen_window_threshold seconds (length) are
+    split into windows, which are fingerprinted in parallel and merged.
+    With the sha256 of the input audio, the output is taken from and
+    stored to the codegen cache. Raises OSError, if echoprint-codegen
+    is missing.
+    """
+    windows = codegen_windows(length)
+    if len(windows) == 1:
+        return run_codegen_window(path, sha256, *windows[0])
+    print(
+        "Fingerprinting " + str(len(windows)) + " windows of " +
+        str(CODEGEN_WINDOW) + " seconds.")
+    # the threads just wait for the codegen processes
+    pool = multiprocessing.pool.ThreadPool(min(CODEGEN_JOBS, len(windows)))
+    try:
+        outputs = pool.starmap(
+            functools.partial(run_codegen_window, path, sha256), windows)
+    finally:
+        pool.close()
+        pool.join()
+    if None in outputs:
+        return None  # killed, the whole file won't do better
+    output = echoprintCodes.merge_outputs(outputs)
+    if output is None:
+        print("WARNING: Fingerprinting of a window failed, "
+              "fingerprinting the whole file.")
+        output = run_codegen_window(path, sha256, 0, 0)
+    return output
+
+
+def run_codegen_window(path, sha256, offset, duration):
+    """
+    Runs echoprint-codegen on duration seconds from offset of a file
+    (0, 0: the whole file), using the codegen cache.
+    """
+    version = None
+    if CODEGEN_CACHE is not None and sha256:
+        version = codegen_version()
+        output = CODEGEN_CACHE.get(sha256, version, offset, duration)
+        if output is not None:
+            return output
+    output = None
+    if CODEGEN_LIBRARY is not None:
+        # any input, decoded like echoprint-codegen does it, in a worker
+        # process of the library; the binary is the fallback
+        output = CODEGEN_RUNNER.call(
+            path, codegenLibrary.server_command(CODEGEN_LIBRARY.path),
+            [path, offset, duration])
+    if output is None:
+        arguments = [path]
+        if duration:
+            arguments += [str(offset), str(duration)]
+        output = CODEGEN_RUNNER.run(arguments)
+    if version and output and output.find('"code":') > 0:
+        CODEGEN_CACHE.put(sha256, version, offset, duration, output)
+    return output
+
+
+def process_file_locked(processing_step_func, root, destsubdir, audiofile):
+    """
+    Applies a processing step to a single file under an exclusive lock.
+
+    Other workers skip the file as long as its '.lock' file is locked.
+    Errors are reported and don't affect the processing of other files.
+
+    Returns True, if the file has been processed.
+    """
+    audiofilepath = os.path.join(root, audiofile)
+    with locked_file(audiofilepath) as locked:
+        if not locked:
+            return False
+        print("Processing " + audiofilepath)
+        try:
+            processing_step_func(root, destsubdir, audiofile)
+        except Exception:
+            print("ERROR: Processing of '" + audiofilepath + "' failed:")
+            traceback.print_exc()
+    return True
+
+
+async def process_file_locked_async(processing_step_coroutine, root,
+                                    destsubdir, audiofile):
+    """
+    Awaits a processing step of a single file under an exclusive lock
+    like process_file_locked.
+    """
+    audiofilepath = os.path.join(root, audiofile)
+    with locked_file(audiofilepath) as locked:
+        if not locked:
+            return False
+        print("Processing " + audiofilepath)
+        try:
+            await processing_step_coroutine(root, destsubdir, audiofile)
+        except Exception:
+            print("ERROR: Processing of '" + audiofilepath + "' failed:")
+            traceback.print_exc()
+    return True
+
+
+@contextlib.contextmanager
+def locked_file(audiofilepath):
+    """
+    Locks a file exclusively against other workers.
+
+    Yields True, if the lock was acquired and the file is still there.
+    """
+    lockfilename = audiofilepath + '.lock'
+    lockfile = None
+    try:
+        lockfile = open(lockfilename, 'w+')
+        fcntl.flock(lockfile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError:
+        print("XXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXX")
+        print("LOCKED: " + os.path.basename(audiofilepath))
+        if lockfile:
+            lockfile.close()
+        yield False
+        return
+
+    try:
+        # after successful locking,
+        # make sure the audiofile is still there
+        present = os.path.isfile(audiofilepath)
+        if not present and PENDING_INDEX is not None:
+            # file is gone, e.g. processed by another host
+            PENDING_INDEX.discard(audiofilepath)
+        yield present
+    finally:
+        # unlock file
+        fcntl.flock(lockfile, fcntl.LOCK_UN)
+        lockfile.close()
+        os.remove(lockfilename)
+
+
+def file_is_locked(audiofilepath):
+    """
+    Checks, if a worker holds the lock of a file, without waiting for it.
+    """
+    try:
+        with open(audiofilepath + '.lock') as lockfile:
+            # flock can't be tested without taking it; a worker trying to
+            # lock the file in this moment skips it until the next run
+            fcntl.flock(lockfile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            fcntl.flock(lockfile, fcntl.LOCK_UN)
+    except FileNotFoundError:
+        return False
+    except IOError:
+        return True
+    return False
+
+
+def processing_stages():
+    """
+    Returns the (stage function, source dir, destination dir) of each
+    processing step in the order of the pipeline.
+    """
+    def stage_path(key):
+        return os.path.join(STORAGE_BASE_PATH, FILEHANDLING_CONFIG[key])
+    if FUSED_PIPELINE:
+        # files leave the uploaded folder fingerprinted
+        return [
+            (fused_audiofile,
+             stage_path('uploaded_path'), stage_path('fingerprinted_path')),
+            (checksum_audiofile,
+             stage_path('previewed_path'), stage_path('checksummed_path')),
+            (fingerprint_audiofile,
+             stage_path('checksummed_path'),
+             stage_path('fingerprinted_path')),
+            (drop_audiofile,
+             stage_path('fingerprinted_path'), stage_path('dropped_path')),
+        ]
+    return [
+        (preview_audiofile,
+         stage_path('uploaded_path'), stage_path('previewed_path')),
+        (checksum_audiofile,
+         stage_path('previewed_path'), stage_path('checksummed_path')),
+        (fingerprint_audiofile,
+         stage_path('checksummed_path'), stage_path('fingerprinted_path')),
+        (drop_audiofile,
+         stage_path('fingerprinted_path'), stage_path('dropped_path')),
+    ]
+
+
+def _process_file_in_pool(candidate):
+    """
+    Pool wrapper for process_file_locked().
+
+    A stage function calling exit() must not take down the pool worker.
+    """
+    try:
+        return process_file_locked(*candidate)
+    except SystemExit:
+        return False
+
+
+# the error of connect_db() in a pool worker
+_POOL_DB_ERROR = None
+
+
+def _connect_pool_worker():
+    """
+    Pool initializer: forked workers need their own proteus connection.
+
+    A failed initializer would be restarted by the pool over and over,
+    so the error is kept for _call_in_pool() to report.
+    """
+    global _POOL_DB_ERROR
+    try:
+        connect_db()
+    except SystemExit as e:
+        _POOL_DB_ERROR = e.code
+
+
+def _call_in_pool(func_and_arg):
+    """
+    Returns (database error, func(arg)) in a pool worker.
+    """
+    func, arg = func_and_arg
+    if _POOL_DB_ERROR is not None:
+        return _POOL_DB_ERROR, None
+    return None, func(arg)
+
+
+def new_pool(jobs):
+    """
+    Returns a pool of jobs worker processes connected to the database.
+
+    Tasks are (func, arg) for _call_in_pool(), their results are read
+    with pool_result().
+    """
+    return multiprocessing.Pool(jobs, initializer=_connect_pool_worker)
+
+
+def pool_result(pool, response):
+    """
+    Returns the result of a pool task, or exits like connect_db() in the
+    main process, if the worker couldn't connect to the database.
+    """
+    error, result = response
+    if error is not None:
+        pool.terminate()
+        exit(error)
+    return result
+
+
+def pool_map(func, items, jobs):
+    """
+    Yields func(item) for each item, in the order of completion, computed
+    by a pool of up to jobs worker processes (see new_pool()).
+    """
+    pool = new_pool(min(jobs, len(items)))
+    try:
+        for response in pool.imap_unordered(
+                _call_in_pool, [(func, item) for item in items]):
+            yield pool_result(pool, response)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def select_backfill_contents(states):
+    """
+    Returns the (uuid, last path, latest fingerprinting version) of the
+    audio contents in the processing states; the version is None, if a
+    content hasn't been logged as fingerprinted.
+    """
+    FingerprintLog = Model.get('content.fingerprintlog')
+    latest = {}  # content id: version of its latest log entry
+    for logentry in FingerprintLog.find(
+            [('fingerprinting_algorithm', '=', 'EchoPrint')],
+            order=[('timestamp', 'ASC'), ('id', 'ASC')]):
+        latest[logentry.content.id] = logentry.fingerprinting_version
+    Content = Model.get('content')
+    return [
+        (content.uuid, content.path or '', latest.get(content.id))
+        for content in Content.find([
+            ('category', '=', 'audio'),
+            ('processing_state', 'in', list(states))])]
+
+
+def stored_audiofile_paths(filename, path):
+    """
+    Returns the paths of a fingerprinted file in the fingerprinted and
+    dropped folders, looking up the user subfolder from its last recorded
+    path or, if that fails, in all user subfolders.
+    """
+    user_dir = os.path.basename(os.path.dirname(path))
+    paths = []
+    for key in ('fingerprinted_path', 'dropped_path'):
+        stage_dir = os.path.join(STORAGE_BASE_PATH, FILEHANDLING_CONFIG[key])
+        filepath = os.path.join(stage_dir, user_dir, filename)
+        if user_dir and os.path.isfile(filepath):
+            paths.append(filepath)
+        else:
+            paths += glob.glob(os.path.join(stage_dir, '*', filename))
+    return paths
+
+
+def is_disembodied(filepath, filename):
+    """
+    Checks, if a dropped file has been overwritten with its filename
+    (disembody_dropped_files).
+    """
+    if os.path.getsize(filepath) != len(filename):
+        return False
+    with open(filepath) as droppedfile:
+        return droppedfile.read() == filename
+
+
+def probe_codegen_version(contents):
+    """
+    Returns the version echoprint-codegen reports for the first seconds of
+    the first stored file of the contents (uuid, path, ...), or None.
+    """
+    for content in contents:
+        for filepath in stored_audiofile_paths(content[0], content[1]):
+            if is_disembodied(filepath, content[0]):
+                continue
+            output = run_codegen_window(filepath, None, 0, 10)
+            try:
+                return str(json.loads(output)[0]['metadata']['version'])
+            except (TypeError, ValueError, KeyError, IndexError):
+                print("WARNING: No codegen version from '" + filepath + "'.")
+    return None
+
+
+def backfill_content(entry):
+    """
+    Backfills a journaled content (uuid, last path) under the lock of its
+    file and records the outcome in the backfill journal.
+
+    Files locked by the pipeline and files which couldn't be sent to the
+    EchoPrint server stay pending. Returns the journal state.
+    """
+    filename, path = entry
+    BACKFILL_LIMITER.wait()
+    if ECHOPRINT_BREAKER is not None and ECHOPRINT_BREAKER.open_until():
+        BACKFILL_JOURNAL.mark(
+            filename, 'pending', "EchoPrint server unavailable")
+        return 'pending'
+    state, note = 'missing', "file not found"
+    for filepath in stored_audiofile_paths(filename, path):
+        with locked_file(filepath) as locked:
+            if not locked:
+                # in process by the pipeline or moved on meanwhile
+                state, note = 'pending', "file locked"
+                continue
+            print("Backfilling " + filepath)
+            try:
+                state, note = backfill_audiofile(filepath, filename)
+            except Exception:
+                print("ERROR: Backfilling of '" + filepath + "' failed:")
+                traceback.print_exc()
+                state, note = 'failed', "exception, see log"
+            break
+    BACKFILL_JOURNAL.mark(filename, state, note)
+    return state
+
+
+def backfill_audiofile(filepath, filename):
+    """
+    Fingerprints a stored file again, ingests the fingerprint into the
+    EchoPrint server and logs it, leaving the file where it is and the
+    processing state of its content as it is.
+
+    Returns the (journal state, note) of the outcome.
+    """
+    if is_disembodied(filepath, filename):
+        return 'missing', "file disembodied"
+    matching_content = trytonAccess.get_content_by_filename(filename)
+    if matching_content is None:
+        return 'failed', "no content record"
+    artist, release, title = creation_metadata(matching_content)
+
+    json_meta_fp = codegen_audiofile(
+        filepath, filename, int(matching_content.length or 0))
+    if not json_meta_fp or json_meta_fp.find('"code":') < 0:
+        return 'failed', "no fingerprint: " + str(json_meta_fp)[:200]
+    meta_fp = json.loads(json_meta_fp)
+
+    data = {
+        'track_id': filename.replace('-', ''),
+        'token': ECHOPRINT_CONFIG['token'],
+        'fp_code': meta_fp[0]['code'],
+        'artist': artist,
+        'release': release,
+        'track': title,
+        'length': int(matching_content.length or 0),
+        'codever': str(meta_fp[0]['metadata']['version']),
+        }
+    # the server replaces the former fingerprint of the track
+    try:
+        ingest_request = ECHOPRINT_CLIENT.ingest(data)
+    except Exception as e:
+        return 'pending', "ingest failed: %s" % e
+    if ingest_request.status_code != 200:
+        return (
+            'pending' if ingest_request.status_code >= 500 else 'failed',
+            "EchoPrint server response code " +
+            str(ingest_request.status_code) + ': ' + ingest_request.reason)
+    remember_fingerprint(data)
+
+    if not save_fingerprintlog(matching_content, data['codever']):
+        return 'failed', "ingested, but not logged (no admin user)"
+    return 'done', data['codever']
+
+
+IDENTIFY_FIELDS = ('clip', 'track_id', 'score', 'content', 'artist', 'title',
+                   'error')
+
+
+def clip_paths(paths, clip_list=None):
+    """
+    Yields the clips in the given files and folders (recursively) and the
+    paths listed in clip_list, one per line.
+    """
+    for path in paths:
+        if not os.path.isdir(path):
+            yield path
+            continue
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for clip in sorted(files):
+                if not clip.startswith('.'):
+                    yield os.path.join(root, clip)
+    if clip_list is not None:
+        for line in clip_list:
+            if line.strip():
+                yield line.strip()
+
+
+def codegen_clip(clip):
+    """
+    Returns the EchoPrint code string of a clip or None.
+    """
+    output = run_codegen(clip, hash_codegen_input(clip))
+    try:
+        return json.loads(output)[0]['code'] or None
+    except (TypeError, ValueError, KeyError, IndexError):
+        return None
+
+
+async def identify_clip(clip, client, codegen_executor):
+    """
+    Fingerprints a clip and queries the EchoPrint server for it.
+
+    Returns the result with the clip, score and matching track id or an
+    error.
+    """
+    result = {'clip': clip, 'track_id': None, 'score': 0, 'error': None}
+    code = await asyncio.get_running_loop().run_in_executor(
+        codegen_executor, codegen_clip, clip)
+    if code is None:
+        result['error'] = "no fingerprint"
+        return result
+    try:
+        query_request = await client.query(code)
+    except Exception as e:
+        result['error'] = "query failed: %s" % e
+        return result
+    if query_request.status_code != 200:
+        result['error'] = (
+            "EchoPrint server response code " +
+            str(query_request.status_code) + ': ' + query_request.reason)
+        return result
+    qresult = json.loads(query_request.text)
+    result['score'] = qresult.get('score', 0)
+    if qresult.get('match'):
+        result['track_id'] = qresult['track_id']
+        # fallback, if the track isn't in the database
+        result['artist'] = qresult.get('artist')
+        result['title'] = qresult.get('track')
+    return result
+
+
+async def identify_clips(clips, concurrency, emit):
+    """
+    Identifies the clips, up to concurrency at a time, and passes each
+    result to emit as soon as it is there.
+
+    The clips are taken from the iterable as needed, so it may be a
+    generator over any number of them. emit is called in a thread of its
+    own, connected to the database, one result at a time, so it may look
+    up the matches without blocking the event loop.
+    """
+    loop = asyncio.get_running_loop()
+    client = echoprintClient.AsyncEchoprintClient(ECHOPRINT_CLIENT)
+    # the threads just wait for the codegen processes
+    codegen_executor = concurrent.futures.ThreadPoolExecutor(
+        CODEGEN_RUNNER.max_procs)
+    # the proteus configuration is per thread
+    emit_executor = concurrent.futures.ThreadPoolExecutor(
+        1, initializer=connect_db)
+    clips = iter(clips)
+
+    async def worker():
+        # the workers share the iterator, no locking needed in the loop
+        for clip in clips:
+            result = await identify_clip(clip, client, codegen_executor)
+            await loop.run_in_executor(emit_executor, emit, result)
+
+    try:
+        await asyncio.gather(*[worker() for _ in range(concurrency)])
+    finally:
+        client.close()
+        codegen_executor.shutdown()
+        emit_executor.shutdown()
+
+
+def resolve_track_ids(track_ids, known):
+    """
+    Looks up the content uuid, artist and title of the EchoPrint track ids
+    not in known (track id: (uuid, artist, title)) with one query for the
+    contents and one for their creations (content.creation), and adds
+    them to known.
+    """
+    uuids = dict(
+        (track_id_to_uuid(track_id), track_id)
+        for track_id in set(track_ids) if track_id not in known)
+    contents = trytonAccess.get_contents_by_filenames(uuids)
+    creations = trytonAccess.get_creations_by_contents(contents.values())
+    for uuid, track_id in uuids.items():
+        content = contents.get(uuid)
+        if content is None:
+            known[track_id] = (None, None, None)
+            continue
+        creation = creations.get(content.id)
+        if creation is None:
+            known[track_id] = (uuid, None, None)
+            continue
+        known[track_id] = (
+            uuid, creation.artist.name if creation.artist else None,
+            creation.title)
+
+
+def write_identified(results, known, write):
+    """
+    Resolves the matches of a batch of results to contents and writes
+    the results.
+    """
+    resolve_track_ids(
+        [result['track_id'] for result in results if result['track_id']],
+        known)
+    for result in results:
+        if result['track_id']:
+            uuid, artist, title = known[result['track_id']]
+            result['content'] = uuid
+            result['artist'] = artist or result.get('artist')
+            result['title'] = title or result.get('title')
+        write(dict((field, result.get(field)) for field in IDENTIFY_FIELDS))
 
 
 def move_file(source, target):
@@ -1106,7 +2400,11 @@ def move_file(source, target):
         # suppose we only have one mounted filesystem
     except IOError as e:
         print(e)
-    return os.path.isfile(target) and not os.path.isfile(source)
+    moved = os.path.isfile(target) and not os.path.isfile(source)
+    if moved and PENDING_INDEX is not None:
+        PENDING_INDEX.discard(source)
+        PENDING_INDEX.add(target)
+    return moved
 
 
 def ensure_path_exists(path):
@@ -1158,6 +2456,8 @@ def reject_file(source, reason, reason_details):
         rejected_filepath_relative)
 
     move_file(source, rejected_filepath)
+    if PCM_CACHE is not None:
+        PCM_CACHE.discard(os.path.basename(source))
 
     # TODO: cleanup possible preview and excerpt files
 
@@ -1197,9 +2497,16 @@ def repro():
     """
 
 
+jobs_option = click.option(
+    '--jobs', '-j', default=1, show_default=True,
+    type=click.IntRange(min=1),
+    help="Number of files to process in parallel.")
+
+
 @repro.command('preview')
+@jobs_option
 # @click.pass_context
-def preview():
+def preview(jobs):
     """
     Get files from uploaded_path and creates a low quality audio snippet of it.
     """
@@ -1210,13 +2517,15 @@ def preview():
                          FILEHANDLING_CONFIG['uploaded_path']),
             os.path.join(STORAGE_BASE_PATH,
                          FILEHANDLING_CONFIG['previewed_path'])
-        )
+        ),
+        jobs
     )
 
 
 @repro.command('checksum')
+@jobs_option
 # @click.pass_context
-def checksum():
+def checksum(jobs):
     """
     Get files from previewed_path and hash them.
     """
@@ -1226,27 +2535,56 @@ def checksum():
                          FILEHANDLING_CONFIG['previewed_path']),
             os.path.join(STORAGE_BASE_PATH,
                          FILEHANDLING_CONFIG['checksummed_path'])
-        )
+        ),
+        jobs
     )
 
 
 @repro.command('fingerprint')
+@jobs_option
+@click.option(
+    '--concurrency', default=FINGERPRINT_CONCURRENCY, show_default=True,
+    type=click.IntRange(min=0),
+    help="Fingerprint this many files at a time with asyncio instead of "
+         "using jobs, 0 to disable.")
 # @click.pass_context
-def fingerprint():
+def fingerprint(jobs, concurrency):
     """
     Get files from checksummed_path and fingerprint them.
     """
+    args = (
+        os.path.join(STORAGE_BASE_PATH,
+                     FILEHANDLING_CONFIG['checksummed_path']),
+        os.path.join(STORAGE_BASE_PATH,
+                     FILEHANDLING_CONFIG['fingerprinted_path']))
+    reconcile_deferred(args[0])
+    if concurrency:
+        async_directory_walker(fingerprint_audiofile_async, args, concurrency)
+        return
+    directory_walker(fingerprint_audiofile, args, jobs)
+
+
+@repro.command('fused')
+@jobs_option
+def fused(jobs):
+    """
+    Get files from uploaded_path and preview, checksum and fingerprint them.
+
+    Reads each file only once instead of once per processing step.
+    """
     directory_walker(
-        fingerprint_audiofile, (
+        fused_audiofile, (
             os.path.join(STORAGE_BASE_PATH,
-                         FILEHANDLING_CONFIG['checksummed_path']),
+                         FILEHANDLING_CONFIG['uploaded_path']),
             os.path.join(STORAGE_BASE_PATH,
-                         FILEHANDLING_CONFIG['fingerprinted_path'])))
+                         FILEHANDLING_CONFIG['fingerprinted_path'])),
+        jobs)
 
 
 @repro.command('drop')
+@jobs_option
 # @click.pass_context
-def drop():
+def drop(jobs):
     """
     Get files from fingerprinted_path and 'drop' them for archiving.
 
@@ -1260,56 +2598,533 @@ def drop():
             os.path.join(STORAGE_BASE_PATH,
                          FILEHANDLING_CONFIG['fingerprinted_path']),
             os.path.join(STORAGE_BASE_PATH,
-                         FILEHANDLING_CONFIG['dropped_path'])))
+                         FILEHANDLING_CONFIG['dropped_path'])),
+        jobs)
+
+
+def deletion_track_ids(ids, id_list=None, states=()):
+    """
+    Yields the EchoPrint track ids of the given track ids or content
+    uuids, those listed in id_list, one per line, and those of the audio
+    contents in the processing states, each once.
+    """
+    def listed():
+        for track_id in ids:
+            yield track_id
+        if id_list is not None:
+            for line in id_list:
+                yield line
+        if states:
+            Content = Model.get('content')
+            for content in Content.find([
+                    ('category', '=', 'audio'),
+                    ('processing_state', 'in', list(states))]):
+                yield content.uuid
+
+    seen = set()
+    for track_id in listed():
+        # content uuids contain '-', the track ids don't
+        track_id = track_id.strip().replace('-', '')
+        if track_id and track_id not in seen:
+            seen.add(track_id)
+            yield track_id
+
+
+def deletion_result(delete_request):
+    """
+    Returns the outcome ('deleted', 'not found' or 'failed') and a note
+    of a delete request to the EchoPrint server.
+    """
+    if delete_request.status_code != 200:
+        return 'failed', (
+            "response code " + str(delete_request.status_code) + ': ' +
+            delete_request.reason)
+    try:
+        found = json.loads(delete_request.text).get('ok', True)
+    except (ValueError, AttributeError):
+        found = True
+    return ('deleted' if found else 'not found'), ''
 
 
 @repro.command('delete')
-# @click.pass_context
-def delete():
+@click.argument('ids', nargs=-1)
+@click.option(
+    '--from-list', 'id_list', type=click.File('r'),
+    help="File listing one track id or content uuid per line, - for stdin.")
+@click.option(
+    '--state', 'states', multiple=True,
+    help="Also delete the fingerprints of all audio contents in this "
+         "processing state, e.g. rejected (repeatable).")
+@click.option(
+    '--concurrency', default=ECHOPRINT_CLIENT.pool_size, show_default=True,
+    type=click.IntRange(min=1),
+    help="Number of delete requests at a time (default: pool_size).")
+@click.option(
+    '--rate', default=0.0, show_default=True, type=click.FloatRange(min=0),
+    help="Delete requests per second at most, 0 for no limit.")
+@click.option(
+    '--dry-run', is_flag=True,
+    help="Only list the track ids to delete.")
+def delete(ids, id_list, states, concurrency, rate, dry_run):
+    """
+    Delete fingerprints from the EchoPrint server.
+
+    Takes EchoPrint track ids or content uuids from the arguments, a list
+    and a database query for processing states, sends the delete requests
+    concurrently and removes the deleted fingerprints from the local
+    fingerprint store and similarity index. Prints the outcome of each
+    and a summary. At most twice concurrency requests are queued at a
+    time, and none are sent after the circuit breaker opened.
+    """
+    track_ids = deletion_track_ids(ids, id_list, states)
+    if dry_run:
+        for track_id in track_ids:
+            print(track_id)
+        return
+    limiter = backfillJournal.RateLimiter(rate)
+
+    def delete_track(track_id):
+        limiter.wait()
+        return ECHOPRINT_CLIENT.delete(track_id)
+
+    counts = {}
+    start = time.time()
+    executor = concurrent.futures.ThreadPoolExecutor(concurrency)
+    futures = {}
+    track_ids = iter(track_ids)
+    try:
+        while True:
+            while len(futures) < 2 * concurrency and not (
+                    ECHOPRINT_BREAKER is not None and
+                    ECHOPRINT_BREAKER.open_until()):
+                track_id = next(track_ids, None)
+                if track_id is None:
+                    break
+                futures[executor.submit(delete_track, track_id)] = track_id
+            if not futures:
+                break
+            done = concurrent.futures.wait(
+                futures, return_when=concurrent.futures.FIRST_COMPLETED)[0]
+            for future in done:
+                track_id = futures.pop(future)
+                try:
+                    result, note = deletion_result(future.result())
+                except Exception as e:
+                    result, note = 'failed', str(e)
+                if result != 'failed':
+                    # local indexes aren't thread safe, update them here
+                    if SIMILARITY_INDEX is not None:
+                        SIMILARITY_INDEX.remove(track_id)
+                    if FINGERPRINT_STORE is not None:
+                        FINGERPRINT_STORE.remove(track_id)
+                counts[result] = counts.get(result, 0) + 1
+                print(track_id + ": " + result +
+                      (" (" + note + ")" if note else ""))
+    finally:
+        for future in futures:
+            future.cancel()
+        executor.shutdown()
+    unsent = sum(1 for _ in track_ids)
+    if unsent:
+        counts['not sent'] = unsent
+        print("EchoPrint server unavailable, " + str(unsent) +
+              " fingerprints not sent, run again later.")
+    print("Deleted %d fingerprints in %.1f seconds: %s" % (
+        counts.get('deleted', 0), time.time() - start, ", ".join(
+            result + ": " + str(count)
+            for result, count in sorted(counts.items())) or "none given"))
+
+
+@repro.command('deferred')
+def deferred():
     """
-    delete a fingerprint from the echoprint server
+    Show the files deferred during EchoPrint server outages.
+    """
+    if DEFERRED_QUEUE is None:
+        print("ERROR: deferred_queue_path isn't configured.")
+        return
+    reconcile_deferred(os.path.join(
+        STORAGE_BASE_PATH, FILEHANDLING_CONFIG['checksummed_path']))
+    open_until = ECHOPRINT_BREAKER.open_until()
+    if open_until:
+        print("EchoPrint server unavailable until " + time.ctime(open_until))
+    for filename, attempts, due, reason in DEFERRED_QUEUE.entries():
+        print(
+            filename + "  attempts: " + str(attempts) + "  due: " +
+            time.ctime(due) + "  " + reason)
+
+
+@repro.command('reingest')
+@click.option(
+    '--batch-size', default=max(INGEST_BATCH_SIZE, 1), show_default=True,
+    type=click.IntRange(min=1),
+    help="Fingerprints per ingest request, more than 1 needs "
+         "ingest_batch_api=yes (default: ingest_batch_size).")
+@click.option(
+    '--journal',
+    help="Journal (sqlite file) of the progress; rerun with the same "
+         "journal to resume after the last accepted fingerprint.")
+@click.option(
+    '--similarity-index/--no-similarity-index', default=False,
+    help="Also rebuild the local similarity index.")
+@click.option(
+    '--rebuild-store-index', is_flag=True,
+    help="Rebuild the index of the fingerprint store from its data first.")
+def reingest(batch_size, journal, similarity_index, rebuild_store_index):
     """
+    Ingest all stored fingerprints into the EchoPrint server.
 
-    # utilizations = Model.get('creation.utilisation.imp')
-    # result = utilizations.find(['title', "=", "999,999"])
-    # if not result:
-    #     sys.exit()
-    # code = result.fingerprint
+    Streams the local fingerprint store into a fresh or migrated server
+    without touching any audio. Fingerprints the server rejects are
+    reported and skipped; the run stops when the server fails.
+    """
+    if FINGERPRINT_STORE is None:
+        print("ERROR: fingerprint_store_path isn't configured.")
+        return
+    if similarity_index and SIMILARITY_INDEX is None:
+        print("ERROR: similarity_index_path isn't configured.")
+        return
+    if batch_size > 1 and not INGEST_BATCH_API:
+        print("ERROR: --batch-size needs ingest_batch_api=yes.")
+        return
+    after = -1
+    if journal:
+        journal = backfillJournal.BackfillJournal(journal)
+        url = journal.get_meta('reingest_url')
+        if url is not None and url != ECHOPRINT_URL:
+            print("ERROR: The journal is for " + url + ", use another "
+                  "journal for " + ECHOPRINT_URL + ".")
+            return
+        journal.set_meta('reingest_url', ECHOPRINT_URL)
+        after = int(journal.get_meta('reingest_offset') or -1)
+    if rebuild_store_index:
+        print("Indexed " + str(FINGERPRINT_STORE.rebuild_index()) +
+              " stored fingerprints.")
+    total = FINGERPRINT_STORE.count(after)
+    if after >= 0:
+        print("Resuming with " + str(total) + " fingerprints.")
+    done = rejected = 0
+    start = report = time.time()
+    batch = []
+
+    def post(items):
+        # the response, or None if the server failed
+        try:
+            if len(items) == 1:
+                response = ECHOPRINT_CLIENT.ingest(items[0])
+            else:
+                response = ECHOPRINT_CLIENT.ingest_batch(items)
+        except Exception as e:
+            print("ERROR: EchoPrint server unavailable: " + str(e))
+            return None
+        if response.status_code >= 500:
+            print(
+                "ERROR: EchoPrint server response code " +
+                str(response.status_code) + ": " + response.reason)
+            return None
+        return response
+
+    def accept(entries, offset):
+        # records the progress up to offset, after the server accepted
+        # the (offset, ingest data, record) entries
+        if similarity_index:
+            for _, _, record in entries:
+                codes = decode_codes(record['code'])
+                if codes is not None:
+                    SIMILARITY_INDEX.add(
+                        record['track_id'], *codes, metadata=dict(
+                            (key, record['metadata'].get(key, ''))
+                            for key in ('artist', 'release', 'track')))
+        if journal:
+            journal.set_meta('reingest_offset', str(offset))
+
+    def send(batch):
+        # ingests a batch of (offset, ingest data, record), one by one if
+        # the server rejects it, and returns the number of entries
+        # processed before the server failed
+        nonlocal rejected
+        response = post([data for _, data, _ in batch])
+        if response is None:
+            return 0
+        if response.status_code == 200:
+            accept(batch, batch[-1][0])
+            return len(batch)
+        accepted = []
+        for processed, entry in enumerate(batch):
+            if len(batch) > 1:
+                response = post([entry[1]])
+            if response is None:
+                if processed:
+                    accept(accepted, batch[processed - 1][0])
+                return processed
+            if response.status_code == 200:
+                accepted.append(entry)
+                continue
+            rejected += 1
+            print(
+                "ERROR: EchoPrint server rejected track " +
+                entry[1]['track_id'] + ": " + str(response.status_code) +
+                " " + response.reason)
+        accept(accepted, batch[-1][0])
+        return len(batch)
+
+    def stopped():
+        print("Stopped after %d of %d fingerprints." % (done, total))
+        if journal:
+            print("Run again with the same journal to resume.")
+        else:
+            print("Use --journal to be able to resume.")
 
-    url = ECHOPRINT_URL + "/delete"
-    var_id = "track_id"
-    track = "TRWIZHB123E858D912"
+    for offset, record in FINGERPRINT_STORE.records(after):
+        metadata = record['metadata']
+        batch.append((offset, {
+            'track_id': record['track_id'],
+            'token': ECHOPRINT_CONFIG['token'],
+            'fp_code': record['code'],
+            'artist': metadata.get('artist', ''),
+            'release': metadata.get('release', ''),
+            'track': metadata.get('track', ''),
+            'length': metadata.get('length', 0),
+            'codever': record['codever'],
+        }, record))
+        if len(batch) >= batch_size:
+            processed = send(batch)
+            done += processed
+            if processed < len(batch):
+                stopped()
+                return
+            batch = []
+            if time.time() - report >= 10:
+                report = time.time()
+                print("Reingested %d of %d fingerprints (%.0f/s)" % (
+                    done, total, done / (report - start)))
+    if batch:
+        processed = send(batch)
+        done += processed
+        if processed < len(batch):
+            stopped()
+            return
+    print("Reingested %d fingerprints in %.1f seconds." % (
+        done - rejected, time.time() - start))
+    if rejected:
+        print(str(rejected) + " fingerprints were rejected.")
+
+
+@repro.command('backfill')
+@jobs_option
+@click.option(
+    '--journal', default=FILEHANDLING_CONFIG.get('backfill_journal_path'),
+    help="Journal (sqlite file) of the run; rerun with the same journal to "
+         "resume (default: backfill_journal_path).")
+@click.option(
+    '--version', 'target_version',
+    help="Select the contents whose latest fingerprinting version isn't "
+         "this one (default: the version of the installed "
+         "echoprint-codegen).")
+@click.option(
+    '--state', 'states', multiple=True,
+    default=('fingerprinted', 'dropped'), show_default=True,
+    help="Processing state of the contents to select (repeatable).")
+@click.option(
+    '--rate', default=float(FILEHANDLING_CONFIG.get('backfill_rate') or 0),
+    show_default=True, type=click.FloatRange(min=0),
+    help="Files per second at most, 0 for no limit "
+         "(default: backfill_rate).")
+@click.option(
+    '--reselect', is_flag=True,
+    help="Select the contents again when resuming, to add new matches.")
+@click.option(
+    '--retry-failed', is_flag=True,
+    help="Also process the contents which failed before.")
+def backfill(jobs, journal, target_version, states, rate, reselect,
+             retry_failed):
+    """
+    Fingerprint stored files again, e.g. after a codegen upgrade.
+
+    Selects the audio contents whose latest fingerprint log has another
+    fingerprinting version, fingerprints their files in the fingerprinted
+    and dropped folders, ingests them into the EchoPrint server and logs
+    them, without moving the files or changing their processing state.
+    The selection and the progress are kept in the journal, so a stopped
+    run resumes where it left off. Files locked by the pipeline are left
+    alone and stay pending.
+    """
+    global BACKFILL_JOURNAL, BACKFILL_LIMITER
+    if not journal:
+        print("ERROR: No journal given (--journal or backfill_journal_path).")
+        return
+    BACKFILL_JOURNAL = backfillJournal.BackfillJournal(journal)
+    BACKFILL_LIMITER = backfillJournal.RateLimiter(rate)
+    version = BACKFILL_JOURNAL.get_meta('version')
+    if target_version and version and target_version != version:
+        print(
+            "ERROR: The journal is for version " + version +
+            ", use another journal for version " + target_version + ".")
+        return
 
-    query_request = requests.post(url, data={var_id: track}, verify=False)
+    if version is None or reselect:
+        contents = select_backfill_contents(states)
+        version = (
+            version or target_version or probe_codegen_version(contents))
+        if version is None:
+            print("ERROR: Couldn't determine the codegen version, "
+                  "use --version.")
+            return
+        added = BACKFILL_JOURNAL.add(
+            (uuid, path) for uuid, path, latest in contents
+            if latest != version)
+        BACKFILL_JOURNAL.set_meta('version', version)
+        print("Selected " + str(added) + " contents not fingerprinted "
+              "with version " + version + ".")
+
+    entries = BACKFILL_JOURNAL.pending(retry_failed)
+    print("Backfilling " + str(len(entries)) + " contents.")
+    start = time.time()
+    if jobs > 1 and len(entries) > 1:
+        for _ in pool_map(backfill_content, entries, jobs):
+            pass
+    else:
+        for entry in entries:
+            backfill_content(entry)
+
+    counts = BACKFILL_JOURNAL.counts()
+    print("Backfill after %.1f seconds: %s" % (
+        time.time() - start, ", ".join(
+            state + ": " + str(count)
+            for state, count in sorted(counts.items()))))
+    if counts.get('pending'):
+        print("Run again with the same journal to resume.")
+
+
+@repro.command('identify')
+@click.argument('paths', nargs=-1, type=click.Path(exists=True))
+@click.option(
+    '--from-list', 'clip_list', type=click.File('r'),
+    help="File listing one clip path per line, - for stdin.")
+@click.option(
+    '--output', '-o', default='-', show_default=True,
+    help="File to write the results to, - for stdout.")
+@click.option(
+    '--format', 'output_format', default='jsonl', show_default=True,
+    type=click.Choice(['jsonl', 'csv']),
+    help="Format of the results.")
+@click.option(
+    '--concurrency', default=16, show_default=True,
+    type=click.IntRange(min=1),
+    help="Number of clips to identify at a time.")
+@click.option(
+    '--batch-size', default=200, show_default=True,
+    type=click.IntRange(min=1),
+    help="Number of results per database lookup of the matched contents.")
+def identify(paths, clip_list, output, output_format, concurrency,
+             batch_size):
+    """
+    Identify recorded clips of monitored music use.
 
-    print("status code: " + str(query_request.status_code) + " -- " +
-          query_request.reason)
+    Fingerprints the clips (files, folders of files or listed paths) in
+    parallel, queries the EchoPrint server for each of them and writes a
+    result per clip (clip, track_id, score, content, artist, title,
+    error) in batches, as they come in. Messages go to stderr.
+    """
+    if not paths and clip_list is None:
+        print("ERROR: No clips given (paths or --from-list).")
+        return
+    known = {}  # track id: (content uuid, artist, title)
+    batch = []
+    count = [0, 0]  # clips, matches
+    start = time.time()
+    with click.open_file(output, 'w', encoding='utf-8') as out:
+        if output_format == 'csv':
+            writer = csv.DictWriter(
+                out, fieldnames=IDENTIFY_FIELDS, lineterminator='\n')
+            writer.writeheader()
+            write = writer.writerow
+        else:
+            def write(row):
+                out.write(json.dumps(row) + '\n')
+
+        def flush():
+            write_identified(batch, known, write)
+            out.flush()
+            del batch[:]
+
+        def emit(result):
+            count[0] += 1
+            count[1] += bool(result['track_id'])
+            batch.append(result)
+            if len(batch) >= batch_size:
+                flush()
+                print("Identified %d clips (%.0f/s)" % (
+                    count[0], count[0] / (time.time() - start)))
+
+        with contextlib.redirect_stdout(sys.stderr):
+            asyncio.run(identify_clips(
+                clip_paths(paths, clip_list), concurrency, emit))
+            flush()
+            print("Identified %d clips, %d matched, in %.1f seconds." % (
+                count[0], count[1], time.time() - start))
+
+
+@repro.command('codegen-stats')
+@click.option(
+    '--hours', default=24.0, show_default=True,
+    help="Only look at the codegen runs of the last hours, 0 for all.")
+def codegen_stats(hours):
+    """
+    Show the number and latency of the recent echoprint-codegen runs.
+    """
+    if not CODEGEN_RUNNER.stats_path:
+        print("ERROR: codegen_stats_path isn't configured.")
+        return
+    since = time.time() - hours * 3600 if hours else 0
+    try:
+        stats = codegenRunner.read_stats(CODEGEN_RUNNER.stats_path, since)
+    except IOError as e:
+        print("ERROR: Couldn't read codegen stats: " + str(e))
+        return
+    if stats is None:
+        print("No codegen runs recorded.")
+        return
+    print("Runs: " + str(stats['runs']) + " (" + ", ".join(
+        status + ": " + str(count)
+        for status, count in sorted(stats['statuses'].items())) + ")")
+    print("Latency: p50 %.1fs, p90 %.1fs, p99 %.1fs, max %.1fs" % (
+        stats['p50'], stats['p90'], stats['p99'], stats['max']))
 
 
 @repro.command('all')
+@jobs_option
 @click.pass_context
-def all(ctx):
+def all(ctx, jobs):
     """
     Apply all processing steps.
 
     Looks for new files to be previed after each processing step.
     """
-    ctx.invoke(preview)
-    ctx.invoke(checksum)
-    ctx.invoke(preview)
-    ctx.invoke(fingerprint)
-    ctx.invoke(drop)
-    ctx.invoke(preview)
+    if FUSED_PIPELINE:
+        ctx.invoke(fused, jobs=jobs)
+        ctx.invoke(checksum, jobs=jobs)
+        ctx.invoke(fingerprint, jobs=jobs)
+        ctx.invoke(drop, jobs=jobs)
+        ctx.invoke(fused, jobs=jobs)
+        return
+    ctx.invoke(preview, jobs=jobs)
+    ctx.invoke(checksum, jobs=jobs)
+    ctx.invoke(preview, jobs=jobs)
+    ctx.invoke(fingerprint, jobs=jobs)
+    ctx.invoke(drop, jobs=jobs)
+    ctx.invoke(preview, jobs=jobs)
 
 
 @repro.command('loop')
+@jobs_option
 @click.pass_context
-def loop(ctx):
+def loop(ctx, jobs):
     """
     Apply all processing steps in an endless loop.
     """
     while True:
-        ctx.invoke(all)
+        ctx.invoke(all, jobs=jobs)
         time_to_wait_between_cycles = 10
         print(
             'Waiting for ' +
@@ -1319,6 +3134,108 @@ def loop(ctx):
         print('entering new processing cycle')
 
 
+@repro.command('watch')
+@jobs_option
+@click.option(
+    '--rescan-interval', default=300, show_default=True,
+    type=click.IntRange(min=1),
+    help="Seconds between full rescans catching missed events.")
+def watch(jobs, rescan_interval):
+    """
+    Apply all processing steps as soon as files arrive.
+
+    Reacts to inotify events in the processing folders instead of polling.
+    Changes done by other hosts on network storage don't raise events, so
+    the folders are fully rescanned every rescan_interval seconds. Files
+    of events and rescans go to the same pool of jobs workers; events for
+    files already queued, locked by another worker or gone are ignored.
+    """
+    stages = {}
+    for processing_step_func, srcdir, destdir in processing_stages():
+        srcdir = os.path.normpath(srcdir)
+        if ensure_path_exists(srcdir) is None:
+            print("ERROR: '" + srcdir + "' couldn't be created.")
+            return
+        stages[srcdir] = (processing_step_func, destdir)
+    watcher = fileWatcher.StageWatcher(stages.keys())
+    pool = None
+    if jobs > 1:
+        pool = new_pool(jobs)
+    # path: AsyncResult of the files queued in the pool
+    in_flight = {}
+
+    def reap():
+        for path, result in list(in_flight.items()):
+            if not result.ready():
+                continue
+            del in_flight[path]
+            try:
+                response = result.get()
+            except Exception:
+                print("ERROR: Processing of '" + path + "' failed:")
+                traceback.print_exc()
+                continue
+            pool_result(pool, response)
+
+    def submit(candidate):
+        path = os.path.join(candidate[1], candidate[3])
+        if path in in_flight:
+            return
+        if pool:
+            in_flight[path] = pool.apply_async(
+                _call_in_pool, ((_process_file_in_pool, candidate),))
+        else:
+            process_file_locked(*candidate)
+
+    try:
+        next_rescan = 0
+        while True:
+            reap()
+            if time.time() >= next_rescan:
+                print('entering full rescan')
+                for processing_step_func, srcdir, destdir in (
+                        processing_stages()):
+                    if PENDING_INDEX is not None:
+                        PENDING_INDEX.invalidate(srcdir)
+                    if processing_step_func is fingerprint_audiofile:
+                        reconcile_deferred(srcdir)
+                    for candidate in stage_candidates(
+                            processing_step_func, os.path.normpath(srcdir),
+                            destdir) or []:
+                        submit(candidate)
+                next_rescan = time.time() + rescan_interval
+            timeout = max(0, next_rescan - time.time())
+            if in_flight:
+                timeout = min(timeout, 1)
+            overflow, files = watcher.events(timeout)
+            if overflow:
+                print("WARNING: inotify queue overflow, rescanning")
+                next_rescan = 0
+            reap()
+            for stage_dir, root, audiofile in files:
+                if uuid4hex.match(audiofile) is None:
+                    continue
+                # e.g. the temporary renaming for taglib in the preview
+                # stage raises events for the file being processed
+                path = os.path.join(root, audiofile)
+                if (path in in_flight or not os.path.isfile(path) or
+                        file_is_locked(path)):
+                    continue
+                if PENDING_INDEX is not None:
+                    PENDING_INDEX.add(path)
+                processing_step_func, destdir = stages[stage_dir]
+                destsubdir = root.replace(stage_dir, destdir, 1)
+                if ensure_path_exists(destsubdir) is None:
+                    print("ERROR: '" + destsubdir + "' couldn't be created.")
+                    continue
+                submit((processing_step_func, root, destsubdir, audiofile))
+    finally:
+        watcher.close()
+        if pool:
+            pool.close()
+            pool.join()
+
+
 def connect_db():
     """
     get access to database
@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+# For copyright and license terms, see COPYRIGHT.rst (top level of repository)
+# Repository: https://github.com/C3S/collecting_society_worker
+
+"""
+The one and only C3S local similarity index of EchoPrint codes
+"""
+
+
+import os
+import json
+import uuid
+import fcntl
+import contextlib
+
+import numpy
+
+
+class SimilarityIndex(object):
+    """
+    Local inverted index of the codes of ingested fingerprints.
+
+    The postings (code, time, track number) are stored in the directory
+    path in segments, uint32 arrays of shape (3, n) sorted by code, which
+    are memory-mapped for queries. Each added track gets a small segment
+    of its own; the newest segments are merged like a binary counter, so
+    there are O(log n) of them. The track numbers map to the track ids
+    and metadata in an append-only log. Workers sharing the directory
+    see each other's updates.
+
+    A query counts the codes each track shares with the query per time
+    offset (in bins of slop time units) and scores the track with its
+    largest count, like the EchoPrint server does.
+    """
+
+    def __init__(self, path, slop=2):
+        self.path = path
+        self.slop = slop
+        self._manifest = None  # (inode, mtime) of the loaded manifest
+        self._segments = []  # (filename, memory-mapped postings)
+        self._tracks = {}  # track number: (track id, metadata)
+        self._numbers = {}  # track id: current track number
+        self._alive = numpy.zeros(0, dtype=bool)  # by track number
+        self._log_offset = 0
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    @contextlib.contextmanager
+    def _locked(self, operation=fcntl.LOCK_EX):
+        with open(os.path.join(self.path, 'index.lock'), 'w+') as lockfile:
+            fcntl.flock(lockfile, operation)
+            try:
+                yield
+            finally:
+                fcntl.flock(lockfile, fcntl.LOCK_UN)
+
+    def _refresh(self):
+        # new entries of the track log
+        logpath = os.path.join(self.path, 'tracks.log')
+        if os.path.exists(logpath):
+            with open(logpath, 'rb') as log:
+                log.seek(self._log_offset)
+                data = log.read()
+            data = data[:data.rfind(b'\n') + 1]  # complete lines only
+            self._log_offset += len(data)
+            for line in data.splitlines():
+                entry = json.loads(line.decode('utf-8'))
+                if entry.get('deleted'):
+                    self._numbers.pop(entry['id'], None)
+                else:
+                    self._tracks[entry['n']] = (entry['id'], entry['meta'])
+                    self._numbers[entry['id']] = entry['n']
+            if data:
+                self._alive = numpy.zeros(
+                    max(self._tracks) + 1 if self._tracks else 0, dtype=bool)
+                self._alive[list(self._numbers.values())] = True
+        # changed segments
+        manifestpath = os.path.join(self.path, 'manifest.json')
+        try:
+            statinfo = os.stat(manifestpath)
+        except OSError:
+            return
+        if self._manifest == (statinfo.st_ino, statinfo.st_mtime_ns):
+            return
+        with open(manifestpath) as manifest:
+            names = json.load(manifest)['segments']
+        loaded = dict(self._segments)
+        self._segments = [
+            (name, loaded[name] if name in loaded else numpy.load(
+                os.path.join(self.path, name), mmap_mode='r'))
+            for name in names]
+        self._manifest = (statinfo.st_ino, statinfo.st_mtime_ns)
+
+    def _write_segment(self, postings):
+        name = 'segment-' + uuid.uuid4().hex + '.npy'
+        temppath = os.path.join(self.path, '.' + name)
+        numpy.save(temppath, postings)
+        os.rename(temppath, os.path.join(self.path, name))
+        return name, numpy.load(os.path.join(self.path, name), mmap_mode='r')
+
+    def _write_manifest(self):
+        temppath = os.path.join(self.path, '.manifest.json')
+        with open(temppath, 'w') as manifest:
+            json.dump({'segments': [name for name, _ in self._segments]},
+                      manifest)
+        os.rename(temppath, os.path.join(self.path, 'manifest.json'))
+
+    def _live(self, numbers):
+        live = numbers < len(self._alive)
+        live[live] = self._alive[numbers[live]]
+        return live
+
+    def _merge(self, first, second):
+        postings = numpy.concatenate((first, second), axis=1)
+        tracks = numpy.unique(postings[2])
+        postings = postings[:, numpy.isin(
+            postings[2], tracks[self._live(tracks)])]
+        return postings[:, numpy.argsort(postings[0], kind='stable')]
+
+    def add(self, track_id, times, codes, metadata=None):
+        """
+        Adds (or replaces) the codes of a track.
+        """
+        with self._locked():
+            self._refresh()
+            number = max(self._tracks) + 1 if self._tracks else 0
+            postings = numpy.empty((3, len(codes)), dtype=numpy.uint32)
+            postings[0] = codes
+            postings[1] = times
+            postings[2] = number
+            postings = postings[:, numpy.argsort(postings[0], kind='stable')]
+            self._segments.append(self._write_segment(postings))
+            entry = {'n': number, 'id': track_id, 'meta': metadata or {}}
+            with open(os.path.join(self.path, 'tracks.log'), 'ab') as log:
+                log.write(json.dumps(entry).encode('utf-8') + b'\n')
+            self._refresh()
+            obsolete = []
+            while (len(self._segments) > 1 and
+                    self._segments[-2][1].shape[1] <=
+                    2 * self._segments[-1][1].shape[1]):
+                second = self._segments.pop()
+                first = self._segments.pop()
+                self._segments.append(
+                    self._write_segment(self._merge(first[1], second[1])))
+                obsolete += [first[0], second[0]]
+            self._write_manifest()
+            for name in obsolete:
+                # other workers may still have it mapped, that's fine;
+                # segments are only mapped under the lock
+                os.remove(os.path.join(self.path, name))
+
+    def remove(self, track_id):
+        """
+        Removes a track; its codes are dropped by the next merge.
+        """
+        with self._locked():
+            with open(os.path.join(self.path, 'tracks.log'), 'ab') as log:
+                log.write(json.dumps(
+                    {'id': track_id, 'deleted': True}).encode('utf-8') + b'\n')
+            self._refresh()
+
+    def __len__(self):
+        with self._locked(fcntl.LOCK_SH):
+            self._refresh()
+        return len(self._numbers)
+
+    def query(self, times, codes, count=1):
+        """
+        Returns the (track id, score, metadata) of the count best matching
+        tracks for the codes of a query, best first.
+        """
+        # add() removes the merged segments after writing the manifest
+        with self._locked(fcntl.LOCK_SH):
+            self._refresh()
+        codes = numpy.asarray(codes, dtype=numpy.uint32)
+        times = numpy.asarray(times, dtype=numpy.int64)
+        keys = []
+        for _, postings in self._segments:
+            begin = postings[0].searchsorted(codes, 'left')
+            matches = postings[0].searchsorted(codes, 'right') - begin
+            total = int(matches.sum())
+            if not total:
+                continue
+            # positions of all postings of all query codes
+            positions = numpy.arange(total) + numpy.repeat(
+                begin - (numpy.cumsum(matches) - matches), matches)
+            offsets = (
+                postings[1][positions].astype(numpy.int64) -
+                numpy.repeat(times, matches)) // self.slop
+            keys.append(
+                (postings[2][positions].astype(numpy.int64) << 32) |
+                (offsets & 0xffffffff))
+        if not keys:
+            return []
+        keys, counts = numpy.unique(
+            numpy.concatenate(keys), return_counts=True)
+        numbers = keys >> 32
+        # the keys are sorted by track, the best offset of each track
+        starts = numpy.flatnonzero(
+            numpy.concatenate(([True], numbers[1:] != numbers[:-1])))
+        scores = numpy.maximum.reduceat(counts, starts)
+        numbers = numbers[starts]
+        live = self._live(numbers)
+        numbers = numbers[live]
+        scores = scores[live]
+        best = numpy.argsort(-scores, kind='stable')[:count]
+        return [
+            (self._tracks[number][0], int(score), self._tracks[number][1])
+            for number, score in zip(
+                numbers[best].tolist(), scores[best].tolist())]
+
+    def best_match(self, times, codes, min_score=10):
+        """
+        Answers a query like the /query API of the EchoPrint server.
+        """
+        results = self.query(times, codes)
+        if not results or results[0][1] < min_score:
+            return {
+                'match': False,
+                'score': results[0][1] if results else 0}
+        track_id, score, metadata = results[0]
+        result = dict(metadata)
+        result.update(match=True, score=score, track_id=track_id)
+        return result
@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+# For copyright and license terms, see COPYRIGHT.rst (top level of repository)
+# Repository: https://github.com/C3S/collecting_society_worker
+
+"""
+The one and only C3S sqlite files shared by the worker processes
+"""
+
+
+import os
+import sqlite3
+import threading
+
+
+class SQLiteDatabase(object):
+    """
+    Base of the sqlite files shared by worker processes and threads.
+
+    _db() returns the connection of the calling process and thread,
+    opened on first use in WAL mode, so readers don't block the writer,
+    and creating the tables with the statements in schema.
+    """
+
+    schema = ()
+
+    def __init__(self, database):
+        self.database = database
+        self._local = threading.local()
+
+    def _db(self):
+        # sqlite connections must not be shared with forked workers
+        # or other threads
+        local = self._local
+        if getattr(local, 'pid', None) != os.getpid():
+            local.connection = sqlite3.connect(self.database, timeout=30)
+            local.pid = os.getpid()
+            local.connection.execute('PRAGMA journal_mode=WAL')
+            with local.connection:
+                for statement in self.schema:
+                    local.connection.execute(statement)
+        return local.connection
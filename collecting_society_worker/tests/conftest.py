@@ -0,0 +1,42 @@
+#!/usr/bin/python
+# For copyright and license terms, see COPYRIGHT.rst (top level of repository)
+# Repository: https://github.com/C3S/collecting_society_worker
+
+"""Fixtures shared by the tests"""
+
+import pytest
+
+from collecting_society_worker import echoprintStandin
+
+
+@pytest.fixture
+def echoprint_server(request):
+    """
+    Local EchoPrint stand-in server (echoprintStandin.StandinServer).
+
+    Parametrize indirectly with a dict of StandinServer options to inject
+    latency, failures or a throughput limit, e.g.:
+
+        @pytest.mark.parametrize(
+            'echoprint_server', [{'error_rate': 0.5}], indirect=True)
+    """
+    server = echoprintStandin.StandinServer(
+        **getattr(request, 'param', {})).start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def echoprint_standin(echoprint_server, monkeypatch):
+    """
+    Points the worker (repro.py) to the echoprint_server stand-in.
+
+    Opt-in: tests not asking for it use the EchoPrint server of
+    config.ini.
+    """
+    from collecting_society_worker import repro
+    monkeypatch.setattr(repro, 'ECHOPRINT_URL', echoprint_server.url)
+    monkeypatch.setattr(repro.ECHOPRINT_CLIENT, 'url', echoprint_server.url)
+    monkeypatch.setitem(
+        repro.ECHOPRINT_CONFIG, 'token', echoprint_server.token)
+    return echoprint_server
@@ -0,0 +1,176 @@
+#!/usr/bin/python
+# For copyright and license terms, see COPYRIGHT.rst (top level of repository)
+# Repository: https://github.com/C3S/collecting_society_worker
+
+"""Test the backfill command against the EchoPrint stand-in server"""
+
+import fcntl
+import json
+import os
+import random
+import time
+import types
+import uuid
+
+import pytest
+from click.testing import CliRunner
+
+from collecting_society_worker import (
+    backfillJournal,
+    echoprintCodes,
+    repro,
+    trytonAccess,
+)
+
+
+def code_string(seed, count=200):
+    generator = random.Random(seed)
+    times = [10 * i for i in range(count)]
+    codes = [generator.randrange(1 << 20) for _ in range(count)]
+    return echoprintCodes.encode_code_string(times, codes)
+
+
+@pytest.fixture
+def storage(echoprint_standin, tmp_path, monkeypatch):
+    """
+    Storage in tmp_path with the contents selected for the backfill
+    (storage.contents: name: uuid):
+
+    - stored: fingerprinted file
+    - dropped: dropped file
+    - disembodied: dropped file overwritten with its filename
+    - gone: no file
+    - unknown: fingerprinted file without a content record
+    - current: fingerprinted with the target version 4.12 already
+
+    The fingerprint logs are recorded in storage.logs.
+    """
+    monkeypatch.setattr(repro, 'STORAGE_BASE_PATH', str(tmp_path))
+    monkeypatch.setattr(repro, 'FINGERPRINT_STORE', None)
+    monkeypatch.setattr(repro, 'SIMILARITY_INDEX', None)
+    monkeypatch.setattr(repro, 'ECHOPRINT_BREAKER', None)
+    monkeypatch.setattr(repro.ECHOPRINT_CLIENT, 'breaker', None)
+    contents = dict(
+        (name, str(uuid.uuid4())) for name in (
+            'stored', 'dropped', 'disembodied', 'gone', 'unknown',
+            'current'))
+    selection = []
+    for name, filename in contents.items():
+        stage = 'dropped_path' if name in (
+            'dropped', 'disembodied') else 'fingerprinted_path'
+        path = os.path.join(
+            str(tmp_path), repro.FILEHANDLING_CONFIG[stage], 'user')
+        os.makedirs(path, exist_ok=True)
+        if name != 'gone':
+            with open(os.path.join(path, filename), 'w') as audiofile:
+                audiofile.write(
+                    filename if name == 'disembodied' else 'audio')
+        selection.append((
+            filename, os.path.join(path, filename),
+            '4.12' if name == 'current' else '4.11'))
+    monkeypatch.setattr(
+        repro, 'select_backfill_contents', lambda states: selection)
+    monkeypatch.setattr(
+        trytonAccess, 'get_content_by_filename',
+        lambda filename: None if filename == contents['unknown'] else
+        types.SimpleNamespace(uuid=filename, length=30))
+    monkeypatch.setattr(
+        repro, 'creation_metadata',
+        lambda content: ("Artist", "Release", "Title"))
+    monkeypatch.setattr(
+        repro, 'codegen_audiofile',
+        lambda filepath, filename, length: json.dumps([{
+            'code': code_string(filename),
+            'metadata': {'version': 4.12}}]))
+    logs = []
+    monkeypatch.setattr(
+        repro, 'save_fingerprintlog',
+        lambda content, version: logs.append((content.uuid, version)) or
+        True)
+    return types.SimpleNamespace(
+        path=tmp_path, contents=contents, logs=logs,
+        journal=str(tmp_path / 'journal.db'))
+
+
+def journal_states(storage):
+    journal = backfillJournal.BackfillJournal(storage.journal)
+    states = dict(
+        (name, journal._db().execute(
+            'SELECT state FROM contents WHERE uuid = ?',
+            (filename,)).fetchone())
+        for name, filename in storage.contents.items())
+    return dict(
+        (name, state[0] if state else None)
+        for name, state in states.items())
+
+
+def test_backfill(storage, echoprint_standin):
+    result = CliRunner().invoke(
+        repro.backfill, ['--journal', storage.journal, '--version', '4.12'])
+    assert result.exit_code == 0, result.output
+    assert 'Selected 5 contents' in result.output
+    assert 'done: 2, failed: 1, missing: 2' in result.output
+    assert journal_states(storage) == {
+        'stored': 'done', 'dropped': 'done', 'disembodied': 'missing',
+        'gone': 'missing', 'unknown': 'failed', 'current': None}
+    assert sorted(storage.logs) == sorted(
+        (storage.contents[name], '4.12') for name in ('stored', 'dropped'))
+    assert sorted(echoprint_standin.tracks) == sorted(
+        storage.contents[name].replace('-', '')
+        for name in ('stored', 'dropped'))
+
+    # resuming leaves the finished contents alone
+    result = CliRunner().invoke(
+        repro.backfill, ['--journal', storage.journal])
+    assert 'Backfilling 0 contents.' in result.output
+    result = CliRunner().invoke(
+        repro.backfill, ['--journal', storage.journal, '--retry-failed'])
+    assert 'Backfilling 1 contents.' in result.output
+    assert echoprint_standin.requests['/ingest'] == 2
+
+
+def test_pending(storage, echoprint_standin):
+    stored = os.path.join(
+        str(storage.path), repro.FILEHANDLING_CONFIG['fingerprinted_path'],
+        'user', storage.contents['stored'])
+    echoprint_standin.error_rate = 1.0
+    with open(stored + '.lock', 'w') as lockfile:
+        # in process by the pipeline
+        fcntl.flock(lockfile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        result = CliRunner().invoke(
+            repro.backfill,
+            ['--journal', storage.journal, '--version', '4.12'])
+    assert result.exit_code == 0, result.output
+    assert journal_states(storage)['stored'] == 'pending'
+    assert journal_states(storage)['dropped'] == 'pending'
+    assert 'Run again with the same journal to resume.' in result.output
+    assert storage.logs == []
+
+    echoprint_standin.error_rate = 0
+    result = CliRunner().invoke(
+        repro.backfill, ['--journal', storage.journal])
+    assert 'Backfilling 2 contents.' in result.output
+    assert journal_states(storage)['stored'] == 'done'
+    assert journal_states(storage)['dropped'] == 'done'
+
+
+@pytest.mark.parametrize('jobs', ['1', '3'])
+def test_rate(storage, monkeypatch, jobs):
+    monkeypatch.setattr(repro, 'connect_db', lambda: None)
+    start = time.time()
+    result = CliRunner().invoke(repro.backfill, [
+        '--journal', storage.journal, '--version', '4.12', '--rate', '10',
+        '--jobs', jobs])
+    assert result.exit_code == 0, result.output
+    assert 'done: 2, failed: 1, missing: 2' in result.output
+    # the workers share the limit, the first of the 5 contents goes
+    # right away
+    assert time.time() - start >= 0.4
+
+
+def test_journal_of_another_version(storage):
+    journal = backfillJournal.BackfillJournal(storage.journal)
+    journal.set_meta('version', '4.11')
+    result = CliRunner().invoke(
+        repro.backfill, ['--journal', storage.journal, '--version', '4.12'])
+    assert 'ERROR: The journal is for version 4.11' in result.output
@@ -0,0 +1,84 @@
+#!/usr/bin/python
+# For copyright and license terms, see COPYRIGHT.rst (top level of repository)
+# Repository: https://github.com/C3S/collecting_society_worker
+
+"""Test the delete command against the EchoPrint stand-in server"""
+
+import random
+
+import pytest
+from click.testing import CliRunner
+
+from collecting_society_worker import (
+    deferredQueue,
+    echoprintCodes,
+    fingerprintStore,
+    repro,
+    similarityIndex,
+)
+
+
+def code_string(seed, count=200):
+    generator = random.Random(seed)
+    times = [10 * i for i in range(count)]
+    codes = [generator.randrange(1 << 20) for _ in range(count)]
+    return echoprintCodes.encode_code_string(times, codes)
+
+
+@pytest.fixture
+def worker(echoprint_standin, tmp_path, monkeypatch):
+    """
+    repro with a fingerprint store and a similarity index in tmp_path
+    and the tracks 'a', 'b' and 'c' ingested to the stand-in
+    """
+    store = fingerprintStore.FingerprintStore(str(tmp_path / 'store'))
+    index = similarityIndex.SimilarityIndex(str(tmp_path / 'index'))
+    monkeypatch.setattr(repro, 'FINGERPRINT_STORE', store)
+    monkeypatch.setattr(repro, 'SIMILARITY_INDEX', index)
+    monkeypatch.setattr(repro, 'ECHOPRINT_BREAKER', None)
+    monkeypatch.setattr(repro.ECHOPRINT_CLIENT, 'breaker', None)
+    for seed, track_id in enumerate('abc'):
+        code = code_string(seed)
+        assert repro.ECHOPRINT_CLIENT.ingest(
+            {'track_id': track_id, 'fp_code': code}).status_code == 200
+        store.append(track_id, '4.12', code)
+        index.add(track_id, *echoprintCodes.decode_code_arrays(code))
+    return echoprint_standin
+
+
+def test_delete(worker):
+    result = CliRunner().invoke(
+        repro.delete, ['a', 'x', '--from-list', '-', '--concurrency', '2'],
+        input='c\n')
+    assert result.exit_code == 0, result.output
+    assert 'a: deleted' in result.output
+    assert 'c: deleted' in result.output
+    assert 'x: not found' in result.output
+    assert 'deleted: 2, not found: 1' in result.output
+    assert list(worker.tracks) == ['b']
+    assert [
+        record['track_id'] for record in repro.FINGERPRINT_STORE] == ['b']
+    assert len(repro.SIMILARITY_INDEX) == 1
+
+
+def test_dry_run(worker):
+    result = CliRunner().invoke(repro.delete, ['a', '--dry-run'])
+    assert result.exit_code == 0, result.output
+    assert result.output == 'a\n'
+    assert sorted(worker.tracks) == ['a', 'b', 'c']
+
+
+def test_stop_when_breaker_opens(worker, tmp_path, monkeypatch):
+    worker.error_rate = 1.0
+    breaker = deferredQueue.CircuitBreaker(
+        str(tmp_path / 'breaker.db'), threshold=1)
+    monkeypatch.setattr(repro, 'ECHOPRINT_BREAKER', breaker)
+    monkeypatch.setattr(repro.ECHOPRINT_CLIENT, 'breaker', breaker)
+    ids = ['t%d' % number for number in range(20)]
+    result = CliRunner().invoke(
+        repro.delete, ids + ['--concurrency', '1'])
+    assert result.exit_code == 0, result.output
+    # one request fails and opens the circuit, the queued one is refused
+    assert worker.requests['/delete'] == 1
+    assert 'failed: 2, not sent: 18' in result.output
+    assert sorted(worker.tracks) == ['a', 'b', 'c']
@@ -0,0 +1,119 @@
+#!/usr/bin/python
+# For copyright and license terms, see COPYRIGHT.rst (top level of repository)
+# Repository: https://github.com/C3S/collecting_society_worker
+
+"""Test the identify command against the EchoPrint stand-in server"""
+
+import asyncio
+import json
+import os
+import random
+import types
+import uuid
+
+import pytest
+from click.testing import CliRunner
+
+from collecting_society_worker import echoprintCodes, repro, trytonAccess
+
+CONTENT = str(uuid.uuid4())
+TRACK_ID = CONTENT.replace('-', '')
+
+
+def code_string(seed, count=200):
+    generator = random.Random(seed)
+    times = [10 * i for i in range(count)]
+    codes = [generator.randrange(1 << 20) for _ in range(count)]
+    return echoprintCodes.encode_code_string(times, codes)
+
+
+@pytest.fixture
+def clips(echoprint_standin, tmp_path, monkeypatch):
+    """
+    Clips in tmp_path, whose fingerprint is their seed: 'match' of the
+    track CONTENT ingested to the stand-in, 'other' of an unknown track
+    and 'empty' without a fingerprint; the database lookups of the
+    matches are recorded in clips.lookups.
+    """
+    monkeypatch.setattr(repro, 'connect_db', lambda: None)
+    monkeypatch.setattr(repro.ECHOPRINT_CLIENT, 'breaker', None)
+
+    def codegen_clip(clip):
+        with open(clip) as seed:
+            return code_string(seed.read()) if os.path.getsize(clip) else None
+
+    monkeypatch.setattr(repro, 'codegen_clip', codegen_clip)
+    assert repro.ECHOPRINT_CLIENT.ingest({
+        'track_id': TRACK_ID, 'fp_code': code_string('match'),
+        'artist': "Server Artist", 'track': "Server Title",
+        }).status_code == 200
+    for name in ('match', 'other', 'empty'):
+        (tmp_path / name).write_text('' if name == 'empty' else name)
+
+    lookups = []
+    creation = types.SimpleNamespace(
+        title="Title", artist=types.SimpleNamespace(name="Artist"))
+    content = types.SimpleNamespace(
+        id=1, uuid=CONTENT, creation=types.SimpleNamespace(id=2))
+
+    def get_contents_by_filenames(filenames):
+        try:
+            asyncio.get_running_loop()
+            lookups.append('in event loop')
+        except RuntimeError:
+            lookups.append(sorted(filenames))
+        return dict((name, content) for name in filenames if name == CONTENT)
+
+    monkeypatch.setattr(
+        trytonAccess, 'get_contents_by_filenames', get_contents_by_filenames)
+    monkeypatch.setattr(
+        trytonAccess, 'get_creations_by_contents',
+        lambda contents: dict((item.id, creation) for item in contents))
+    return types.SimpleNamespace(
+        path=tmp_path, lookups=lookups, server=echoprint_standin)
+
+
+def test_identify(clips):
+    result = CliRunner().invoke(
+        repro.identify, [str(clips.path), '--batch-size', '1'])
+    assert result.exit_code == 0, result.stderr
+    rows = dict(
+        (row.pop('clip'), row)
+        for row in map(json.loads, result.stdout.splitlines()))
+    assert rows[str(clips.path / 'match')] == {
+        'track_id': TRACK_ID, 'score': 200, 'content': CONTENT,
+        'artist': "Artist", 'title': "Title", 'error': None}
+    assert rows[str(clips.path / 'other')]['track_id'] is None
+    assert rows[str(clips.path / 'empty')]['error'] == "no fingerprint"
+    assert 'Identified 3 clips, 1 matched' in result.stderr
+    # a lookup per batch, outside of the event loop
+    assert len(clips.lookups) == 4
+    assert [CONTENT] in clips.lookups
+    assert 'in event loop' not in clips.lookups
+
+
+def test_identify_csv(clips):
+    result = CliRunner().invoke(
+        repro.identify, [str(clips.path / 'match'), '--format', 'csv'])
+    assert result.exit_code == 0, result.stderr
+    assert result.stdout.splitlines() == [
+        'clip,track_id,score,content,artist,title,error',
+        '%s,%s,200,%s,Artist,Title,' % (
+            clips.path / 'match', TRACK_ID, CONTENT)]
+
+
+def test_server_failure(clips):
+    clips.server.error_rate = 1.0
+    clip_list = ''.join(
+        str(clips.path / name) + '\n' for name in ('match', 'other'))
+    result = CliRunner().invoke(
+        repro.identify, ['--from-list', '-', '--format', 'csv'],
+        input=clip_list)
+    assert result.exit_code == 0, result.stderr
+    rows = result.stdout.splitlines()[1:]
+    assert sorted(rows) == sorted(
+        '%s,,0,,,,EchoPrint server response code 503: %s' % (
+            clips.path / name, "Service Unavailable")
+        for name in ('match', 'other'))
+    assert 'Identified 2 clips, 0 matched' in result.stderr
+    assert clips.lookups == [[]]
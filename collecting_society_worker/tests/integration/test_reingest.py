@@ -0,0 +1,103 @@
+#!/usr/bin/python
+# For copyright and license terms, see COPYRIGHT.rst (top level of repository)
+# Repository: https://github.com/C3S/collecting_society_worker
+
+"""Test the reingest command against the EchoPrint stand-in server"""
+
+import random
+
+import pytest
+from click.testing import CliRunner
+
+from collecting_society_worker import (
+    backfillJournal,
+    echoprintCodes,
+    fingerprintStore,
+    repro,
+    similarityIndex,
+)
+
+
+def code_string(seed, count=200):
+    generator = random.Random(seed)
+    times = [10 * i for i in range(count)]
+    codes = [generator.randrange(1 << 20) for _ in range(count)]
+    return echoprintCodes.encode_code_string(times, codes)
+
+
+@pytest.fixture
+def store(echoprint_standin, tmp_path, monkeypatch):
+    """
+    Fingerprint store in tmp_path of the tracks 't0' to 't4', of which
+    't2' has an invalid code; the similarity index is empty.
+    """
+    store = fingerprintStore.FingerprintStore(str(tmp_path / 'store'))
+    for number in range(5):
+        store.append(
+            't%d' % number, '4.12',
+            'invalid' if number == 2 else code_string(number),
+            {'artist': "Artist %d" % number})
+    monkeypatch.setattr(repro, 'FINGERPRINT_STORE', store)
+    monkeypatch.setattr(
+        repro, 'SIMILARITY_INDEX',
+        similarityIndex.SimilarityIndex(str(tmp_path / 'index')))
+    monkeypatch.setattr(repro, 'INGEST_BATCH_API', True)
+    monkeypatch.setattr(repro.ECHOPRINT_CLIENT, 'breaker', None)
+    return store
+
+
+def test_reingest(store, echoprint_standin):
+    result = CliRunner().invoke(
+        repro.reingest, ['--batch-size', '2', '--similarity-index'])
+    assert result.exit_code == 0, result.output
+    # the batch of the invalid code is retried one by one
+    assert 'rejected track t2: 400' in result.output
+    assert 'Reingested 4 fingerprints' in result.output
+    assert '1 fingerprints were rejected.' in result.output
+    assert echoprint_standin.requests['/ingest'] == 5
+    assert sorted(echoprint_standin.tracks) == ['t0', 't1', 't3', 't4']
+    assert echoprint_standin.tracks['t4']['artist'] == "Artist 4"
+    assert len(repro.SIMILARITY_INDEX) == 4
+
+
+def test_resume(store, echoprint_standin, tmp_path):
+    journal = str(tmp_path / 'journal.db')
+    result = CliRunner().invoke(repro.reingest, ['--journal', journal])
+    assert result.exit_code == 0, result.output
+    assert echoprint_standin.requests['/ingest'] == 5
+
+    store.append('t5', '4.12', code_string(5))
+    result = CliRunner().invoke(repro.reingest, ['--journal', journal])
+    assert result.exit_code == 0, result.output
+    assert 'Resuming with 1 fingerprints.' in result.output
+    assert 'Reingested 1 fingerprints' in result.output
+    assert echoprint_standin.requests['/ingest'] == 6
+    assert 't5' in echoprint_standin.tracks
+
+
+def test_stop_when_server_fails(store, echoprint_standin, tmp_path):
+    journal = str(tmp_path / 'journal.db')
+    echoprint_standin.error_rate = 1.0
+    result = CliRunner().invoke(
+        repro.reingest, ['--journal', journal, '--batch-size', '2'])
+    assert result.exit_code == 0, result.output
+    assert 'EchoPrint server response code 503' in result.output
+    assert 'Stopped after 0 of 5 fingerprints.' in result.output
+    assert 'Run again with the same journal to resume.' in result.output
+    assert backfillJournal.BackfillJournal(journal).get_meta(
+        'reingest_offset') is None
+
+    echoprint_standin.error_rate = 0
+    result = CliRunner().invoke(
+        repro.reingest, ['--journal', journal, '--batch-size', '2'])
+    assert result.exit_code == 0, result.output
+    assert 'Reingested 4 fingerprints' in result.output
+    assert sorted(echoprint_standin.tracks) == ['t0', 't1', 't3', 't4']
+
+
+def test_journal_of_another_server(store, tmp_path):
+    journal = backfillJournal.BackfillJournal(str(tmp_path / 'journal.db'))
+    journal.set_meta('reingest_url', 'http://elsewhere/')
+    result = CliRunner().invoke(
+        repro.reingest, ['--journal', str(tmp_path / 'journal.db')])
+    assert 'ERROR: The journal is for http://elsewhere/' in result.output
@@ -0,0 +1,28 @@
+#!/usr/bin/python
+# For copyright and license terms, see COPYRIGHT.rst (top level of repository)
+# Repository: https://github.com/C3S/collecting_society_worker
+
+"""Test the pool of worker processes of the --jobs option"""
+
+import pytest
+
+from collecting_society_worker import repro
+
+
+def square(number):
+    return number * number
+
+
+def test_pool_map(monkeypatch):
+    monkeypatch.setattr(repro, 'connect_db', lambda: None)
+    assert sorted(repro.pool_map(square, [1, 2, 3], 2)) == [1, 4, 9]
+
+
+def test_pool_without_database(monkeypatch):
+    def connect_db():
+        exit("Database connection could not be established")
+    monkeypatch.setattr(repro, 'connect_db', connect_db)
+    with pytest.raises(SystemExit) as excinfo:
+        list(repro.pool_map(square, [1, 2, 3], 2))
+    assert excinfo.value.code == (
+        "Database connection could not be established")
@@ -0,0 +1,212 @@
+#!/usr/bin/python
+# For copyright and license terms, see COPYRIGHT.rst (top level of repository)
+# Repository: https://github.com/C3S/collecting_society_worker
+
+"""Test the audio tools without external decoders"""
+
+import os
+import wave
+import random
+import shutil
+import tempfile
+import unittest
+import contextlib
+
+import numpy
+from pydub import AudioSegment
+from pydub.exceptions import CouldntDecodeError
+
+from collecting_society_worker import audioTools
+from collecting_society_worker import fileTools
+
+
+def noise(seconds, channels=2, frame_rate=8000):
+    rng = random.Random(seconds)
+    data = bytes(
+        rng.getrandbits(8)
+        for _ in range(int(seconds * frame_rate) * channels * 2))
+    return AudioSegment(
+        data=data, sample_width=2, frame_rate=frame_rate, channels=channels)
+
+
+class TestAssemblePreview(unittest.TestCase):
+
+    def _legacy_preview(self, segments):
+        preview = None
+        for segment in segments:
+            segment = segment.set_channels(1)
+            preview = segment if not preview else preview.append(
+                segment, crossfade=2000)
+        return preview.fade_in(1000).fade_out(1000)
+
+    def test_matches_append_chain(self):
+        audio = noise(40)
+        segments = [audio[0:8000], audio[15000:23000], audio[30000:38000]]
+        self.assertEqual(
+            audioTools.assemble_preview(segments, 2000, 1000, 1000).raw_data,
+            self._legacy_preview(segments).raw_data)
+
+    def test_memoryview_segments(self):
+        audio = noise(20)
+        view = audio._spawn(memoryview(audio.raw_data))
+        segments = [view[0:8000], view[10000:18000]]
+        self.assertEqual(
+            audioTools.assemble_preview(segments, 2000, 1000, 1000).raw_data,
+            self._legacy_preview(segments).raw_data)
+
+    def test_single_segment(self):
+        audio = noise(5)
+        self.assertEqual(
+            audioTools.assemble_preview([audio], 2000, 1000, 1000).raw_data,
+            self._legacy_preview([audio]).raw_data)
+
+    def test_short_trailing_segment_skipped(self):
+        audio = noise(20)
+        preview = audioTools.assemble_preview(
+            [audio[0:8000], audio[10000:11000]], 2000, 1000, 1000)
+        self.assertEqual(len(preview), 8000)
+
+
+class TestRenderPreview(unittest.TestCase):
+
+    def test_matches_assembler(self):
+        audio = noise(40)
+        ranges = [(0, 8000), (15000, 23000), (30000, 38000)]
+        expected = numpy.frombuffer(
+            audioTools.assemble_preview(
+                [audio[a:b] for a, b in ranges], 2000, 1000, 1000
+            ).raw_data, dtype=numpy.int16)
+        samples = numpy.frombuffer(
+            audio.raw_data, dtype=numpy.int16).reshape(-1, 2)
+        preview = audioTools.render_preview(
+            [samples[a * 8:b * 8] for a, b in ranges],
+            8000, 2000, 1000, 1000, 8000)
+        self.assertEqual(preview.dtype, numpy.int16)
+        self.assertEqual(len(preview), len(expected))
+        # pydub fades in 1 ms steps, the renderer per sample
+        difference = numpy.abs(
+            preview.astype(numpy.int32) - expected.astype(numpy.int32))
+        self.assertLess(difference.mean(), 200)
+
+    def test_resample_length(self):
+        samples = numpy.zeros(44100, dtype=numpy.float32)
+        self.assertEqual(
+            len(audioTools.resample(samples, 44100, 16000)), 16000)
+        self.assertEqual(
+            len(audioTools.resample(samples, 44100, 11025)), 11025)
+
+
+class TestWavFile(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def _write(self, name, sample_width, data, channels=2):
+        path = os.path.join(self.tmp, name)
+        with contextlib.closing(wave.open(path, 'wb')) as output:
+            output.setnchannels(channels)
+            output.setsampwidth(sample_width)
+            output.setframerate(8000)
+            output.writeframes(data)
+        return path
+
+    def test_read_16_bit(self):
+        audio = noise(2)
+        path = self._write('w16.wav', 2, audio.raw_data)
+        expected = numpy.frombuffer(
+            audio.raw_data, dtype=numpy.int16).reshape(-1, 2)
+        with audioTools.open_native(path) as native:
+            self.assertIsInstance(native, audioTools.WavFile)
+            self.assertEqual(native.frames, 16000)
+            self.assertEqual(native.channels, 2)
+            self.assertEqual(native.frame_rate, 8000)
+            numpy.testing.assert_array_equal(
+                native.read(500, 1500), expected[4000:12000])
+            self.assertEqual(len(native.read(1500, 5000)), 4000)
+
+    def test_read_24_bit(self):
+        samples = numpy.array([[-32768, 32767], [1, -1]], dtype='<i4') << 8
+        samples[1] += 0x7f  # discarded low byte
+        data = b''.join(
+            int(value).to_bytes(3, 'little', signed=True)
+            for value in samples.flatten())
+        path = self._write('w24.wav', 3, data)
+        with audioTools.WavFile(path) as native:
+            numpy.testing.assert_array_equal(
+                native.read(0, 1000), [[-32768, 32767], [1, -1]])
+
+    def test_write_wav_roundtrip(self):
+        samples = numpy.frombuffer(
+            noise(1, channels=1).raw_data, dtype=numpy.int16)
+        path = os.path.join(self.tmp, 'excerpt.wav')
+        self.assertTrue(audioTools.write_wav(samples, 8000, path))
+        with audioTools.WavFile(path) as native:
+            numpy.testing.assert_array_equal(
+                native.read(0, 1000)[:, 0], samples)
+
+    def test_no_native_decoder(self):
+        path = os.path.join(self.tmp, 'upload.mp3')
+        with open(path, 'wb') as upload:
+            upload.write(b'ID3' + bytes(100))
+        self.assertIsNone(audioTools.open_native(path))
+
+
+@unittest.skipUnless(shutil.which('ffmpeg'), "needs ffmpeg")
+class TestDecodeRanges(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, 'upload.flac')
+        samples = numpy.frombuffer(
+            noise(10, channels=1).raw_data, dtype=numpy.int16)
+        audioTools.encode_samples(samples, 8000, self.path, 'flac')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_matches_single_ranges(self):
+        ranges = [(0, 2000), (4000, 6500), (9000, 12000)]
+        segments = audioTools.decode_ranges_samples(
+            self.path, ranges, 2, 8000)
+        self.assertEqual(
+            [len(segment) for segment in segments], [16000, 20000, 8000])
+        for (start, end), segment in zip(ranges, segments):
+            numpy.testing.assert_array_equal(
+                segment, audioTools.decode_range_samples(
+                    self.path, start, end - start, 2, 8000))
+        mono = audioTools.decode_ranges(self.path, ranges[:1], 1, 8000)
+        self.assertEqual(mono[0].channels, 1)
+        self.assertEqual(len(mono[0]), 2000)
+
+
+@unittest.skipUnless(shutil.which('ffmpeg'), "needs ffmpeg")
+class TestPCMBuffer(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        # mp4 muxes the index (moov atom) after the audio by default,
+        # ffmpeg only finds it in small files from its pipe buffer
+        self.path = os.path.join(self.tmp, 'upload.m4a')
+        samples = numpy.random.RandomState(1).randint(
+            -20000, 20000, 30 * 8000).astype(numpy.int16)
+        audioTools.encode_samples(
+            samples, 8000, self.path, 'ipod', ['-acodec', 'aac'])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_decode_by_path(self):
+        with audioTools.PCMBuffer(
+                self.path, 1, 8000, self.tmp, duration=30000) as pcm_buffer:
+            self.assertAlmostEqual(pcm_buffer.frames, 240000, delta=2000)
+
+    def test_index_at_the_end_from_pipe(self):
+        hasher = fileTools.FileHasher()
+        with self.assertRaises(CouldntDecodeError):
+            audioTools.PCMBuffer(
+                self.path, 1, 8000, self.tmp, tee=hasher, duration=30000)
+        self.assertEqual(hasher.length, os.path.getsize(self.path))
+        self.assertEqual(os.listdir(self.tmp), ['upload.m4a'])
@@ -0,0 +1,61 @@
+#!/usr/bin/python
+# For copyright and license terms, see COPYRIGHT.rst (top level of repository)
+# Repository: https://github.com/C3S/collecting_society_worker
+
+"""Test the backfill journal and rate limiter"""
+
+import os
+import time
+import shutil
+import tempfile
+import unittest
+
+from collecting_society_worker import backfillJournal
+
+
+class TestBackfillJournal(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.journal = backfillJournal.BackfillJournal(
+            os.path.join(self.tmp, 'backfill.db'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_resume(self):
+        self.assertEqual(
+            self.journal.add([('a', 'p/a'), ('b', 'p/b'), ('c', 'p/c')]), 3)
+        self.journal.mark('a', 'done', '4.12')
+        self.journal.mark('b', 'failed', "no fingerprint")
+        # selecting again keeps the outcomes
+        self.assertEqual(self.journal.add([('a', 'p/a'), ('d', 'p/d')]), 1)
+        resumed = backfillJournal.BackfillJournal(self.journal.path)
+        self.assertEqual(resumed.pending(), [('c', 'p/c'), ('d', 'p/d')])
+        self.assertEqual(
+            resumed.pending(retry_failed=True),
+            [('b', 'p/b'), ('c', 'p/c'), ('d', 'p/d')])
+        self.assertEqual(
+            resumed.counts(), {'done': 1, 'failed': 1, 'pending': 2})
+
+    def test_meta(self):
+        self.assertIsNone(self.journal.get_meta('version'))
+        self.journal.set_meta('version', '4.12')
+        self.assertEqual(self.journal.get_meta('version'), '4.12')
+
+
+class TestRateLimiter(unittest.TestCase):
+
+    def test_rate(self):
+        limiter = backfillJournal.RateLimiter(20)
+        start = time.time()
+        for _ in range(5):
+            limiter.wait()
+        self.assertAlmostEqual(time.time() - start, 0.2, delta=0.1)
+
+    def test_no_limit(self):
+        limiter = backfillJournal.RateLimiter(0)
+        start = time.time()
+        for _ in range(100):
+            limiter.wait()
+        self.assertLess(time.time() - start, 0.1)
@@ -0,0 +1,62 @@
+#!/usr/bin/python
+# For copyright and license terms, see COPYRIGHT.rst (top level of repository)
+# Repository: https://github.com/C3S/collecting_society_worker
+
+"""Test the cache of echoprint-codegen results"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from collecting_society_worker import codegenCache
+
+OUTPUT = '[{"metadata": {"version": 4.12}, "code": "%s"}]' % ('eJx' * 500)
+
+
+class TestCodegenCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, 'codegen.sqlite')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_put_and_get(self):
+        cache = codegenCache.CodegenCache(self.path)
+        self.assertIsNone(cache.get('aa', 'v1'))
+        cache.put('aa', 'v1', 0, 0, OUTPUT)
+        self.assertEqual(cache.get('aa', 'v1'), OUTPUT)
+        self.assertIsNone(cache.get('aa', 'v2'))
+        self.assertIsNone(cache.get('aa', 'v1', 30, 60))
+        # persistent
+        self.assertEqual(
+            codegenCache.CodegenCache(self.path).get('aa', 'v1'), OUTPUT)
+
+    def test_compressed(self):
+        cache = codegenCache.CodegenCache(self.path)
+        cache.put('aa', 'v1', 0, 0, OUTPUT)
+        size = cache._db().execute('SELECT size FROM codegen').fetchone()[0]
+        self.assertLess(size, len(OUTPUT) / 10)
+
+    def test_least_recently_used_evicted(self):
+        cache = codegenCache.CodegenCache(self.path)
+        cache.put('aa', 'v1', 0, 0, OUTPUT)
+        size = cache._db().execute('SELECT size FROM codegen').fetchone()[0]
+        cache.max_size = 2 * size
+        cache.put('bb', 'v1', 0, 0, OUTPUT)
+        cache.get('aa', 'v1')
+        cache.put('cc', 'v1', 0, 0, OUTPUT)
+        self.assertIsNotNone(cache.get('aa', 'v1'))
+        self.assertIsNone(cache.get('bb', 'v1'))
+        self.assertIsNotNone(cache.get('cc', 'v1'))
+
+    def test_discard(self):
+        cache = codegenCache.CodegenCache(self.path)
+        cache.put('aa', 'v1', 0, 0, OUTPUT)
+        cache.put('aa', 'v1', 30, 60, OUTPUT)
+        cache.put('bb', 'v1', 0, 0, OUTPUT)
+        cache.discard('aa')
+        self.assertIsNone(cache.get('aa', 'v1', 30, 60))
+        self.assertIsNotNone(cache.get('bb', 'v1'))
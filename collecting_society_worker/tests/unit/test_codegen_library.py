@@ -0,0 +1,81 @@
+#!/usr/bin/python
+# For copyright and license terms, see COPYRIGHT.rst (top level of repository)
+# Repository: https://github.com/C3S/collecting_society_worker
+
+"""Test the codegen library against the echoprint-codegen binary
+
+Needs echoprint-codegen in the exe path and the library built from
+contrib/codegen_c.cpp in the environment variable CODEGEN_LIBRARY.
+"""
+
+import os
+import re
+import shutil
+import tempfile
+import unittest
+
+import numpy
+
+from collecting_society_worker import audioTools
+from collecting_society_worker import codegenRunner
+from collecting_society_worker import codegenLibrary
+
+LIBRARY = os.environ.get('CODEGEN_LIBRARY')
+
+# the only fields which differ between two runs of the binary
+_timing = re.compile(r'"(codegen|decode)_time":[0-9.]+')
+
+
+def music(seconds, frame_rate):
+    # a few tones changing every quarter second, so there are codes
+    rng = numpy.random.RandomState(1)
+    t = numpy.arange(int(seconds * frame_rate)) / float(frame_rate)
+    notes = rng.uniform(200, 2000, size=int(seconds * 4) + 1)
+    samples = 8000 * numpy.sin(2 * numpy.pi * notes[(t * 4).astype(int)] * t)
+    return samples.astype(numpy.int16)
+
+
+@unittest.skipUnless(
+    LIBRARY and shutil.which('echoprint-codegen'),
+    "needs echoprint-codegen and CODEGEN_LIBRARY")
+class TestCodegenLibrary(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.library = codegenLibrary.CodegenLibrary(LIBRARY)
+        self.runner = codegenRunner.CodegenRunner(self.tmp, 1)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def assertSameOutput(self, path, *window):
+        arguments = [path] + [str(value) for value in window]
+        expected = self.runner.run(arguments)
+        output = self.library.codegen_file(path, *window)
+        self.assertIsNotNone(output)
+        self.assertEqual(
+            _timing.sub('', output), _timing.sub('', expected))
+
+    def test_codegen_input(self):
+        # mono 11025 Hz wav, read without ffmpeg
+        path = os.path.join(self.tmp, 'mono.wav')
+        audioTools.write_wav(music(40, 11025), 11025, path)
+        self.assertSameOutput(path)
+        self.assertSameOutput(path, 10, 20)
+
+    def test_other_input(self):
+        # decoded with the ffmpeg command line of echoprint-codegen
+        path = os.path.join(self.tmp, 'music.flac')
+        audioTools.encode_samples(music(40, 44100), 44100, path, 'flac')
+        self.assertSameOutput(path)
+        self.assertSameOutput(path, 10, 20)
+
+    def test_worker_process(self):
+        path = os.path.join(self.tmp, 'music.flac')
+        audioTools.encode_samples(music(40, 44100), 44100, path, 'flac')
+        output = self.runner.call(
+            path, codegenLibrary.server_command(LIBRARY), [path, 10, 20])
+        self.assertIsNotNone(output)
+        self.assertEqual(
+            _timing.sub('', output),
+            _timing.sub('', self.runner.run([path, '10', '20'])))
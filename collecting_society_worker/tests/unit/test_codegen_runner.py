@@ -0,0 +1,151 @@
+#!/usr/bin/python
+# For copyright and license terms, see COPYRIGHT.rst (top level of repository)
+# Repository: https://github.com/C3S/collecting_society_worker
+
+"""Test the echoprint-codegen runner with a stand-in codegen script"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import unittest
+import threading
+
+from collecting_society_worker import codegenRunner
+
+# sleeps for the seconds in its first argument, then prints a code;
+# a background child stands in for the ffmpeg process of codegen
+CODEGEN = """#!/bin/sh
+sleep "$1" > /dev/null &
+echo $! > "$0.child"
+sleep "$1"
+echo '[{"code": "x"}]'
+"""
+
+
+# answers the requests of CodegenRunner.call() like the server of
+# codegenLibrary, [action, value] instead of [filepath, offset, duration]
+WORKER = """import json, os, signal, sys, time
+print(json.dumps({'version': 0}), flush=True)
+for line in sys.stdin:
+    action, value = json.loads(line)
+    try:
+        if action == 'sleep':
+            time.sleep(value)
+        elif action == 'crash':
+            os.kill(os.getpid(), signal.SIGSEGV)
+        elif action == 'fail':
+            raise ValueError(value)
+        elif action == 'allocate':
+            value = str(len('x' * value))
+        elif action == 'pid':
+            value = str(os.getpid())
+        response = {'output': None if action == 'none' else value}
+    except Exception as e:
+        response = {'error': str(e)}
+    print(json.dumps(response), flush=True)
+"""
+
+
+def running(pid):
+    try:
+        with open('/proc/%d/stat' % pid) as stat:
+            return stat.read().rsplit(')', 1)[1].split()[0] != 'Z'
+    except IOError:
+        return False
+
+
+class TestCodegenRunner(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        codegen = os.path.join(self.tmp, 'echoprint-codegen')
+        with open(codegen, 'w') as script:
+            script.write(CODEGEN)
+        os.chmod(codegen, 0o755)
+        worker = os.path.join(self.tmp, 'worker.py')
+        with open(worker, 'w') as script:
+            script.write(WORKER)
+        self.worker = [sys.executable, worker]
+        self.path = os.environ['PATH']
+        os.environ['PATH'] = self.tmp + os.pathsep + self.path
+        self.stats = os.path.join(self.tmp, 'stats.tsv')
+
+    def tearDown(self):
+        os.environ['PATH'] = self.path
+        shutil.rmtree(self.tmp)
+
+    def test_output_and_stats(self):
+        runner = codegenRunner.CodegenRunner(
+            self.tmp, 2, timeout=10, stats_path=self.stats)
+        self.assertEqual(runner.run(['0']), '[{"code": "x"}]\n')
+        stats = codegenRunner.read_stats(self.stats)
+        self.assertEqual(stats['runs'], 1)
+        self.assertEqual(stats['statuses'], {'ok': 1})
+
+    def test_timeout_kills_process_group(self):
+        runner = codegenRunner.CodegenRunner(
+            self.tmp, 1, timeout=0.5, stats_path=self.stats)
+        start = time.time()
+        self.assertIsNone(runner.run(['30']))
+        self.assertLess(time.time() - start, 10)
+        with open(os.path.join(self.tmp, 'echoprint-codegen.child')) as f:
+            child = int(f.read())
+        time.sleep(0.1)
+        self.assertFalse(running(child))
+        self.assertEqual(
+            codegenRunner.read_stats(self.stats)['statuses'],
+            {'timeout': 1})
+
+    def test_concurrency_limit(self):
+        runner = codegenRunner.CodegenRunner(
+            self.tmp, 2, stats_path=self.stats)
+        threads = [
+            threading.Thread(target=runner.run, args=(['0.3'],))
+            for _ in range(4)]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # two rounds of two runs
+        self.assertGreater(time.time() - start, 0.6)
+        self.assertEqual(codegenRunner.read_stats(self.stats)['runs'], 4)
+
+    def test_call(self):
+        runner = codegenRunner.CodegenRunner(
+            self.tmp, 1, stats_path=self.stats)
+        self.assertEqual(runner.call('a.wav', self.worker, ['echo', 'a']),
+                         'a')
+        self.assertIsNone(runner.call('b.wav', self.worker, ['none', 0]))
+        self.assertIsNone(runner.call('c.wav', self.worker, ['fail', 0]))
+        self.assertEqual(
+            codegenRunner.read_stats(self.stats)['statuses'],
+            {'library': 1, 'failed': 1})
+        # the worker is kept for the next calls
+        self.assertEqual(
+            runner.call('d.wav', self.worker, ['pid', 0]),
+            runner.call('e.wav', self.worker, ['pid', 0]))
+
+    def test_call_timeout_and_crash(self):
+        runner = codegenRunner.CodegenRunner(
+            self.tmp, 1, timeout=2, stats_path=self.stats)
+        start = time.time()
+        self.assertIsNone(runner.call('a.wav', self.worker, ['sleep', 30]))
+        self.assertLess(time.time() - start, 10)
+        self.assertIsNone(runner.call('b.wav', self.worker, ['crash', 0]))
+        self.assertEqual(
+            codegenRunner.read_stats(self.stats)['statuses'],
+            {'timeout': 1, 'killed': 1})
+        # a new worker takes over
+        self.assertEqual(runner.call('c.wav', self.worker, ['echo', 'c']),
+                         'c')
+
+    def test_call_memory_limit(self):
+        runner = codegenRunner.CodegenRunner(
+            self.tmp, 1, memory_limit=64 * 1024 * 1024)
+        self.assertEqual(
+            runner.call('a.wav', self.worker, ['allocate', 1000]), '1000')
+        self.assertIsNone(
+            runner.call('b.wav', self.worker, ['allocate', 2 ** 30]))
@@ -0,0 +1,94 @@
+#!/usr/bin/python
+# For copyright and license terms, see COPYRIGHT.rst (top level of repository)
+# Repository: https://github.com/C3S/collecting_society_worker
+
+"""Test the circuit breaker and the deferred queue"""
+
+import os
+import time
+import shutil
+import tempfile
+import unittest
+
+from collecting_society_worker import deferredQueue
+
+
+class TestCircuitBreaker(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.breaker = deferredQueue.CircuitBreaker(
+            os.path.join(self.tmp, 'deferred.db'),
+            threshold=2, cooldown=0.2, max_cooldown=0.3)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_opens_at_threshold(self):
+        self.breaker.failure()
+        self.assertTrue(self.breaker.allow())
+        self.breaker.failure()
+        self.assertFalse(self.breaker.allow())
+        self.assertTrue(self.breaker.open_until())
+
+    def test_single_probe_after_cooldown(self):
+        self.breaker.failure()
+        self.breaker.failure()
+        time.sleep(0.25)
+        self.assertTrue(self.breaker.allow())
+        self.assertFalse(self.breaker.allow())
+        # failed probe: open for twice as long, at most max_cooldown
+        self.breaker.failure()
+        self.assertAlmostEqual(
+            self.breaker.open_until() - time.time(), 0.3, delta=0.05)
+        time.sleep(0.35)
+        self.assertTrue(self.breaker.allow())
+        self.breaker.success()
+        self.assertTrue(self.breaker.allow())
+        self.assertTrue(self.breaker.allow())
+
+    def test_shared_state(self):
+        other = deferredQueue.CircuitBreaker(
+            self.breaker.path, threshold=2, cooldown=10)
+        self.breaker.failure()
+        self.breaker.failure()
+        self.assertFalse(other.allow())
+
+
+class TestDeferredQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.queue = deferredQueue.DeferredQueue(
+            os.path.join(self.tmp, 'deferred.db'), delay=60, max_delay=150)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_backoff(self):
+        self.assertTrue(self.queue.is_due('a'))
+        delays = [self.queue.defer('a', 'down') - time.time()
+                  for _ in range(3)]
+        self.assertAlmostEqual(delays[0], 60, delta=1)
+        self.assertAlmostEqual(delays[1], 120, delta=1)
+        self.assertAlmostEqual(delays[2], 150, delta=1)
+        self.assertFalse(self.queue.is_due('a'))
+        self.assertEqual(self.queue.entries()[0][:2], ('a', 3))
+        self.queue.remove('a')
+        self.assertTrue(self.queue.is_due('a'))
+        self.assertEqual(self.queue.entries(), [])
+
+    def test_max_attempts(self):
+        queue = deferredQueue.DeferredQueue(
+            self.queue.path, delay=60, max_attempts=2)
+        self.assertIsNotNone(queue.defer('a', 'down'))
+        self.assertIsNotNone(queue.defer('a', 'down'))
+        self.assertIsNone(queue.defer('a', 'down'))
+        self.assertEqual(queue.entries(), [])
+
+    def test_retain(self):
+        for filename in ('a', 'b', 'c'):
+            self.queue.defer(filename, 'down')
+        self.assertEqual(sorted(self.queue.retain(['b', 'x'])), ['a', 'c'])
+        self.assertEqual(
+            [entry[0] for entry in self.queue.entries()], ['b'])
@@ -0,0 +1,129 @@
+#!/usr/bin/python
+# For copyright and license terms, see COPYRIGHT.rst (top level of repository)
+# Repository: https://github.com/C3S/collecting_society_worker
+
+"""Test the EchoPrint client against a local keep-alive server"""
+
+import gzip
+import json
+import time
+import asyncio
+import unittest
+import threading
+from urllib.parse import parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from collecting_society_worker import echoprintClient
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        if self.headers.get('Content-Encoding') == 'gzip':
+            body = gzip.decompress(body)
+        params = parse_qs(body.decode('ascii'))
+        self.server.requests.append((
+            self.path, self.client_address[1], params))
+        time.sleep(self.server.delay)
+        # batches with an invalid fingerprint are rejected as a whole
+        items = json.loads(params['data'][0]) if 'data' in params else []
+        status = 400 if any(item.get('fp') == 'x' for item in items) else 200
+        if params.get('fp') == ['x']:
+            status = 400
+        response = json.dumps({'ok': status == 200}).encode('ascii')
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestEchoprintClient(unittest.TestCase):
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.requests = []
+        self.server.delay = 0
+        threading.Thread(target=self.server.serve_forever).start()
+        self.url = 'http://127.0.0.1:%d' % self.server.server_port
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_keep_alive(self):
+        client = echoprintClient.EchoprintClient(self.url)
+        self.assertEqual(client.query('abc').status_code, 200)
+        client.ingest({'fp': 'abc', 'track_id': '1'})
+        client.delete('1')
+        paths = [request[0] for request in self.server.requests]
+        self.assertEqual(paths, ['/query', '/ingest', '/delete'])
+        # one connection, so one client port
+        ports = set(request[1] for request in self.server.requests)
+        self.assertEqual(len(ports), 1)
+        self.assertEqual(
+            self.server.requests[1][2], {'fp': ['abc'], 'track_id': ['1']})
+
+    def test_compressed_query(self):
+        client = echoprintClient.EchoprintClient(self.url, compress=True)
+        client.query('abc')
+        self.assertEqual(
+            self.server.requests[0][2], {'fp_code': ['abc']})
+
+    def test_async_requests_overlap(self):
+        self.server.delay = 0.3
+        client = echoprintClient.AsyncEchoprintClient(
+            echoprintClient.EchoprintClient(self.url, pool_size=4))
+
+        async def queries():
+            return await asyncio.gather(*[
+                client.query(str(i)) for i in range(4)])
+
+        start = time.time()
+        responses = asyncio.run(queries())
+        client.close()
+        self.assertLess(time.time() - start, 1.0)
+        self.assertEqual([r.status_code for r in responses], [200] * 4)
+
+    def test_batched_ingest(self):
+        client = echoprintClient.AsyncEchoprintClient(
+            echoprintClient.EchoprintClient(self.url),
+            batch_size=2, batch_wait=0.2)
+
+        async def ingests():
+            return await asyncio.gather(*[
+                client.ingest({'token': 't', 'track_id': str(i)})
+                for i in range(3)])
+
+        responses = asyncio.run(ingests())
+        client.close()
+        self.assertEqual([r.status_code for r in responses], [200] * 3)
+        # a full batch and one flushed after batch_wait
+        batches = [
+            json.loads(request[2]['data'][0])
+            for request in self.server.requests]
+        self.assertEqual(
+            batches, [[{'track_id': '0'}, {'track_id': '1'}],
+                      [{'track_id': '2'}]])
+        self.assertEqual(self.server.requests[0][2]['token'], ['t'])
+
+    def test_rejected_batch(self):
+        client = echoprintClient.AsyncEchoprintClient(
+            echoprintClient.EchoprintClient(self.url),
+            batch_size=3, batch_wait=0.2)
+
+        async def ingests():
+            return await asyncio.gather(*[
+                client.ingest({'token': 't', 'fp': fp, 'track_id': str(i)})
+                for i, fp in enumerate(['a', 'x', 'b'])])
+
+        responses = asyncio.run(ingests())
+        client.close()
+        # the rejected batch is ingested again one by one
+        self.assertEqual(
+            [r.status_code for r in responses], [200, 400, 200])
+        self.assertEqual(len(self.server.requests), 4)
@@ -0,0 +1,73 @@
+#!/usr/bin/python
+# For copyright and license terms, see COPYRIGHT.rst (top level of repository)
+# Repository: https://github.com/C3S/collecting_society_worker
+
+"""Test the EchoPrint code string tools"""
+
+import json
+import zlib
+import base64
+import unittest
+
+from collecting_society_worker import echoprintCodes
+
+
+def codegen_output(times, codes):
+    return json.dumps([{
+        'metadata': {'version': 4.12},
+        'code_count': len(codes),
+        'code': echoprintCodes.encode_code_string(times, codes),
+    }])
+
+
+class TestCodeStrings(unittest.TestCase):
+
+    def test_roundtrip(self):
+        times = [0, 12, 12, 47, 0xfffff]
+        codes = [0x1a2b3, 7, 0xfffff, 0, 99]
+        self.assertEqual(
+            echoprintCodes.decode_code_string(
+                echoprintCodes.encode_code_string(times, codes)),
+            (times, codes))
+
+    def test_codegen_format(self):
+        code_string = base64.urlsafe_b64encode(
+            zlib.compress(b'0000100002000ab000cd')).decode('ascii')
+        self.assertEqual(
+            echoprintCodes.decode_code_string(code_string.rstrip('=')),
+            ([1, 2], [0xab, 0xcd]))
+
+    def test_empty(self):
+        self.assertEqual(echoprintCodes.decode_code_string(''), ([], []))
+
+    def test_decode_arrays(self):
+        times = [0, 12, 12, 47, 0xfffff]
+        codes = [0x1a2b3, 7, 0xfffff, 0, 99]
+        code_string = echoprintCodes.encode_code_string(times, codes)
+        decoded = echoprintCodes.decode_code_arrays(code_string)
+        self.assertEqual(
+            (decoded[0].tolist(), decoded[1].tolist()), (times, codes))
+        self.assertEqual(
+            [len(a) for a in echoprintCodes.decode_code_arrays('')], [0, 0])
+
+
+class TestMergeOutputs(unittest.TestCase):
+
+    def test_single_output_unchanged(self):
+        self.assertEqual(echoprintCodes.merge_outputs(['x']), 'x')
+
+    def test_merge_windows(self):
+        merged = json.loads(echoprintCodes.merge_outputs([
+            codegen_output([1, 2], [10, 20]),
+            codegen_output([], []),
+            codegen_output([30, 31], [30, 40]),
+        ]))[0]
+        self.assertEqual(merged['code_count'], 4)
+        self.assertEqual(merged['metadata'], {'version': 4.12})
+        self.assertEqual(
+            echoprintCodes.decode_code_string(merged['code']),
+            ([1, 2, 30, 31], [10, 20, 30, 40]))
+
+    def test_failed_window(self):
+        self.assertIsNone(echoprintCodes.merge_outputs([
+            codegen_output([1], [10]), 'Error: no such file']))
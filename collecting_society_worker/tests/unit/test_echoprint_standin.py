@@ -0,0 +1,92 @@
+#!/usr/bin/python
+# For copyright and license terms, see COPYRIGHT.rst (top level of repository)
+# Repository: https://github.com/C3S/collecting_society_worker
+
+"""Test the EchoPrint stand-in server through the EchoPrint client"""
+
+import json
+import time
+import random
+
+import pytest
+
+from collecting_society_worker import echoprintClient, echoprintCodes
+
+
+def code_string(seed, count=200, shift=0):
+    generator = random.Random(seed)
+    times = [shift + 10 * i for i in range(count)]
+    codes = [generator.randrange(1 << 20) for _ in range(count)]
+    return echoprintCodes.encode_code_string(times, codes)
+
+
+def test_ingest_query_delete(echoprint_server):
+    client = echoprintClient.EchoprintClient(echoprint_server.url)
+    for seed in range(3):
+        response = client.ingest({
+            'track_id': 'track%d' % seed, 'fp_code': code_string(seed),
+            'artist': 'artist%d' % seed, 'track': 'title%d' % seed})
+        assert response.status_code == 200
+    # an excerpt starts later in the track
+    result = json.loads(client.query(code_string(1, shift=500)).text)
+    assert result['match']
+    assert result['track_id'] == 'track1'
+    result = json.loads(client.query(code_string(1)).text)
+    assert result['track_id'] == 'track1'
+    assert result['artist'] == 'artist1'
+    assert result['track'] == 'title1'
+    assert result['score'] == 200
+    assert client.delete('track1').status_code == 200
+    result = json.loads(client.query(code_string(1)).text)
+    assert not result['match']
+    assert result['score'] == 0
+
+
+def test_batched_ingest(echoprint_server):
+    client = echoprintClient.EchoprintClient(echoprint_server.url)
+    response = client.ingest_batch([
+        {'token': '', 'track_id': 'a', 'fp_code': code_string(1)},
+        {'token': '', 'track_id': 'b', 'fp_code': code_string(2)}])
+    assert response.status_code == 200
+    assert sorted(echoprint_server.tracks) == ['a', 'b']
+    assert echoprint_server.requests == {'/ingest': 1}
+
+
+def test_invalid_ingest(echoprint_server):
+    client = echoprintClient.EchoprintClient(echoprint_server.url)
+    assert client.ingest({'fp_code': code_string(1)}).status_code == 400
+    response = client.ingest_batch([
+        {'token': '', 'track_id': 'a', 'fp_code': code_string(1)},
+        {'token': '', 'fp_code': code_string(2)}])
+    assert response.status_code == 400
+    assert client.post(
+        '/ingest', {'token': '', 'data': '["a"]'}).status_code == 400
+    assert client.post(
+        '/ingest', {'token': '', 'data': '{'}).status_code == 400
+
+
+@pytest.mark.parametrize(
+    'echoprint_server', [{'error_rate': 1.0}], indirect=True)
+def test_error_rate(echoprint_server):
+    client = echoprintClient.EchoprintClient(echoprint_server.url)
+    assert client.query(code_string(1)).status_code == 503
+
+
+@pytest.mark.parametrize(
+    'echoprint_server', [{'latency': 0.05, 'max_rps': 20}], indirect=True)
+def test_latency_and_throughput(echoprint_server):
+    client = echoprintClient.EchoprintClient(echoprint_server.url)
+    start = time.time()
+    for _ in range(5):
+        client.query('')
+    # four intervals of 1/20 s plus the latency of the last request
+    assert time.time() - start >= 0.25
+
+
+@pytest.mark.parametrize(
+    'echoprint_server', [{'token': 'secret'}], indirect=True)
+def test_token(echoprint_server):
+    client = echoprintClient.EchoprintClient(echoprint_server.url)
+    data = {'track_id': 'a', 'fp_code': code_string(1)}
+    assert client.ingest(dict(data, token='wrong')).status_code == 403
+    assert client.ingest(dict(data, token='secret')).status_code == 200
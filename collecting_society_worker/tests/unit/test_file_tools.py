@@ -0,0 +1,59 @@
+#!/usr/bin/python
+# For copyright and license terms, see COPYRIGHT.rst (top level of repository)
+# Repository: https://github.com/C3S/collecting_society_worker
+
+"""Test the file tools"""
+
+import os
+import shutil
+import hashlib
+import tempfile
+import unittest
+
+from collecting_society_worker import fileTools
+
+
+class TestFileHasher(unittest.TestCase):
+
+    data = bytes(range(256)) * 40  # 10240 bytes
+
+    def test_whole_file(self):
+        hasher = fileTools.FileHasher()
+        for pos in range(0, len(self.data), 1000):
+            hasher.update(self.data[pos:pos + 1000])
+        self.assertEqual(
+            hasher.hexdigest(), hashlib.sha256(self.data).hexdigest())
+        self.assertEqual(hasher.length, len(self.data))
+        self.assertEqual(hasher.blocks, [])
+
+    def test_blocks_independent_of_chunks(self):
+        expected = [
+            (begin, min(begin + 4096, len(self.data)),
+             hashlib.sha256(self.data[begin:begin + 4096]).hexdigest())
+            for begin in range(0, len(self.data), 4096)]
+        for chunk_size in (1, 1000, 4096, 5000, len(self.data)):
+            hasher = fileTools.FileHasher(4096)
+            for pos in range(0, len(self.data), chunk_size):
+                hasher.update(self.data[pos:pos + chunk_size])
+            hasher.hexdigest()
+            self.assertEqual(hasher.blocks, expected)
+
+    def test_block_aligned_end(self):
+        hasher = fileTools.FileHasher(1024)
+        hasher.update(self.data)
+        hasher.hexdigest()
+        hasher.hexdigest()
+        self.assertEqual(len(hasher.blocks), 10)
+        self.assertEqual(hasher.blocks[-1][:2], (9216, 10240))
+
+    def test_hash_file(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp, 'upload')
+            with open(path, 'wb') as upload:
+                upload.write(self.data)
+            hasher = fileTools.FileHasher().hash_file(path, bufsize=3000)
+            self.assertEqual(
+                hasher.hexdigest(), hashlib.sha256(self.data).hexdigest())
+        finally:
+            shutil.rmtree(tmp)
@@ -0,0 +1,50 @@
+#!/usr/bin/python
+# For copyright and license terms, see COPYRIGHT.rst (top level of repository)
+# Repository: https://github.com/C3S/collecting_society_worker
+
+"""Test the inotify watcher for the processing folders"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from collecting_society_worker import fileWatcher
+
+
+class TestStageWatcher(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.stage1 = os.path.join(self.tmp, 'uploaded')
+        self.stage2 = os.path.join(self.tmp, 'previewed')
+        os.makedirs(os.path.join(self.stage1, 'user'))
+        os.makedirs(self.stage2)
+        self.watcher = fileWatcher.StageWatcher([self.stage1, self.stage2])
+
+    def tearDown(self):
+        self.watcher.close()
+        shutil.rmtree(self.tmp)
+
+    def test_written_file(self):
+        with open(os.path.join(self.stage1, 'user', 'file'), 'w') as f:
+            f.write('data')
+        overflow, files = self.watcher.events(1)
+        self.assertFalse(overflow)
+        self.assertEqual(
+            files, [(self.stage1, os.path.join(self.stage1, 'user'), 'file')])
+
+    def test_file_moved_into_new_user_folder(self):
+        with open(os.path.join(self.stage1, 'user', 'file'), 'w') as f:
+            f.write('data')
+        self.watcher.events(1)
+        os.makedirs(os.path.join(self.stage2, 'user'))
+        os.rename(
+            os.path.join(self.stage1, 'user', 'file'),
+            os.path.join(self.stage2, 'user', 'file'))
+        _, files = self.watcher.events(1)
+        self.assertIn(
+            (self.stage2, os.path.join(self.stage2, 'user'), 'file'), files)
+
+    def test_timeout(self):
+        self.assertEqual(self.watcher.events(0.1), (False, []))
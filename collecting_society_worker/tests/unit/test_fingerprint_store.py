@@ -0,0 +1,72 @@
+#!/usr/bin/python
+# For copyright and license terms, see COPYRIGHT.rst (top level of repository)
+# Repository: https://github.com/C3S/collecting_society_worker
+
+"""Test the local store of ingested fingerprints"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from collecting_society_worker import fingerprintStore
+
+
+class TestFingerprintStore(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.store = fingerprintStore.FingerprintStore(
+            os.path.join(self.tmp, 'store'))
+        for i in range(5):
+            self.store.append(
+                'track%d' % i, '4.12', 'code%d' % i, {'artist': 'a%d' % i})
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_get(self):
+        self.assertEqual(self.store.get('track3'), {
+            'track_id': 'track3', 'codever': '4.12', 'code': 'code3',
+            'metadata': {'artist': 'a3'}})
+        self.assertIsNone(self.store.get('missing'))
+
+    def test_replace_and_remove(self):
+        self.store.append('track1', '4.13', 'new')
+        self.store.remove('track2')
+        self.assertEqual(self.store.get('track1')['code'], 'new')
+        self.assertIsNone(self.store.get('track2'))
+        self.assertEqual(len(self.store), 4)
+        self.assertEqual(
+            [record['track_id'] for record in self.store],
+            ['track0', 'track3', 'track4', 'track1'])
+
+    def test_remove_unknown(self):
+        size = os.path.getsize(self.store.datapath)
+        self.store.remove('missing')
+        self.assertEqual(os.path.getsize(self.store.datapath), size)
+        self.assertEqual(len(self.store), 5)
+
+    def test_resume_records(self):
+        records = list(self.store.records())
+        offset = records[2][0]
+        self.store.append('track0', '4.13', 'new')
+        # the records after the third one, and the replaced first one
+        self.assertEqual(self.store.count(offset), 3)
+        self.assertEqual(
+            [record['track_id'] for _, record in self.store.records(offset)],
+            ['track3', 'track4', 'track0'])
+
+    def test_rebuild_index(self):
+        self.store.append('track1', '4.13', 'new')
+        self.store.remove('track2')
+        os.remove(os.path.join(self.store.path, 'index.db'))
+        store = fingerprintStore.FingerprintStore(self.store.path)
+        self.assertEqual(store.rebuild_index(), 4)
+        self.assertEqual(store.get('track1')['code'], 'new')
+        self.assertIsNone(store.get('track2'))
+
+    def test_torn_record_is_ignored(self):
+        with open(self.store.datapath, 'ab') as datafile:
+            datafile.write(b'\x00\x00\x01\x00partial')
+        self.assertEqual(self.store.rebuild_index(), 5)
@@ -0,0 +1,74 @@
+#!/usr/bin/python
+# For copyright and license terms, see COPYRIGHT.rst (top level of repository)
+# Repository: https://github.com/C3S/collecting_society_worker
+
+"""Test the cache of decoded audio"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from collecting_society_worker import pcmCache
+
+UUID = '0bd6ef2c-8b57-4a5b-8c21-1b2e8e1b2d3f'
+
+
+class TestPCMCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.cache = pcmCache.PCMCache(os.path.join(self.tmp, 'cache'), 100)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def _store(self, uuid, sha256, size=40):
+        path = self.cache.reserve()
+        with open(path, 'wb') as entry:
+            entry.write(b'x' * size)
+        self.cache.store(uuid, sha256, path)
+
+    def _entries(self):
+        return sorted(
+            name for name in os.listdir(self.cache.path)
+            if not name.startswith('.'))
+
+    def test_store_and_checkout(self):
+        self.assertIsNone(self.cache.checkout(UUID, 'aa'))
+        self._store(UUID, 'aa')
+        self.assertIsNone(self.cache.checkout(UUID, 'bb'))
+        link = self.cache.checkout(UUID, 'aa')
+        with open(link, 'rb') as entry:
+            self.assertEqual(entry.read(), b'x' * 40)
+        self.cache.release(link)
+        self.assertFalse(os.path.exists(link))
+        self.assertEqual(self._entries(), [UUID + '.aa.wav'])
+
+    def test_checked_out_entry_survives_eviction(self):
+        self._store(UUID, 'aa')
+        link = self.cache.checkout(UUID, 'aa')
+        self.cache.discard(UUID)
+        self.assertEqual(self._entries(), [])
+        with open(link, 'rb') as entry:
+            self.assertEqual(len(entry.read()), 40)
+        self.cache.release(link)
+
+    def test_least_recently_used_evicted(self):
+        self._store('a', 'aa')
+        self._store('b', 'bb')
+        os.utime(self.cache.entry_path('a', 'aa'), (1, 1))
+        os.utime(self.cache.entry_path('b', 'bb'), (2, 2))
+        self.cache.release(self.cache.checkout('a', 'aa'))
+        self._store('c', 'cc')
+        self.assertEqual(self._entries(), ['a.aa.wav', 'c.cc.wav'])
+
+    def test_discard(self):
+        self._store(UUID, 'aa')
+        self._store('other', 'aa')
+        self.cache.discard(UUID)
+        self.assertEqual(self._entries(), ['other.aa.wav'])
+
+    def test_empty_entries_not_stored(self):
+        self.cache.store(UUID, 'aa', self.cache.reserve())
+        self.assertEqual(os.listdir(self.cache.path), [])
@@ -0,0 +1,62 @@
+#!/usr/bin/python
+# For copyright and license terms, see COPYRIGHT.rst (top level of repository)
+# Repository: https://github.com/C3S/collecting_society_worker
+
+"""Test the index of files waiting in the processing folders"""
+
+import os
+import re
+import shutil
+import tempfile
+import unittest
+
+from collecting_society_worker import pendingIndex
+
+uuid4hex = re.compile('^[0-9a-f-]{36}$')
+test_uuid = '2c1f0e8e-1ac2-4b1a-9e4f-7c2a3b4d5e6f'
+
+
+class TestPendingIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.uploaded = os.path.join(self.tmp, 'uploaded')
+        self.previewed = os.path.join(self.tmp, 'previewed')
+        os.makedirs(os.path.join(self.uploaded, 'user'))
+        os.makedirs(os.path.join(self.previewed, 'user'))
+        self.filepath = os.path.join(self.uploaded, 'user', test_uuid)
+        open(self.filepath, 'w').close()
+        open(self.filepath + '.checksum', 'w').close()
+        self.index = pendingIndex.PendingIndex(
+            os.path.join(self.tmp, 'pending.sqlite'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_reconcile(self):
+        self.assertFalse(self.index.is_warm(self.uploaded))
+        self.assertEqual(self.index.reconcile(self.uploaded, uuid4hex), 1)
+        self.assertTrue(self.index.is_warm(self.uploaded))
+        self.assertEqual(
+            self.index.pending(self.uploaded),
+            [(os.path.join(self.uploaded, 'user'), test_uuid)])
+
+    def test_move(self):
+        self.index.reconcile(self.uploaded, uuid4hex)
+        self.index.reconcile(self.previewed, uuid4hex)
+        target = os.path.join(self.previewed, 'user', test_uuid)
+        self.index.discard(self.filepath)
+        self.index.add(target)
+        self.assertEqual(self.index.pending(self.uploaded), [])
+        self.assertEqual(
+            self.index.pending(self.previewed),
+            [(os.path.join(self.previewed, 'user'), test_uuid)])
+
+    def test_cold_stage_ignores_add(self):
+        self.index.add(os.path.join(self.previewed, 'user', test_uuid))
+        self.assertEqual(self.index.pending(self.previewed), [])
+
+    def test_invalidate(self):
+        self.index.reconcile(self.uploaded, uuid4hex)
+        self.index.invalidate(self.uploaded)
+        self.assertFalse(self.index.is_warm(self.uploaded))
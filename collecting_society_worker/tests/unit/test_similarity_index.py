@@ -0,0 +1,90 @@
+#!/usr/bin/python
+# For copyright and license terms, see COPYRIGHT.rst (top level of repository)
+# Repository: https://github.com/C3S/collecting_society_worker
+
+"""Test the local similarity index of EchoPrint codes"""
+
+import os
+import multiprocessing
+import shutil
+import tempfile
+import unittest
+
+import numpy
+
+from collecting_society_worker import similarityIndex
+
+
+def fingerprint(seed, count=500):
+    generator = numpy.random.RandomState(seed)
+    times = numpy.arange(count, dtype=numpy.uint32) * 3
+    codes = generator.randint(0, 1 << 20, count).astype(numpy.uint32)
+    return times, codes
+
+
+class TestSimilarityIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.index = similarityIndex.SimilarityIndex(
+            os.path.join(self.tmp, 'index'))
+        for seed in range(20):
+            self.index.add(
+                'track%d' % seed, *fingerprint(seed),
+                metadata={'artist': 'artist%d' % seed})
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_excerpt_matches(self):
+        times, codes = fingerprint(7)
+        # an excerpt: the middle of the track, timed from its start
+        excerpt = (times[200:300] - times[200], codes[200:300])
+        results = self.index.query(*excerpt, count=2)
+        self.assertEqual(results[0][0], 'track7')
+        self.assertEqual(results[0][1], 100)
+        self.assertEqual(results[0][2], {'artist': 'artist7'})
+        self.assertTrue(all(score < 10 for _, score, _ in results[1:]))
+        result = self.index.best_match(*excerpt)
+        self.assertTrue(result['match'])
+        self.assertEqual(result['track_id'], 'track7')
+        self.assertEqual(result['artist'], 'artist7')
+
+    def test_no_match(self):
+        result = self.index.best_match(*fingerprint(99))
+        self.assertFalse(result['match'])
+
+    def test_segments_are_merged(self):
+        self.assertEqual(len(self.index), 20)
+        self.assertLessEqual(len(self.index._segments), 5)
+
+    def test_remove_and_replace(self):
+        self.index.remove('track3')
+        self.assertNotEqual(
+            self.index.query(*fingerprint(3))[0][0], 'track3')
+        self.index.add('track4', *fingerprint(50))
+        self.assertEqual(self.index.query(*fingerprint(50))[0][0], 'track4')
+        self.assertNotEqual(
+            self.index.query(*fingerprint(4))[0][0], 'track4')
+        self.assertEqual(len(self.index), 19)
+
+    def test_shared_directory(self):
+        other = similarityIndex.SimilarityIndex(self.index.path)
+        self.assertEqual(other.query(*fingerprint(5))[0][0], 'track5')
+        other.add('new', *fingerprint(60))
+        self.assertEqual(self.index.query(*fingerprint(60))[0][0], 'new')
+
+    def test_concurrent_add_and_query(self):
+        def add():
+            other = similarityIndex.SimilarityIndex(self.index.path)
+            for seed in range(100, 160):
+                other.add('track%d' % seed, *fingerprint(seed, 50))
+        process = multiprocessing.Process(target=add)
+        process.start()
+        while process.is_alive():
+            # a fresh index loads all segments of the current manifest
+            reader = similarityIndex.SimilarityIndex(self.index.path)
+            self.assertEqual(reader.query(*fingerprint(5))[0][0], 'track5')
+        process.join()
+        self.assertEqual(process.exitcode, 0)
+        self.assertEqual(len(self.index), 80)
@@ -0,0 +1,54 @@
+#!/usr/bin/python
+# For copyright and license terms, see COPYRIGHT.rst (top level of repository)
+# Repository: https://github.com/C3S/collecting_society_worker
+
+"""Test the sqlite files shared by the worker processes"""
+
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from collecting_society_worker import sqliteTools
+
+
+class Database(sqliteTools.SQLiteDatabase):
+
+    schema = (
+        'CREATE TABLE IF NOT EXISTS a (x INTEGER)',
+        'CREATE TABLE IF NOT EXISTS b (y INTEGER)',
+    )
+
+
+class TestSQLiteDatabase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.database = Database(os.path.join(self.tmp, 'test.db'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_schema(self):
+        db = self.database._db()
+        self.assertEqual(
+            [row[0] for row in db.execute(
+                'SELECT name FROM sqlite_master ORDER BY name')],
+            ['a', 'b'])
+        self.assertEqual(
+            db.execute('PRAGMA journal_mode').fetchone()[0], 'wal')
+        self.assertIs(self.database._db(), db)
+
+    def test_connection_per_thread_and_process(self):
+        db = self.database._db()
+        connections = []
+        thread = threading.Thread(
+            target=lambda: connections.append(self.database._db()))
+        thread.start()
+        thread.join()
+        self.assertIsNot(connections[0], db)
+        pid = os.fork()
+        if not pid:
+            os._exit(0 if self.database._db() is not db else 1)
+        self.assertEqual(os.waitpid(pid, 0)[1], 0)
@@ -60,6 +60,41 @@ def get_creation_by_content(content):
     return matching_creations[0]
 
 
+def get_contents_by_filenames(filenames):
+    """
+    Get the contents of several filenames/uuids with one query, as a dict
+    by uuid. Unknown filenames are left out.
+    """
+    if not filenames:
+        return {}
+    Content = Model.get('content')
+    return dict(
+        (content.uuid, content)
+        for content in Content.find([('uuid', 'in', list(filenames))]))
+
+
+def get_creations_by_contents(contents):
+    """
+    Get the creations of several contents (content.creation) with one
+    query, as a dict by content id. Contents without a creation are left
+    out.
+    """
+    creation_ids = dict(
+        (content.id, content.creation.id)
+        for content in contents if content.creation)
+    if not creation_ids:
+        return {}
+    Creation = Model.get('creation')
+    creations = dict(
+        (creation.id, creation)
+        for creation in Creation.find(
+            [('id', 'in', list(set(creation_ids.values())))]))
+    return dict(
+        (content_id, creations[creation_id])
+        for content_id, creation_id in creation_ids.items()
+        if creation_id in creations)
+
+
 def insert_content_by_filename(filename, user, pstate):
     """
     insert an example content by filename/uuid.
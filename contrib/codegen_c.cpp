@@ -0,0 +1,141 @@
+// For copyright and license terms, see COPYRIGHT.rst (top level of repository)
+// Repository: https://github.com/C3S/collecting_society_worker
+//
+// C interface to the echoprint-codegen library for ctypes
+// (collecting_society_worker/codegenLibrary.py). libcodegen only has a C++
+// class returning a std::string, which ctypes can't call.
+//
+// Build against the echoprint-codegen sources/library (Metadata.cpp isn't
+// part of libcodegen, it reads the tags for the JSON output), e.g.:
+//
+//   g++ -O3 -shared -fPIC -I echoprint-codegen/src \
+//       $(pkg-config --cflags taglib) contrib/codegen_c.cpp \
+//       echoprint-codegen/src/Metadata.cpp -L echoprint-codegen/src \
+//       -lcodegen $(pkg-config --libs taglib) -o libcodegen_c.so
+//
+// and set codegen_library in config.ini to the path of libcodegen_c.so.
+
+#include <sys/time.h>
+#include <cstdio>
+#include <cstdlib>
+#include <string>
+#include "Codegen.h"
+#include "Metadata.h"
+
+struct codegen_result {
+    std::string code;
+    int num_codes;
+};
+
+// escaping of the strings in the JSON output, as in main.cxx of
+// echoprint-codegen
+static std::string escape(const std::string &value) {
+    std::string out = "";
+    out.reserve(value.size());
+    for (size_t i = 0; i < value.size(); i++) {
+        char c = value[i];
+        if ((unsigned char) c < 31)
+            continue;
+        switch (c) {
+            case '"' : out += "\\\""; break;
+            case '\\': out += "\\\\"; break;
+            default:
+                out += c;
+        }
+    }
+    return out;
+}
+
+static double now() {
+    struct timeval tv;
+    gettimeofday(&tv, NULL);
+    return (double) tv.tv_sec + (double) tv.tv_usec / 1000000.0;
+}
+
+extern "C" {
+
+// Fingerprints mono 11025 Hz samples in [-1, 1], start_offset in seconds.
+// Returns NULL on errors.
+void *codegen_new(const float *pcm, unsigned int num_samples,
+                  int start_offset) {
+    try {
+        Codegen codegen(pcm, num_samples, start_offset);
+        codegen_result *result = new codegen_result;
+        result->code = codegen.getCodeString();
+        result->num_codes = codegen.getNumCodes();
+        return result;
+    } catch (...) {
+        return 0;
+    }
+}
+
+// The code string, valid until codegen_free().
+const char *codegen_code_string(void *result) {
+    return static_cast<codegen_result *>(result)->code.c_str();
+}
+
+int codegen_num_codes(void *result) {
+    return static_cast<codegen_result *>(result)->num_codes;
+}
+
+double codegen_version(void) {
+    return ECHOPRINT_VERSION;
+}
+
+void codegen_free(void *result) {
+    delete static_cast<codegen_result *>(result);
+}
+
+// Fingerprints the mono 11025 Hz samples in [-1, 1] decoded from filename
+// and returns what `echoprint-codegen filename start_offset duration`
+// prints for them (the metadata, codegen_time and decode_time included),
+// byte for byte like main.cxx formats it. Returns NULL on errors, free
+// the output with codegen_json_free().
+char *codegen_json(const float *pcm, unsigned int num_samples,
+                   int start_offset, int duration, const char *filename,
+                   double decode_time) {
+    try {
+        double codegen_time = now();
+        Codegen codegen(pcm, num_samples, start_offset);
+        codegen_time = now() - codegen_time;
+        Metadata metadata(filename);
+        std::string code = codegen.getCodeString();
+        std::string artist = escape(metadata.Artist());
+        std::string release = escape(metadata.Album());
+        std::string title = escape(metadata.Title());
+        std::string genre = escape(metadata.Genre());
+        std::string escaped_filename = escape(filename);
+        size_t size = 16384 + code.size() + artist.size() + release.size() +
+            title.size() + genre.size() + escaped_filename.size();
+        char *output = static_cast<char *>(malloc(size));
+        if (!output)
+            return 0;
+        int length = snprintf(output, size,
+            "[\n{\"metadata\":{\"artist\":\"%s\", \"release\":\"%s\", "
+            "\"title\":\"%s\", \"genre\":\"%s\", \"bitrate\":%d,"
+            "\"sample_rate\":%d, \"duration\":%d, \"filename\":\"%s\", "
+            "\"samples_decoded\":%d, \"given_duration\":%d,"
+            " \"start_offset\":%d, \"version\":%2.2f, "
+            "\"codegen_time\":%2.6f, \"decode_time\":%2.6f}, "
+            "\"code_count\":%d,"
+            " \"code\":\"%s\", \"tag\":%d}\n]\n",
+            artist.c_str(), release.c_str(), title.c_str(), genre.c_str(),
+            metadata.Bitrate(), metadata.SampleRate(), metadata.Seconds(),
+            escaped_filename.c_str(), (int) num_samples, duration,
+            start_offset, codegen.getVersion(), codegen_time, decode_time,
+            codegen.getNumCodes(), code.c_str(), 0);
+        if (length < 0 || (size_t) length >= size) {
+            free(output);
+            return 0;
+        }
+        return output;
+    } catch (...) {
+        return 0;
+    }
+}
+
+void codegen_json_free(char *output) {
+    free(output);
+}
+
+}
@@ -13,6 +13,7 @@ install_requires = [
     'click>=4.0',
     'pyechonest>=9.0',
     'pydub>=0.18',
+    'numpy',
     'pytaglib>=1.4',
 ]
 test_requires = [
@@ -20,6 +21,9 @@ test_requires = [
     'nose',
 ]
 docs_requires = []
+extras_require = {
+    'flac': ['soundfile'],
+}
 setup(
     name='collecting_society_worker',
     version='0.0',
@@ -45,4 +49,5 @@ setup(
     test_suite='c3srepertoireprocessing',
     install_requires=install_requires + docs_requires,
     tests_require=test_requires,
+    extras_require=extras_require,
 )